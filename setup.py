@@ -29,6 +29,7 @@ setup(
         'tensor2tensor/bin/t2t-avg-all',
         'tensor2tensor/bin/t2t-bleu',
         'tensor2tensor/bin/t2t-translate-all',
+        'tensor2tensor/bin/t2t-reshard',
     ],
     install_requires=[
         'bz2file',
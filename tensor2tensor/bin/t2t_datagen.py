@@ -29,10 +29,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import datetime
 import multiprocessing
 import os
 import random
 import tempfile
+import time
 
 # Dependency imports
 
@@ -203,10 +205,75 @@ def generate_data_for_problem(problem):
   generator_utils.shuffle_dataset(all_output_files)
 
 
+# The Problem that a worker process generates tasks for; see
+# _init_generate_worker.
+_worker_problem = None
+
+
+def _init_generate_worker(problem_name, t2t_usr_dir):
+  """Creates the Problem once per worker, rather than once per task."""
+  global _worker_problem
+  usr_dir.import_usr_dir(t2t_usr_dir)
+  _worker_problem = registry.problem(problem_name)
+
+
 def generate_data_in_process(arg):
+  """Generates one task; returns (task_id, seconds it took)."""
   problem_name, data_dir, tmp_dir, task_id = arg
-  problem = registry.problem(problem_name)
+  problem = _worker_problem or registry.problem(problem_name)
+  start_time = time.time()
   problem.generate_data(data_dir, tmp_dir, task_id)
+  return task_id, time.time() - start_time
+
+
+def _format_seconds(seconds):
+  return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def generate_tasks_in_pool(problem, problem_name, data_dir, tmp_dir, task_ids):
+  """Generates the tasks of a multiprocess_generate problem in a pool.
+
+  Tasks are handed out one at a time, biggest first, so that a worker that
+  finishes early takes the next task instead of idling while others work
+  through a longer share. Progress and the estimated remaining time, by task
+  size, are logged as the tasks finish.
+
+  Args:
+    problem: the Problem, already prepared to generate.
+    problem_name: its registered name.
+    data_dir: a string
+    tmp_dir: a string
+    task_ids: a list of integers
+  """
+  sizes = {task_id: problem.generate_task_size(data_dir, tmp_dir, task_id)
+           for task_id in task_ids}
+  total_size = sum(sizes.values())
+  args = [(problem_name, data_dir, tmp_dir, task_id)
+          for task_id in sorted(task_ids, key=lambda t: sizes[t],
+                                reverse=True)]
+  pool = multiprocessing.Pool(processes=FLAGS.num_concurrent_processes,
+                              initializer=_init_generate_worker,
+                              initargs=(problem_name, FLAGS.t2t_usr_dir))
+  try:
+    start_time = time.time()
+    done_size = 0
+    for num_done, (task_id, task_time) in enumerate(
+        pool.imap_unordered(generate_data_in_process, args, chunksize=1), 1):
+      done_size += sizes[task_id]
+      elapsed = time.time() - start_time
+      if done_size and total_size:
+        eta = _format_seconds(elapsed * (total_size - done_size) / done_size)
+      else:
+        eta = "unknown"
+      tf.logging.info(
+          "Task %d of %s done in %s; %d/%d tasks, %.1f%% of the input, "
+          "%s elapsed, ETA %s.", task_id, problem_name,
+          _format_seconds(task_time), num_done, len(args),
+          100.0 * done_size / (total_size or 1), _format_seconds(elapsed),
+          eta)
+  finally:
+    pool.terminate()
+    pool.join()
 
 
 def generate_data_for_registered_problem(problem_name):
@@ -225,11 +292,9 @@ def generate_data_for_registered_problem(problem_name):
     else:
       task_id_start = 0
       task_id_end = problem.num_generate_tasks
-    pool = multiprocessing.Pool(processes=FLAGS.num_concurrent_processes)
     problem.prepare_to_generate(data_dir, tmp_dir)
-    args = [(problem_name, data_dir, tmp_dir, task_id)
-            for task_id in range(task_id_start, task_id_end)]
-    pool.map(generate_data_in_process, args)
+    generate_tasks_in_pool(problem, problem_name, data_dir, tmp_dir,
+                           list(range(task_id_start, task_id_end)))
   else:
     problem.generate_data(data_dir, tmp_dir, task_id)
 
@@ -0,0 +1,73 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for t2t_datagen."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import tempfile
+
+# Dependency imports
+
+from tensor2tensor.bin import t2t_datagen
+from tensor2tensor.data_generators import problem
+from tensor2tensor.utils import registry
+
+import tensorflow as tf
+
+FLAGS = tf.flags.FLAGS
+
+
+@registry.register_problem
+class DatagenTestProblem(problem.Problem):
+  """Logs the tasks it generates, in the order they are generated."""
+
+  task_sizes = [3, 10, 1, 7, 5]
+
+  def generate_task_size(self, data_dir, tmp_dir, task_id):
+    del data_dir, tmp_dir
+    return self.task_sizes[task_id]
+
+  def generate_data(self, data_dir, tmp_dir, task_id=-1):
+    del data_dir
+    with open(os.path.join(tmp_dir, "tasks.log"), "a") as f:
+      f.write("%d\n" % task_id)
+
+
+class GenerateTasksInPoolTest(tf.test.TestCase):
+
+  def _generate_tasks(self, num_processes):
+    """Returns the task ids in the order the workers generated them."""
+    FLAGS.num_concurrent_processes = num_processes
+    tmp_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    t2t_datagen.generate_tasks_in_pool(
+        DatagenTestProblem(), "datagen_test_problem", self.get_temp_dir(),
+        tmp_dir, list(range(len(DatagenTestProblem.task_sizes))))
+    with open(os.path.join(tmp_dir, "tasks.log")) as f:
+      return [int(line) for line in f]
+
+  def testBiggestTasksFirst(self):
+    # A single worker generates the tasks in the order they are handed out.
+    self.assertEqual([1, 3, 4, 0, 2], self._generate_tasks(1))
+
+  def testEveryTaskOnce(self):
+    self.assertEqual([0, 1, 2, 3, 4], sorted(self._generate_tasks(3)))
+
+
+if __name__ == "__main__":
+  tf.test.main()
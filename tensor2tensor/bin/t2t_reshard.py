@@ -0,0 +1,89 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rewrite the shards of a TFRecord dataset as a different number of shards.
+
+The records of all input shards are shuffled together, so this can also be
+used to shuffle a dataset globally rather than within each shard.
+
+```
+t2t-reshard \
+  --input_pattern=$DATA_DIR/translate_ende_wmt32k-train-* \
+  --output_prefix=$NEW_DATA_DIR/translate_ende_wmt32k-train \
+  --num_shards=1000 \
+  --num_processes=16 \
+  --max_memory_mb=2048
+```
+
+writes $NEW_DATA_DIR/translate_ende_wmt32k-train-00000-of-01000 and so on.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Dependency imports
+
+from tensor2tensor.data_generators import generator_utils
+
+import tensorflow as tf
+
+flags = tf.flags
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("input_pattern", None,
+                    "Glob pattern of the TFRecord files to read.")
+flags.DEFINE_string("output_prefix", None,
+                    "Path prefix of the output files; a shard suffix such as "
+                    "-00000-of-00010 is appended.")
+flags.DEFINE_integer("num_shards", None, "Number of output files.")
+flags.DEFINE_integer("num_processes", 1,
+                     "Number of processes reading and writing files.")
+flags.DEFINE_integer("max_memory_mb", 0,
+                     "Approximate memory budget for records per process, in "
+                     "megabytes. Unbounded if 0.")
+flags.DEFINE_integer("random_seed", None,
+                     "Seed for the shuffle; random if not set.")
+flags.DEFINE_string("tmp_dir", None,
+                    "Where to write temporary files. Defaults to the output "
+                    "directory.")
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  if not FLAGS.input_pattern or not FLAGS.output_prefix:
+    raise ValueError("Must provide --input_pattern and --output_prefix.")
+  if not FLAGS.num_shards or FLAGS.num_shards < 1:
+    raise ValueError("--num_shards must be positive.")
+  filenames = sorted(tf.gfile.Glob(FLAGS.input_pattern))
+  if not filenames:
+    raise ValueError("No files match %s" % FLAGS.input_pattern)
+  out_filenames = generator_utils.shard_filepath(FLAGS.output_prefix,
+                                                FLAGS.num_shards)
+  existing = generator_utils.outputs_exist(out_filenames)
+  if existing:
+    raise ValueError("Output file %s already exists." % existing)
+  tf.logging.info("Resharding %d files into %d files", len(filenames),
+                  len(out_filenames))
+  counts = generator_utils.reshard_dataset(
+      filenames, out_filenames,
+      max_memory_bytes=FLAGS.max_memory_mb * 2**20 or None,
+      seed=FLAGS.random_seed,
+      num_processes=FLAGS.num_processes,
+      tmp_dir=FLAGS.tmp_dir)
+  tf.logging.info("Wrote %d records", sum(counts))
+
+
+if __name__ == "__main__":
+  tf.app.run()
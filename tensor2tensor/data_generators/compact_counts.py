@@ -0,0 +1,302 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A compact, read-only table of string counts.
+
+A Python dict of unicode strings to ints costs roughly 100 bytes per entry on
+top of the characters themselves, which adds up to tens of GB for the token
+and subtoken count tables of large corpora. CompactCounts stores the same
+table in three flat buffers instead:
+ - the sorted keys, UTF-8 encoded and concatenated into one bytes object,
+ - a NumPy array with the offset of every key in that buffer,
+ - a NumPy array with the counts,
+which is about 16 bytes per entry plus the encoded keys. Lookups are binary
+searches over the sorted keys.
+
+CompactCounter counts into a dict of bounded size, and moves the counts into
+CompactCounts tables whenever the dict is full, so the full table of counts
+never exists as a dict.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import heapq
+import itertools
+import operator
+import sys
+
+# Dependency imports
+
+import numpy as np
+import six
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+try:
+  import resource  # pylint: disable=g-import-not-at-top
+except ImportError:
+  # Not available on Windows.
+  resource = None
+
+# How many keys CompactCounter counts in a dict before compacting them; such a
+# dict takes a few hundred MB.
+_MAX_DICT_ENTRIES = 2**21
+
+# How many tables CompactCounter keeps before merging them.
+_MAX_TABLES = 8
+
+# How many keys from_sorted_items encodes at a time.
+_BATCH_SIZE = 2**14
+
+# How many keys _iteritems decodes at a time. merge() iterates over up to
+# _MAX_TABLES tables at once.
+_DECODE_BATCH_SIZE = 2**12
+
+
+def peak_rss_mb():
+  """Returns the peak resident set size of this process in megabytes, or None.
+
+  None is returned where the resource module is not available.
+  """
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+  if sys.platform == "darwin":
+    return peak / 2.0**20
+  return peak / 2.0**10
+
+
+class CompactCounts(object):
+  """Read-only mapping of unicode strings to int counts.
+
+  Supports len(), `in`, indexing, get() and iteration over keys and items in
+  sorted order, so it can be passed where a dict of token counts is expected.
+  """
+
+  def __init__(self, blob, offsets, counts):
+    """Initialize from the flat buffers; see from_dict().
+
+    Args:
+      blob: bytes; the sorted, UTF-8 encoded keys, concatenated.
+      offsets: int64 NumPy array of len(counts) + 1 offsets into blob.
+      counts: int64 NumPy array of counts.
+    """
+    self._blob = blob
+    self._offsets = offsets
+    self._counts = counts
+
+  @classmethod
+  def from_dict(cls, counts):
+    """Builds a table from a dictionary of unicode strings to ints.
+
+    Args:
+      counts: a dictionary; it can be deleted afterwards to reclaim its memory.
+
+    Returns:
+      a CompactCounts.
+    """
+    # Only references to the keys are copied; the encoded keys are streamed
+    # into the buffer.
+    keys = sorted(six.iterkeys(counts))
+    return cls.from_sorted_items((key, counts[key]) for key in keys)
+
+  @classmethod
+  def from_sorted_items(cls, items):
+    """Builds a table from (unicode string, int) pairs.
+
+    Args:
+      items: an iterable of pairs, sorted by their strings, which are unique.
+
+    Returns:
+      a CompactCounts.
+    """
+    items = iter(items)
+    blobs = []
+    offsets = [np.zeros(1, dtype=np.int64)]
+    count_arrays = []
+    blob_length = 0
+    while True:
+      batch = list(itertools.islice(items, _BATCH_SIZE))
+      if not batch:
+        break
+      keys = [key for key, _ in batch]
+      text = u"".join(keys)
+      blob = text.encode("utf-8")
+      if len(blob) == len(text):
+        # All ASCII, so the encoded keys are as long as the keys.
+        lengths = np.fromiter(six.moves.map(len, keys), dtype=np.int64,
+                              count=len(keys))
+      else:
+        lengths = np.fromiter((len(key.encode("utf-8")) for key in keys),
+                              dtype=np.int64, count=len(keys))
+      offsets.append(blob_length + np.cumsum(lengths))
+      count_arrays.append(np.fromiter((count for _, count in batch),
+                                      dtype=np.int64, count=len(batch)))
+      blobs.append(blob)
+      blob_length += len(blob)
+    return cls(b"".join(blobs), np.concatenate(offsets),
+               np.concatenate(count_arrays or [np.zeros(0, dtype=np.int64)]))
+
+  @property
+  def nbytes(self):
+    """The number of bytes used by the buffers."""
+    return len(self._blob) + self._offsets.nbytes + self._counts.nbytes
+
+  def __len__(self):
+    return len(self._counts)
+
+  def _key(self, i):
+    return self._blob[self._offsets[i]:self._offsets[i + 1]].decode("utf-8")
+
+  def _index(self, key):
+    """Returns the index of key, or -1 if it is not in the table."""
+    # Compare unicode strings, as from_dict sorted them, rather than bytes:
+    # the two orders differ on narrow Python 2 builds.
+    lo, hi = 0, len(self._counts)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._key(mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < len(self._counts) and self._key(lo) == key:
+      return lo
+    return -1
+
+  def __contains__(self, key):
+    return self._index(key) >= 0
+
+  def __getitem__(self, key):
+    i = self._index(key)
+    if i < 0:
+      raise KeyError(key)
+    return int(self._counts[i])
+
+  def get(self, key, default=None):
+    i = self._index(key)
+    return default if i < 0 else int(self._counts[i])
+
+  def __iter__(self):
+    return self.iterkeys()
+
+  def iterkeys(self):
+    for key, _ in self.iteritems():
+      yield key
+
+  def iteritems(self, min_count=None):
+    """Yields (key, count) pairs in sorted order.
+
+    Args:
+      min_count: if not None, only yield the keys with at least this count.
+        The other keys are skipped without being decoded.
+    """
+    if min_count is None:
+      return self._iteritems(slice(None))
+    return self._iteritems(np.flatnonzero(self._counts >= min_count))
+
+  def iteritems_of_shard(self, shard, num_shards):
+    """Yields the (key, count) pairs at positions shard + k * num_shards."""
+    return self._iteritems(slice(shard, None, num_shards))
+
+  def _iteritems(self, indices):
+    """Yields the (key, count) pairs at indices, a slice or an index array."""
+    if isinstance(indices, slice):
+      starts = self._offsets[:-1][indices]
+      ends = self._offsets[1:][indices]
+    else:
+      starts = self._offsets[indices]
+      ends = self._offsets[indices + 1]
+    counts = self._counts[indices]
+    blob = self._blob
+    # Convert a batch at a time, as Python ints take several times the memory
+    # of the arrays.
+    for i in xrange(0, len(counts), _DECODE_BATCH_SIZE):
+      batch = slice(i, i + _DECODE_BATCH_SIZE)
+      for start, end, count in zip(starts[batch].tolist(),
+                                   ends[batch].tolist(),
+                                   counts[batch].tolist()):
+        yield blob[start:end].decode("utf-8"), count
+
+  # six.iterkeys and six.iteritems call these on Python 3.
+  keys = iterkeys
+  items = iteritems
+
+
+def merge(tables):
+  """Adds up tables of counts.
+
+  Args:
+    tables: a list of CompactCounts.
+
+  Returns:
+    a CompactCounts with the keys of all the tables, and the sums of their
+    counts.
+  """
+  if len(tables) == 1:
+    return tables[0]
+  items = heapq.merge(*[table.iteritems() for table in tables])
+  return CompactCounts.from_sorted_items(
+      (key, sum(count for _, count in group))
+      for key, group in itertools.groupby(items, operator.itemgetter(0)))
+
+
+class CompactCounter(object):
+  """Counts strings into CompactCounts tables.
+
+  Add counts to the dict `counts`, and call maybe_flush() after every few
+  additions. When the dict has grown to max_dict_entries keys, maybe_flush()
+  moves its counts into a table and clears it. compact() returns all the
+  counts as one table.
+
+  Typical use:
+
+    counter = CompactCounter()
+    counts = counter.counts
+    for line in lines:
+      for token in line.split():
+        counts[token] += 1
+      counter.maybe_flush()
+    token_counts = counter.compact()
+  """
+
+  def __init__(self, max_dict_entries=None):
+    self.counts = collections.defaultdict(int)
+    self._max_dict_entries = max_dict_entries or _MAX_DICT_ENTRIES
+    self._tables = []
+
+  def maybe_flush(self):
+    if len(self.counts) >= self._max_dict_entries:
+      self._flush()
+
+  def _flush(self):
+    self.add_table(CompactCounts.from_dict(self.counts))
+    self.counts.clear()
+
+  def add_table(self, table):
+    """Adds the counts of a CompactCounts."""
+    self._tables.append(table)
+    if len(self._tables) >= _MAX_TABLES:
+      self._tables = [merge(self._tables)]
+
+  def compact(self):
+    """Returns all the counts as one CompactCounts, and empties the counter."""
+    if self.counts or not self._tables:
+      self._flush()
+    table = merge(self._tables)
+    self._tables = []
+    return table
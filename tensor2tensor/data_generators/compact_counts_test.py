@@ -0,0 +1,97 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tensor2tensor.data_generators.compact_counts."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+
+# Dependency imports
+
+import mock
+import six
+
+from tensor2tensor.data_generators import compact_counts
+from tensor2tensor.data_generators import text_encoder
+import tensorflow as tf
+
+
+class CompactCountsTest(tf.test.TestCase):
+
+  def test_mapping(self):
+    counts = {"the": 7, "quick": 2, "brown": 1, "fox": 3, "\U0001F638": 4,
+              "jumps": 1, "": 5}
+    table = compact_counts.CompactCounts.from_dict(counts)
+
+    self.assertEqual(len(counts), len(table))
+    self.assertEqual(counts, dict(six.iteritems(table)))
+    self.assertEqual(sorted(counts), list(six.iterkeys(table)))
+    for key, count in six.iteritems(counts):
+      self.assertIn(key, table)
+      self.assertEqual(count, table[key])
+    self.assertNotIn("dog", table)
+    self.assertIsNone(table.get("dog"))
+    self.assertEqual(0, table.get("fo", 0))
+    with self.assertRaises(KeyError):
+      _ = table["th"]
+
+  def test_iteritems_with_min_count(self):
+    counts = {"a": 1, "b": 3, "c": 2, "d": 5}
+    table = compact_counts.CompactCounts.from_dict(counts)
+    self.assertEqual([("b", 3), ("d", 5)], list(table.iteritems(min_count=3)))
+
+  def test_iteritems_of_shard(self):
+    counts = {"a": 1, "b": 3, "c": 2, "d": 5, "e": 4}
+    table = compact_counts.CompactCounts.from_dict(counts)
+    self.assertEqual([("b", 3), ("e", 4)],
+                     list(table.iteritems_of_shard(1, 3)))
+
+  def test_merge(self):
+    tables = [compact_counts.CompactCounts.from_dict(counts)
+              for counts in [{"a": 1, "b": 2}, {"b": 3, "c": 4}, {"a": 5}]]
+    self.assertEqual({"a": 6, "b": 5, "c": 4},
+                     dict(six.iteritems(compact_counts.merge(tables))))
+
+  def test_counter_matches_dict(self):
+    words = ("the quick brown fox jumps over the lazy dog \U0001F638 " * 3 +
+             " ".join(str(i) for i in range(100))).split()
+    expected = collections.Counter(words)
+    # Flush every few words, and so merge tables several times.
+    counter = compact_counts.CompactCounter(max_dict_entries=3)
+    with mock.patch.object(compact_counts, "_BATCH_SIZE", 7):
+      for word in words:
+        counter.counts[word] += 1
+        counter.maybe_flush()
+      table = counter.compact()
+    self.assertEqual(dict(expected), dict(six.iteritems(table)))
+    self.assertEqual(0, len(compact_counts.CompactCounter().compact()))
+
+  def test_build_vocab_from_compact_counts(self):
+    corpus = "the quick brown fox jumps over the lazy dog"
+    token_counts = collections.Counter(corpus.split(" "))
+    expected = text_encoder.SubwordTextEncoder.build_to_target_size(
+        100, token_counts, 2, 10)
+    encoder = text_encoder.SubwordTextEncoder.build_to_target_size(
+        100, compact_counts.CompactCounts.from_dict(token_counts), 2, 10)
+    self.assertEqual(expected.all_subtoken_strings,
+                     encoder.all_subtoken_strings)
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -26,6 +26,8 @@ from __future__ import print_function
 import itertools
 # Dependency imports
 
+import numpy as np
+import six
 from six.moves import xrange  # pylint: disable=redefined-builtin
 from tensor2tensor.data_generators import text_encoder
 
@@ -53,6 +55,8 @@ class DNAEncoder(text_encoder.TextEncoder):
     ids = range(self._num_reserved_ids, len(tokens) + self._num_reserved_ids)
     self._ids_to_tokens = dict(zip(ids, tokens))
     self._tokens_to_ids = dict(zip(tokens, ids))
+    # Lookup tables for the vectorized encoder, built on first use.
+    self._char_codes = None
 
   def _tokens(self):
     chunks = []
@@ -69,6 +73,106 @@ class DNAEncoder(text_encoder.TextEncoder):
     return len(self._ids_to_tokens) + self._num_reserved_ids
 
   def encode(self, s):
+    """Encodes a sequence of bases.
+
+    Args:
+      s: a string or list of bases, a 1-D NumPy array of bases as bytes
+        (dtype "S1", or uint8 character codes), or a 2-D NumPy array with one
+        row per base, one-hot encoded in the order of BASES, where all-zero
+        rows are UNK. The latter is the format of the gene expression h5
+        files.
+
+    Returns:
+      a list of ids.
+
+    Raises:
+      ValueError: if s has unknown bases or misplaced PADs.
+    """
+    if self._char_codes is None:
+      self._init_chunk_tables()
+    if isinstance(s, np.ndarray) and s.ndim == 2:
+      if self._char_codes is False:
+        return self._encode_chunks(self._one_hot_to_bases(s))
+      return self._codes_to_ids(self._one_hot_to_codes(s))
+    try:
+      if isinstance(s, np.ndarray) and s.dtype == np.uint8:
+        chars = s.tobytes()
+      elif isinstance(s, np.ndarray):
+        chars = s.astype("S1").tobytes()
+      else:
+        chars = "".join(s).encode("ascii")
+    except UnicodeError:
+      chars = None
+    if self._char_codes is False or chars is None:
+      return self._encode_chunks(s)
+    codes = self._char_codes[np.frombuffer(chars, dtype=np.uint8)]
+    if (codes < 0).any():
+      return self._encode_chunks(chars.decode("ascii"))
+    return self._codes_to_ids(codes)
+
+  def _init_chunk_tables(self):
+    """Builds the tables that map bases to codes and chunks of codes to ids.
+
+    The characters are numbered in sorted order, and a chunk is the number
+    whose digits are the codes of its characters. The vocabulary is sorted
+    too, so the ids follow the order of these numbers, but not every number
+    is a chunk (PAD only appears at the end), so a table maps them to ids,
+    with -1 for the ones that are not.
+    """
+    chars = sorted(set(self.BASES + [self.UNK, self.PAD]))
+    if any(len(c) != 1 or ord(c) >= 128 for c in chars):
+      # Only single ASCII characters can be looked up by their byte value.
+      self._char_codes = False
+      return
+    self._chars = chars
+    self._char_codes = np.full(256, -1, dtype=np.int64)
+    for code, c in enumerate(chars):
+      self._char_codes[ord(c)] = code
+    self._pad_code = chars.index(self.PAD)
+    self._one_hot_codes = np.full(2**len(self.BASES), -1, dtype=np.int64)
+    self._one_hot_codes[0] = chars.index(self.UNK)
+    for i, c in enumerate(self.BASES):
+      self._one_hot_codes[1 << i] = chars.index(c)
+    self._place_values = len(chars)**np.arange(self._chunk_size - 1, -1, -1)
+    self._chunk_ids = np.full(len(chars)**self._chunk_size, -1, dtype=np.int32)
+    for token, token_id in six.iteritems(self._tokens_to_ids):
+      if len(token) == self._chunk_size and set(token) <= set(chars):
+        self._chunk_ids[self._place_values.dot(
+            [chars.index(c) for c in token])] = token_id
+
+  def _one_hot_to_codes(self, one_hot):
+    # Read each row as a binary number and look its code up.
+    codes = self._one_hot_codes[
+        one_hot.astype(bool).dot(1 << np.arange(len(self.BASES)))]
+    if (codes < 0).any():
+      raise ValueError("More than one base in row %d" % np.argmax(codes < 0))
+    return codes
+
+  def _one_hot_to_bases(self, one_hot):
+    bases = []
+    for row in one_hot:
+      hot = np.flatnonzero(row)
+      if len(hot) > 1:
+        raise ValueError("More than one base in row %d" % len(bases))
+      bases.append(self.BASES[hot[0]] if len(hot) else self.UNK)
+    return bases
+
+  def _codes_to_ids(self, codes):
+    """Maps character codes to ids, chunk_size codes at a time."""
+    extra = len(codes) % self._chunk_size
+    if extra > 0:
+      codes = np.concatenate(
+          [codes, np.full(self._chunk_size - extra, self._pad_code,
+                          dtype=codes.dtype)])
+    ids = self._chunk_ids[
+        codes.reshape(-1, self._chunk_size).dot(self._place_values)]
+    if (ids < 0).any():
+      # Let the slow path raise the error.
+      return self._encode_chunks([self._chars[c] for c in codes])
+    return ids.tolist()
+
+  def _encode_chunks(self, s):
+    """Encodes one chunk at a time; raises ValueError for unknown chunks."""
     bases = list(s)
     extra = len(bases) % self._chunk_size
     if extra > 0:
@@ -82,7 +186,7 @@ class DNAEncoder(text_encoder.TextEncoder):
       end_idx = start_idx + self._chunk_size
       chunk = tuple(bases[start_idx:end_idx])
       if chunk not in self._tokens_to_ids:
-        raise ValueError("Unrecognized token %s" % chunk)
+        raise ValueError("Unrecognized token %s" % (chunk,))
       ids.append(self._tokens_to_ids[chunk])
     return ids
 
@@ -19,8 +19,13 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import random
+import time
+
 # Dependency imports
 
+import numpy as np
+
 from tensor2tensor.data_generators import dna_encoder
 import tensorflow as tf
 
@@ -37,6 +42,36 @@ class DnaEncoderTest(tf.test.TestCase):
       decoded = encoder.decode(encoded)
       self.assertEqual(original, decoded)
 
+  def test_vectorized_encode_matches_chunk_lookup(self):
+    rng = random.Random(0)
+    for chunk_size in [1, 2, 3, 4, 6]:
+      encoder = dna_encoder.DNAEncoder(chunk_size=chunk_size)
+      for length in [0, 1, 5, 17, 64]:
+        bases = ''.join(rng.choice('ACTGN') for _ in range(length))
+        expected = encoder._encode_chunks(bases)
+        self.assertEqual(expected, encoder.encode(bases))
+        self.assertEqual(expected, encoder.encode(list(bases)))
+        self.assertEqual(expected,
+                         encoder.encode(np.array(list(bases), dtype='S1')))
+        self.assertEqual(expected, encoder.encode(
+            np.frombuffer(bases.encode('ascii'), dtype=np.uint8)))
+
+  def test_encode_one_hot(self):
+    encoder = dna_encoder.DNAEncoder(chunk_size=4)
+    bases = 'NACGTTNNGCA'
+    one_hot = np.array([[b == c for c in encoder.BASES] for b in bases])
+    self.assertEqual(encoder.encode(bases), encoder.encode(one_hot))
+    one_hot[0, :2] = True
+    with self.assertRaises(ValueError):
+      encoder.encode(one_hot)
+
+  def test_encode_raises_on_unknown_chunks(self):
+    encoder = dna_encoder.DNAEncoder(chunk_size=2)
+    self.assertEqual(encoder.encode('A'), encoder.encode('A0'))
+    for bases in ['ACX', 'AC\u00e9', '0A']:
+      with self.assertRaises(ValueError):
+        encoder.encode(bases)
+
   def test_delimited_dna_encoder(self):
     original = 'TTCGCGGNNN,AACCCAACGC,CATCTATGTA,NNTTGAGTTG,TTGAGTTAAA'
 
@@ -48,5 +83,38 @@ class DnaEncoderTest(tf.test.TestCase):
       self.assertEqual(original, decoded)
 
 
+class DnaEncoderBenchmark(tf.test.Benchmark):
+  """Compares encoding one-hot h5 records with and without NumPy.
+
+  Run with:
+    python dna_encoder_test.py --benchmarks=DnaEncoderBenchmark
+  """
+
+  def benchmark_encode_one_hot(self):
+    encoder = dna_encoder.DNAEncoder(chunk_size=4)
+    rng = np.random.RandomState(0)
+    # A record of the gene expression h5 files.
+    one_hot = np.eye(4, dtype=bool)[rng.randint(0, 4, size=131072)]
+    bases = [encoder.BASES[i] for i in one_hot.argmax(axis=1)]
+    encoder.encode(bases)
+    num_iters = 10
+
+    start_time = time.time()
+    for _ in range(num_iters):
+      expected = encoder._encode_chunks(bases)
+    chunk_lookup_time = (time.time() - start_time) / num_iters
+    start_time = time.time()
+    for _ in range(num_iters):
+      ids = encoder.encode(one_hot)
+    vectorized_time = (time.time() - start_time) / num_iters
+    assert ids == expected
+
+    self.report_benchmark(
+        iters=num_iters,
+        wall_time=vectorized_time,
+        extras={'chunk_lookup_secs': chunk_lookup_time,
+                'vectorized_secs': vectorized_time})
+
+
 if __name__ == '__main__':
   tf.test.main()
@@ -35,14 +35,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import math
 import multiprocessing as mp
 import os
 
 # Dependency imports
 
 import h5py
-import numpy as np
 
 from six.moves import xrange  # pylint: disable=redefined-builtin
 
@@ -55,7 +53,8 @@ from tensor2tensor.utils import registry
 
 import tensorflow as tf
 
-MAX_CONCURRENT_PROCESSES = 10
+# Number of examples read from the h5 file at a time.
+READ_BATCH_SIZE = 16
 
 
 class GeneExpressionProblem(problem.Problem):
@@ -106,8 +105,8 @@ class GeneExpressionProblem(problem.Problem):
 
     # Collect all_filepaths to later shuffle
     all_filepaths = []
-    # Collect created shard processes to start and join
-    processes = []
+    # One task per shard
+    tasks = []
 
     datasets = [(self.training_filepaths, self.num_shards, "train",
                  num_train_examples), (self.dev_filepaths, 10, "valid",
@@ -118,30 +117,35 @@ class GeneExpressionProblem(problem.Problem):
       all_filepaths.extend(outfiles)
       for start_idx, end_idx, outfile in generate_shard_args(
           outfiles, num_examples):
-        p = mp.Process(
-            target=generate_dataset,
-            args=(h5_filepath, key_prefix, [outfile], self.chunk_size,
-                  start_idx, end_idx))
-        processes.append(p)
+        tasks.append((key_prefix, [outfile], self.chunk_size, start_idx,
+                      end_idx))
 
     # 1 per training shard + 10 for dev + 10 for test
-    assert len(processes) == self.num_shards + 20
-
-    # Start and wait for processes in batches
-    num_batches = int(
-        math.ceil(float(len(processes)) / MAX_CONCURRENT_PROCESSES))
-    for i in xrange(num_batches):
-      start = i * MAX_CONCURRENT_PROCESSES
-      end = start + MAX_CONCURRENT_PROCESSES
-      current = processes[start:end]
-      for p in current:
-        p.start()
-      for p in current:
-        p.join()
+    assert len(tasks) == self.num_shards + 20
+
+    # Idle workers take the next shard, so the pool stays busy until the
+    # last shard is done. Starting with the biggest shards keeps a big one
+    # from being left for the end.
+    tasks.sort(key=lambda task: task[4] - task[3], reverse=True)
+    pool = mp.Pool(processes=self.num_generate_processes,
+                   initializer=_open_h5_file_in_worker,
+                   initargs=(h5_filepath,))
+    try:
+      for _ in pool.imap_unordered(_generate_dataset_in_worker, tasks,
+                                   chunksize=1):
+        pass
+    finally:
+      pool.terminate()
+      pool.join()
 
     # Shuffle
     generator_utils.shuffle_dataset(all_filepaths)
 
+  @property
+  def num_generate_processes(self):
+    """Number of worker processes generating shards."""
+    return mp.cpu_count()
+
   def hparams(self, defaults, unused_model_hparams):
     p = defaults
     vocab_size = self._encoders["inputs"].vocab_size
@@ -218,6 +222,24 @@ def generate_shard_args(outfiles, num_examples):
   return zip(start_idxs, end_idxs, outfiles)
 
 
+# The h5 file opened by a worker process of GeneExpressionProblem.generate_data
+_worker_h5_file = None
+
+
+def _open_h5_file_in_worker(h5_filepath):
+  global _worker_h5_file
+  _worker_h5_file = h5py.File(h5_filepath, "r")
+
+
+def _generate_dataset_in_worker(args):
+  key_prefix, out_filepaths, chunk_size, start_idx, end_idx = args
+  print("PID: %d, Key: %s, (Start, End): (%s, %s)" % (os.getpid(), key_prefix,
+                                                      start_idx, end_idx))
+  generator_utils.generate_files(
+      _h5_file_examples(_worker_h5_file, key_prefix, chunk_size, start_idx,
+                        end_idx), out_filepaths)
+
+
 def generate_dataset(h5_filepath,
                      key_prefix,
                      out_filepaths,
@@ -236,26 +258,44 @@ def dataset_generator(filepath,
                       chunk_size=1,
                       start_idx=None,
                       end_idx=None):
-  encoder = dna_encoder.DNAEncoder(chunk_size=chunk_size)
   with h5py.File(filepath, "r") as h5_file:
-    # Get input keys from h5_file
-    src_keys = [s % dataset for s in ["%s_in", "%s_na", "%s_out"]]
-    src_values = [h5_file[k] for k in src_keys]
-    inp_data, mask_data, out_data = src_values
-    assert len(set([v.len() for v in src_values])) == 1
-
-    if start_idx is None:
-      start_idx = 0
-    if end_idx is None:
-      end_idx = inp_data.len()
-
-    for i in xrange(start_idx, end_idx):
+    for ex_dict in _h5_file_examples(h5_file, dataset, chunk_size, start_idx,
+                                     end_idx):
+      yield ex_dict
+
+
+def _h5_file_examples(h5_file,
+                      dataset,
+                      chunk_size=1,
+                      start_idx=None,
+                      end_idx=None):
+  """Yields the example dicts of records [start_idx, end_idx) of a dataset."""
+  encoder = dna_encoder.DNAEncoder(chunk_size=chunk_size)
+  # Get input keys from h5_file
+  src_keys = [s % dataset for s in ["%s_in", "%s_na", "%s_out"]]
+  src_values = [h5_file[k] for k in src_keys]
+  inp_data, mask_data, out_data = src_values
+  assert len(set([v.len() for v in src_values])) == 1
+
+  if start_idx is None:
+    start_idx = 0
+  if end_idx is None:
+    end_idx = inp_data.len()
+
+  for batch_start in xrange(start_idx, end_idx, READ_BATCH_SIZE):
+    # Read contiguous slabs rather than one record at a time.
+    batch_end = min(batch_start + READ_BATCH_SIZE, end_idx)
+    inp_batch = inp_data[batch_start:batch_end]
+    mask_batch = mask_data[batch_start:batch_end]
+    out_batch = out_data[batch_start:batch_end]
+    for j in xrange(batch_end - batch_start):
+      i = batch_start + j
       if i % 100 == 0:
         print("Generating example %d for %s" % (i, dataset))
-      inputs, mask, outputs = inp_data[i], mask_data[i], out_data[i]
-      ex_dict = to_example_dict(encoder, inputs, mask, outputs)
-      # Original data has one output for every 128 input bases. Ensure that the
-      # ratio has been maintained given the chunk size and removing EOS.
+      ex_dict = to_example_dict(encoder, inp_batch[j], mask_batch[j],
+                                out_batch[j])
+      # Original data has one output for every 128 input bases. Ensure that
+      # the ratio has been maintained given the chunk size and removing EOS.
       assert (len(ex_dict["inputs"]) - 1) == ((
           128 // chunk_size) * ex_dict["targets_shape"][0])
       yield ex_dict
@@ -264,22 +304,8 @@ def dataset_generator(filepath,
 def to_example_dict(encoder, inputs, mask, outputs):
   """Convert single h5 record to an example dict."""
   # Inputs
-  bases = []
-  input_ids = []
-  last_idx = -1
-  for row in np.argwhere(inputs):
-    idx, base_id = row
-    idx, base_id = int(idx), int(base_id)
-    assert idx > last_idx  # if not, means 2 True values in 1 row
-    # Some rows are all False. Those rows are mapped to UNK_ID.
-    while idx != last_idx + 1:
-      bases.append(encoder.UNK)
-      last_idx += 1
-    bases.append(encoder.BASES[base_id])
-    last_idx = idx
-  assert len(inputs) == len(bases)
-
-  input_ids = encoder.encode(bases)
+  # The encoder reads the one-hot rows directly; all-False rows are UNK.
+  input_ids = encoder.encode(inputs)
   input_ids.append(text_encoder.EOS_ID)
 
   # Targets: mask and output
@@ -18,12 +18,18 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+
 # Dependency imports
 
+import h5py
+import mock
 import numpy as np
 
 from tensor2tensor.data_generators import dna_encoder
 from tensor2tensor.data_generators import gene_expression
+from tensor2tensor.data_generators import generator_utils
+from tensor2tensor.utils import registry
 
 import tensorflow as tf
 
@@ -69,6 +75,63 @@ class GeneticsTest(tf.test.TestCase):
     self.assertAllEqual([9, 18, 27, 37], ends)
     self.assertAllEqual(fnames, outfiles)
 
+  def testGenerateDataMatchesRecordByRecord(self):
+    tmp_dir = self.get_temp_dir()
+    rng = np.random.RandomState(0)
+    num_examples = {"train": 45, "valid": 23, "test": 12}
+    with h5py.File(os.path.join(tmp_dir, "tiny.h5"), "w") as h5_file:
+      for key_prefix, n in num_examples.items():
+        # One-hot bases, with some all-False (UNK) rows.
+        h5_file["%s_in" % key_prefix] = np.eye(5, 4, dtype=bool)[
+            rng.randint(0, 5, size=(n, 256))]
+        h5_file["%s_na" % key_prefix] = rng.rand(n, 2) > 0.5
+        h5_file["%s_out" % key_prefix] = rng.rand(n, 2, 3)
+
+    problem = TinyGeneExpressionProblem()
+    out_dir = os.path.join(tmp_dir, "out")
+    os.mkdir(out_dir)
+    with mock.patch.object(generator_utils, "shuffle_dataset"):
+      problem.generate_data(out_dir, tmp_dir)
+
+    # Reference: one process reading one record at a time.
+    encoder = dna_encoder.DNAEncoder(chunk_size=problem.chunk_size)
+    ref_dir = os.path.join(tmp_dir, "ref")
+    os.mkdir(ref_dir)
+    datasets = [(problem.training_filepaths, problem.num_shards, "train"),
+                (problem.dev_filepaths, 10, "valid"),
+                (problem.test_filepaths, 10, "test")]
+    with h5py.File(os.path.join(tmp_dir, "tiny.h5"), "r") as h5_file:
+      for fname_fn, nshards, key_prefix in datasets:
+        outfiles = fname_fn(ref_dir, nshards, shuffled=False)
+        records = [h5_file["%s_%s" % (key_prefix, k)]
+                   for k in ["in", "na", "out"]]
+        for start, end, outfile in gene_expression.generate_shard_args(
+            outfiles, num_examples[key_prefix]):
+          generator_utils.generate_files(
+              (gene_expression.to_example_dict(
+                  encoder, records[0][i], records[1][i], records[2][i])
+               for i in range(start, end)), [outfile])
+          with open(outfile, "rb") as expected_file:
+            with open(os.path.join(out_dir, os.path.basename(outfile)),
+                      "rb") as f:
+              self.assertEqual(expected_file.read(), f.read())
+
+
+@registry.register_problem
+class TinyGeneExpressionProblem(gene_expression.GeneExpressionProblem):
+
+  @property
+  def h5_file(self):
+    return "tiny.h5"
+
+  @property
+  def num_shards(self):
+    return 4
+
+  @property
+  def num_generate_processes(self):
+    return 2
+
 
 if __name__ == "__main__":
   tf.test.main()
@@ -19,20 +19,30 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-from collections import defaultdict
+import bisect
+from collections import deque
 import gzip
+import itertools
+import mmap
+import multiprocessing
 import os
 import random
 import stat
+import struct
+import sys
 import tarfile
+import threading
 
 # Dependency imports
 
+import numpy as np
 import requests
 import six
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import six.moves.urllib_request as urllib  # Imports urllib on Python2, urllib.request on Python3
 
+from tensor2tensor.data_generators import compact_counts
+from tensor2tensor.data_generators import record_index
 from tensor2tensor.data_generators import text_encoder
 from tensor2tensor.data_generators import tokenizer
 
@@ -40,6 +50,17 @@ import tensorflow as tf
 
 UNSHUFFLED_SUFFIX = "-unshuffled"
 
+# The length field that starts a TFRecord.
+_RECORD_LENGTH = struct.Struct("<Q")
+
+# Number of cases that a worker of generate_files converts per task.
+_SERIALIZE_BATCH_SIZE = 64
+# Number of serialized records buffered for each shard's writer thread.
+_WRITE_QUEUE_SIZE = 1024
+# The most files a reshard_dataset task writes at once; the default limit of
+# open files is often 1024.
+_MAX_OPEN_WRITERS = 128
+
 
 def to_example(dictionary):
   """Helper: build tf.Example from (string -> int/float/str list) dictionary."""
@@ -74,7 +95,7 @@ def generate_files_distributed(generator,
   output_filename = sharded_name(output_name, task_id, num_shards)
   output_file = os.path.join(output_dir, output_filename)
   tf.logging.info("Writing to file %s", output_file)
-  writer = tf.python_io.TFRecordWriter(output_file)
+  writer = record_index.IndexedRecordWriter(output_file)
 
   counter = 0
   for case in generator:
@@ -132,24 +153,144 @@ def outputs_exist(filenames):
       return out_fname
 
 
-def generate_files(generator, output_filenames, max_cases=None):
+def generate_files(generator, output_filenames, max_cases=None,
+                   num_processes=None):
   """Generate cases from a generator and save as TFRecord files.
 
   Generated cases are transformed to tf.Example protos and saved as TFRecords
   in sharded files named output_dir/output_name-00..N-of-00..M=num_shards.
 
+  If an earlier run was interrupted while writing the files, this resumes
+  it: the cases that all the files already have are kept, the generator is
+  replayed past them without converting or writing them, and the rest are
+  written. The generator must yield the same cases as in the earlier run.
+
   Args:
     generator: a generator yielding (string -> int/float/str list) dictionaries.
     output_filenames: List of output file paths.
     max_cases: maximum number of cases to get from the generator;
       if None (default), we use the generator until StopIteration is raised.
+    num_processes: If greater than 1, the generator runs in this process while
+      a pool of this many worker processes converts the cases to serialized
+      tf.Examples, and each file is written by its own thread. The files are
+      the same as with a single process.
   """
   if outputs_exist(output_filenames):
     tf.logging.info("Skipping generator because outputs files exist")
     return
+  if all(record_index.is_complete(fname) for fname in output_filenames):
+    tf.logging.info("Skipping generator because outputs files are complete")
+    return
+  num_written, writers = _resume_files(output_filenames)
+  cases = itertools.islice(_limit_cases(generator, max_cases), num_written,
+                           None)
+  num_shards = len(output_filenames)
+  shard = num_written % num_shards
+  if num_processes and num_processes > 1:
+    if multiprocessing.current_process().daemon:
+      # Daemonic processes, e.g. workers of a pool, cannot start a pool.
+      tf.logging.warning("Generating cases in a single process.")
+    else:
+      _write_records_in_threads(_serialize_in_pool(cases, num_processes),
+                                writers, shard)
+      _remove_partial_files(output_filenames)
+      return
+  try:
+    for case in cases:
+      example = to_example(case)
+      writers[shard].write(example.SerializeToString())
+      shard = (shard + 1) % num_shards
+  except:  # pylint: disable=bare-except
+    # Leave the files without an index, so that a new run resumes them.
+    for writer in writers:
+      writer.abort()
+    raise
+
+  for writer in writers:
+    writer.close()
+  _remove_partial_files(output_filenames)
+
+
+def _num_readable_records(filename):
+  """Counts the records of a TFRecord file, up to any truncated one."""
+  count = record_index.num_records(filename)
+  if count is not None:
+    return count
+  count = 0
+  try:
+    for _ in tf.python_io.tf_record_iterator(filename):
+      count += 1
+  except tf.errors.DataLossError:
+    pass
+  return count
+
+
+def _resume_files(output_filenames):
+  """Opens writers for the files of generate_files, keeping finished cases.
+
+  Cases are written round-robin, so case i is in file i % num_shards. The
+  files of an interrupted run end wherever their writers stopped; this finds
+  the longest prefix of the cases that is in the files, and rewrites each
+  file to hold just its share of them. The old files are kept as
+  "<file>.partial" until the new ones are closed; see _remove_partial_files.
+
+  Args:
+    output_filenames: a list of file names.
+
+  Returns:
+    (the number of cases in the files, a list of IndexedRecordWriters, one
+    per file, positioned after them).
+  """
   num_shards = len(output_filenames)
-  writers = [tf.python_io.TFRecordWriter(fname) for fname in output_filenames]
-  counter, shard = 0, 0
+  sources = []
+  counts = []
+  for fname in output_filenames:
+    # If a resumed run was interrupted too, both the file and its ".partial"
+    # hold a prefix of the cases of the file; keep the longer one.
+    candidates = [f for f in [fname + ".partial", fname] if tf.gfile.Exists(f)]
+    candidate_counts = [_num_readable_records(f) for f in candidates]
+    if candidates:
+      count, source = max(zip(candidate_counts, candidates))
+    else:
+      count, source = 0, None
+    sources.append(source)
+    counts.append(count)
+  if not any(sources):
+    return 0, [record_index.IndexedRecordWriter(fname)
+               for fname in output_filenames]
+
+  # File s holds cases s, s + num_shards, ...; the first case it is missing
+  # is s + num_shards * (number of records in it).
+  num_written = min(shard + num_shards * count
+                    for shard, count in enumerate(counts))
+  tf.logging.warning("Resuming the generation of %s after %d cases.",
+                     output_filenames[0], num_written)
+  writers = []
+  for shard, (fname, source) in enumerate(zip(output_filenames, sources)):
+    if source == fname:
+      tf.gfile.Rename(fname, fname + ".partial", overwrite=True)
+      record_index.remove_index(fname)
+      source = fname + ".partial"
+    writer = record_index.IndexedRecordWriter(fname)
+    if source:
+      num_kept = max(0, num_written - shard + num_shards - 1) // num_shards
+      records = tf.python_io.tf_record_iterator(source)
+      for record in itertools.islice(records, num_kept):
+        writer.write(record)
+    writers.append(writer)
+  return num_written, writers
+
+
+def _remove_partial_files(output_filenames):
+  """Removes the files that _resume_files kept, once the outputs are closed."""
+  for fname in output_filenames:
+    if tf.gfile.Exists(fname + ".partial"):
+      record_index.remove(fname + ".partial")
+
+
+def _limit_cases(generator, max_cases):
+  """Yields the cases of generate_files: non-None, at most max_cases."""
+  counter = 0
   for case in generator:
     if case is None:
       continue
@@ -158,12 +299,92 @@ def generate_files(generator, output_filenames, max_cases=None):
     counter += 1
     if max_cases and counter > max_cases:
       break
-    example = to_example(case)
-    writers[shard].write(example.SerializeToString())
-    shard = (shard + 1) % num_shards
+    yield case
+
+
+def _serialize_cases(cases):
+  return [to_example(case).SerializeToString() for case in cases]
+
+
+def _serialize_in_pool(cases, num_processes):
+  """Yields serialized tf.Examples of cases, in order, converted in a pool."""
+  pool = multiprocessing.Pool(processes=num_processes)
+  try:
+    # Keep a few batches per worker in flight; imap would read the whole
+    # generator ahead of the workers.
+    pending = deque()
+    batch = []
+    for case in cases:
+      batch.append(case)
+      if len(batch) == _SERIALIZE_BATCH_SIZE:
+        pending.append(pool.apply_async(_serialize_cases, (batch,)))
+        batch = []
+        if len(pending) >= 4 * num_processes:
+          for record in pending.popleft().get():
+            yield record
+    if batch:
+      pending.append(pool.apply_async(_serialize_cases, (batch,)))
+    while pending:
+      for record in pending.popleft().get():
+        yield record
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def _write_records_in_threads(records, writers, first_shard=0):
+  """Writes records round-robin with the writers, one thread per writer.
 
-  for writer in writers:
-    writer.close()
+  Args:
+    records: an iterable of serialized records.
+    writers: a list of IndexedRecordWriters. They are closed, or aborted if
+      anything fails.
+    first_shard: the index of the writer of the first record.
+  """
+  queues = [six.moves.queue.Queue(maxsize=_WRITE_QUEUE_SIZE)
+            for _ in writers]
+  errors = []
+
+  def write_shard(writer, queue):
+    try:
+      while True:
+        record = queue.get()
+        if record is None:
+          break
+        if not errors:
+          writer.write(record)
+    except Exception as e:  # pylint: disable=broad-except
+      errors.append(e)
+      # Keep emptying the queue so that the main thread does not block.
+      while queue.get() is not None:
+        pass
+    finally:
+      if errors:
+        writer.abort()
+      else:
+        writer.close()
+
+  threads = [threading.Thread(target=write_shard, args=(writer, queue))
+             for writer, queue in zip(writers, queues)]
+  for thread in threads:
+    thread.start()
+  try:
+    num_shards = len(writers)
+    for i, record in enumerate(records):
+      queues[(first_shard + i) % num_shards].put(record)
+      if errors:
+        break
+  except:  # pylint: disable=bare-except
+    # Have the threads abort their writers too.
+    errors.append(sys.exc_info()[1])
+    raise
+  finally:
+    for queue in queues:
+      queue.put(None)
+    for thread in threads:
+      thread.join()
+  if errors:
+    raise errors[0]
 
 
 def download_report_hook(count, block_size, total_size):
@@ -280,7 +501,7 @@ def gunzip_file(gz_path, new_path):
 
 
 def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
-                                generator):
+                                generator, num_processes=None):
   """Inner implementation for vocab generators.
 
   Args:
@@ -289,6 +510,8 @@ def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
     vocab_filename: relative filename where vocab file is stored
     vocab_size: target size of the vocabulary constructed by SubwordTextEncoder
     generator: a generator that produces tokens from the vocabulary
+    num_processes: If greater than 1, count subtokens in a pool of this many
+        worker processes.
 
   Returns:
     A SubwordTextEncoder vocabulary object.
@@ -304,13 +527,22 @@ def get_or_generate_vocab_inner(data_dir, vocab_filename, vocab_size,
     return vocab
 
   tf.logging.info("Generating vocab file: %s", vocab_filepath)
-  token_counts = defaultdict(int)
+  counter = compact_counts.CompactCounter()
+  token_counts = counter.counts
   for item in generator:
     for tok in tokenizer.encode(text_encoder.native_to_unicode(item)):
       token_counts[tok] += 1
+    counter.maybe_flush()
+  token_counts = counter.compact()
+  tf.logging.info("Counted %d distinct tokens in a table of %.1f MB",
+                  len(token_counts), token_counts.nbytes / 2.0**20)
 
   vocab = text_encoder.SubwordTextEncoder.build_to_target_size(
-      vocab_size, token_counts, 1, 1e3)
+      vocab_size, token_counts, 1, 1e3, num_processes=num_processes)
+  tf.logging.info("Built vocab of size %d", vocab.vocab_size)
+  peak_rss_mb = compact_counts.peak_rss_mb()
+  if peak_rss_mb is not None:
+    tf.logging.info("Peak RSS of this process so far: %.1f MB", peak_rss_mb)
 
   if vocab_filepath is not None:
     vocab.store_to_file(vocab_filepath)
@@ -421,6 +653,84 @@ def get_or_generate_txt_vocab(data_dir, vocab_filename, vocab_size,
                                      generate())
 
 
+class RandomAccessRecordReader(object):
+  """Reads records of a TFRecord file by their position in the file.
+
+  The record offsets come from the index of the file (see record_index). If
+  it has none, they are found by scanning the length fields of the records
+  once. Local files are memory-mapped, so reading record i only touches the
+  pages it is on. Other files, e.g. on GCS, are kept open and each record is
+  read by seeking to its offset. Unlike tf_record_iterator, the CRCs are not
+  checked.
+
+  Usage:
+    with RandomAccessRecordReader(filename) as reader:
+      last_record = reader[len(reader) - 1]
+      sample = reader.read_batch(random.sample(range(len(reader)), 10))
+  """
+
+  def __init__(self, filename):
+    self._filename = filename
+    self._buf = None
+    self._file = None
+    try:
+      with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+          self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+          # Empty files cannot be mapped.
+          self._buf = b""
+    except (IOError, OSError):
+      # Not a local file, e.g. on GCS.
+      self._file = tf.gfile.GFile(filename, "rb")
+    offsets = record_index.read_offsets(filename)
+    if offsets is None:
+      tf.logging.info("No index for %s; scanning it", filename)
+      if self._file is None:
+        offsets = record_index.scan_offsets(self._buf)
+      else:
+        offsets = record_index.scan_file_offsets(self._file)
+    self._offsets = offsets
+
+  def __len__(self):
+    return len(self._offsets)
+
+  def _read(self, offset, length):
+    if self._file is None:
+      return self._buf[offset:offset + length]
+    self._file.seek(offset)
+    return self._file.read(length)
+
+  def __getitem__(self, i):
+    """Returns record i, as bytes."""
+    if i < 0:
+      i += len(self._offsets)
+    if not 0 <= i < len(self._offsets):
+      raise IndexError("Record index out of range: %d" % i)
+    offset = int(self._offsets[i])
+    length, = _RECORD_LENGTH.unpack(self._read(offset, _RECORD_LENGTH.size))
+    # The length is followed by its CRC.
+    return self._read(offset + _RECORD_LENGTH.size + 4, length)
+
+  def read_batch(self, indices):
+    """Returns the records with the given indices, as a list of bytes."""
+    return [self[i] for i in indices]
+
+  def close(self):
+    if isinstance(self._buf, mmap.mmap):
+      self._buf.close()
+    self._buf = None
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.close()
+
+
 def read_records(filename):
   reader = tf.python_io.tf_record_iterator(filename)
   records = []
@@ -432,7 +742,7 @@ def read_records(filename):
 
 
 def write_records(records, out_filename):
-  writer = tf.python_io.TFRecordWriter(out_filename)
+  writer = record_index.IndexedRecordWriter(out_filename)
   for count, record in enumerate(records):
     writer.write(record)
     if count > 0 and count % 100000 == 0:
@@ -451,47 +761,357 @@ def generate_dataset_and_shuffle(train_gen,
     shuffle_dataset(train_paths + dev_paths)
 
 
-def shuffle_dataset(filenames):
-  if outputs_exist(filenames):
-    tf.logging.info("Skipping shuffle because output files exist")
-    return
+def shuffle_dataset(filenames, max_memory_bytes=None, seed=None,
+                    across_shards=False):
+  """Shuffles the records of unshuffled TFRecord files.
+
+  The records of each file "<name>-unshuffled-*" are shuffled into a file
+  "<name>-*", and the unshuffled file is removed.
+
+  Files that fit in max_memory_bytes are shuffled in memory. Larger ones are
+  shuffled in two passes: the records are scattered into random buckets in
+  temporary files next to the output, and then each bucket is shuffled in
+  memory and appended to the output. This is a uniformly random permutation
+  too.
+
+  If an earlier shuffle was interrupted, the files it finished are skipped
+  and the others are shuffled again. Files without UNSHUFFLED_SUFFIX are
+  left alone.
+
+  Args:
+    filenames: a list of filenames, ending in UNSHUFFLED_SUFFIX and a shard
+      suffix.
+    max_memory_bytes: an optional integer; approximately how much memory to
+      use for records. If None, each file (or with across_shards, all files)
+      is shuffled in memory.
+    seed: an optional integer seed for the shuffle. If None, the global
+      random module is used.
+    across_shards: if True, shuffle the records of all the files together,
+      and write as many to each output file as its input file had.
+  """
   tf.logging.info("Shuffling data...")
-  for fname in filenames:
-    records = read_records(fname)
-    random.shuffle(records)
-    out_fname = fname.replace(UNSHUFFLED_SUFFIX, "")
-    write_records(records, out_fname)
-    tf.gfile.Remove(fname)
+  rng = random if seed is None else random.Random(seed)
+  if across_shards:
+    groups = [filenames]
+  else:
+    groups = [[fname] for fname in filenames]
+  for group in groups:
+    out_fnames = [fname.replace(UNSHUFFLED_SUFFIX, "") for fname in group]
+    if any(fname in out_fnames for fname in group):
+      # Shuffling would overwrite, and then remove, the input.
+      tf.logging.info("Skipping shuffle of %s: not an unshuffled file",
+                      out_fnames[0])
+      continue
+    if all(record_index.is_complete(fname) for fname in out_fnames):
+      # Shuffled already, but maybe interrupted before removing the inputs.
+      pass
+    elif all(tf.gfile.Exists(fname) for fname in group):
+      _shuffle_records(group, out_fnames, max_memory_bytes, rng)
+    else:
+      tf.logging.info("Skipping shuffle of %s: input files are missing",
+                      out_fnames[0])
+      continue
+    for fname in group:
+      if tf.gfile.Exists(fname):
+        record_index.remove(fname)
+
+
+def _shuffle_records(filenames, out_filenames, max_memory_bytes, rng):
+  """Writes a random permutation of the records of filenames to out_filenames.
+
+  Args:
+    filenames: a list of TFRecord files.
+    out_filenames: either a list of the same length, where the i-th output
+      file gets as many records as the i-th input file, or a single file.
+    max_memory_bytes: an optional integer; see shuffle_dataset.
+    rng: a random.Random or the random module.
+
+  Returns:
+    the number of records.
+  """
+  total_bytes = sum(tf.gfile.Stat(fname).length for fname in filenames)
+  if max_memory_bytes is None or total_bytes <= max_memory_bytes // 2:
+    records = []
+    counts = []
+    for fname in filenames:
+      file_records = read_records(fname)
+      counts.append(len(file_records))
+      records.extend(file_records)
+    rng.shuffle(records)
+    _write_records_to_files(iter(records), counts, out_filenames)
+    return sum(counts)
+
+  # Python objects roughly double the size of the records, so aim for
+  # buckets of half the budget.
+  num_buckets = (total_bytes * 2 + max_memory_bytes - 1) // max_memory_bytes
+  tf.logging.info("Shuffling %d bytes in %d buckets", total_bytes, num_buckets)
+  bucket_fnames = ["%s.bucket-%05d" % (out_filenames[0], i)
+                   for i in xrange(num_buckets)]
+  bucket_writers = [tf.python_io.TFRecordWriter(fname)
+                    for fname in bucket_fnames]
+  counts = []
+  try:
+    for fname in filenames:
+      count = 0
+      for record in tf.python_io.tf_record_iterator(fname):
+        bucket_writers[rng.randrange(num_buckets)].write(record)
+        count += 1
+      counts.append(count)
+    for writer in bucket_writers:
+      writer.close()
+    bucket_writers = []
+
+    def shuffled_buckets():
+      for bucket_fname in bucket_fnames:
+        records = read_records(bucket_fname)
+        rng.shuffle(records)
+        for record in records:
+          yield record
+        del records
+        tf.gfile.Remove(bucket_fname)
+
+    _write_records_to_files(shuffled_buckets(), counts, out_filenames)
+    return sum(counts)
+  finally:
+    for writer in bucket_writers:
+      writer.close()
+    for bucket_fname in bucket_fnames:
+      if tf.gfile.Exists(bucket_fname):
+        tf.gfile.Remove(bucket_fname)
+
+
+def _write_records_to_files(records, counts, out_filenames):
+  """Writes the next counts[i] records of an iterator to out_filenames[i].
+
+  If there is a single output file, all the records are written to it.
+  """
+  if len(out_filenames) == 1:
+    counts = [sum(counts)]
+  for count, out_fname in zip(counts, out_filenames):
+    write_records(itertools.islice(records, count), out_fname)
+
+
+def reshard_dataset(filenames, out_filenames, max_memory_bytes=None, seed=None,
+                    num_processes=None, tmp_dir=None):
+  """Writes the records of TFRecord files, globally shuffled, to new shards.
+
+  Each record is first copied to a random output shard, in temporary part
+  files; then the parts of each output shard are shuffled together. This is
+  a uniformly random permutation of all the records, split into
+  len(out_filenames) shards of approximately (but not exactly) equal size.
+  The passes stream the records; files are read and written by a pool of
+  processes, one input file, bucket or output shard per task.
+
+  A task keeps at most _MAX_OPEN_WRITERS files open for writing. With more
+  output shards than that, each input is scattered into buckets that cover
+  a contiguous range of output shards each, and the buckets are then split
+  into one part file per output shard, in an extra pass.
+
+  Args:
+    filenames: a list of TFRecord files.
+    out_filenames: a list of output files.
+    max_memory_bytes: an optional integer; approximately how much memory each
+      process uses for records. Output shards larger than that are shuffled
+      in two passes, as in shuffle_dataset. If None, output shards are
+      shuffled in memory.
+    seed: an optional integer seed. If given, the output is deterministic.
+    num_processes: an optional integer; the number of processes to use.
+    tmp_dir: where to write the part files. Defaults to the directory of the
+      first output file.
+
+  Returns:
+    a list with the number of records in each output file.
+  """
+  if tmp_dir is None:
+    tmp_dir = os.path.dirname(out_filenames[0])
+  part_prefix = os.path.join(
+      tmp_dir, os.path.basename(out_filenames[0]) + ".reshard")
+  num_outputs = len(out_filenames)
+  outputs_per_bucket = -(-num_outputs // _MAX_OPEN_WRITERS)
+  num_buckets = -(-num_outputs // outputs_per_bucket)
+  scatter_tasks = [(fname, i, num_outputs, outputs_per_bucket, part_prefix,
+                    seed)
+                   for i, fname in enumerate(filenames)]
+  bucket_fnames = [[_reshard_bucket_name(part_prefix, i, b)
+                    for i in xrange(len(filenames))]
+                   for b in xrange(num_buckets)]
+  if outputs_per_bucket == 1:
+    # Each bucket is the part of a single output shard already.
+    split_tasks = []
+    part_fnames = bucket_fnames
+  else:
+    split_tasks = [(bucket_fnames[b], b, b * outputs_per_bucket,
+                    min(num_outputs, (b + 1) * outputs_per_bucket),
+                    part_prefix, seed)
+                   for b in xrange(num_buckets)]
+    part_fnames = [[_reshard_part_name(part_prefix, j)]
+                   for j in xrange(num_outputs)]
+  shuffle_tasks = [(part_fnames[j], out_fname, j, max_memory_bytes, seed)
+                   for j, out_fname in enumerate(out_filenames)]
+  if num_processes and num_processes > 1:
+    pool = multiprocessing.Pool(processes=num_processes)
+    map_fn = pool.map
+  else:
+    pool = None
+    map_fn = map
+  try:
+    for fname, num_records in zip(filenames,
+                                  map_fn(_scatter_to_buckets, scatter_tasks)):
+      tf.logging.info("Read %d records from %s", num_records, fname)
+    list(map_fn(_split_bucket, split_tasks))
+    counts = list(map_fn(_shuffle_parts, shuffle_tasks))
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+    for part_fname in tf.gfile.Glob(part_prefix + "-*"):
+      tf.gfile.Remove(part_fname)
+  return counts
+
+
+def _reshard_bucket_name(part_prefix, input_index, bucket_index):
+  return "%s-%05d-%05d" % (part_prefix, input_index, bucket_index)
+
+
+def _reshard_part_name(part_prefix, output_index):
+  return "%s-part-%05d" % (part_prefix, output_index)
+
+
+def _reshard_rng(seed, stage, index):
+  if seed is None:
+    return random.Random()
+  return random.Random("%d-%s-%d" % (seed, stage, index))
+
+
+def _scatter_to_buckets(args):
+  """Copies each record of a file to the bucket of a random output shard."""
+  (fname, input_index, num_outputs, outputs_per_bucket, part_prefix,
+   seed) = args
+  rng = _reshard_rng(seed, "scatter", input_index)
+  num_buckets = -(-num_outputs // outputs_per_bucket)
+  writers = [tf.python_io.TFRecordWriter(
+      _reshard_bucket_name(part_prefix, input_index, b))
+             for b in xrange(num_buckets)]
+  num_records = 0
+  try:
+    for record in tf.python_io.tf_record_iterator(fname):
+      writers[rng.randrange(num_outputs) // outputs_per_bucket].write(record)
+      num_records += 1
+  finally:
+    for writer in writers:
+      writer.close()
+  return num_records
+
+
+def _split_bucket(args):
+  """Copies each record of a bucket to the part of a random shard in it.
+
+  A record is in a bucket with probability proportional to the number of
+  shards it covers, so picking one of those uniformly gives every record
+  the same chance to go to each output shard.
+  """
+  bucket_fnames, bucket_index, begin, end, part_prefix, seed = args
+  rng = _reshard_rng(seed, "split", bucket_index)
+  writers = [tf.python_io.TFRecordWriter(_reshard_part_name(part_prefix, j))
+             for j in xrange(begin, end)]
+  try:
+    for bucket_fname in bucket_fnames:
+      for record in tf.python_io.tf_record_iterator(bucket_fname):
+        writers[rng.randrange(end - begin)].write(record)
+      tf.gfile.Remove(bucket_fname)
+  finally:
+    for writer in writers:
+      writer.close()
+
+
+def _shuffle_parts(args):
+  """Shuffles the part files of an output shard into it."""
+  part_fnames, out_fname, output_index, max_memory_bytes, seed = args
+  rng = _reshard_rng(seed, "shuffle", output_index)
+  num_records = _shuffle_records(part_fnames, [out_fname], max_memory_bytes,
+                                 rng)
+  for part_fname in part_fnames:
+    tf.gfile.Remove(part_fname)
+  tf.logging.info("Wrote %d records to %s", num_records, out_fname)
+  return num_records
+
+
+# list(xrange(n)) for the largest n seen so far.
+_positions = []
+
+
+def _position_ids(n):
+  """Returns list(xrange(n)), sliced from a cached list."""
+  global _positions
+  positions = _positions
+  if n > len(positions):
+    positions = _positions = list(xrange(2 * n))
+  return positions[:n]
 
 
 class SequencePacker(object):
   """Helper for constructing a packed example of sequence examples.
 
+  The ids, segmentation and positions are written into lists of
+  packed_length, allocated up front, rather than built by concatenation.
+
   See comments to pack_examples()
   """
 
-  def __init__(self, first_sequence, spacing=2):
+  __slots__ = ("_spacing", "_ids", "_segmentation", "_position", "_length",
+               "_num_tokens")
+
+  def __init__(self, first_sequence, spacing=2, packed_length=None):
     self._spacing = spacing
-    self._ids = first_sequence[:]
-    self._segmentation = [1] * len(first_sequence)
-    self._position = range(len(first_sequence))
+    size = max(packed_length or 0, len(first_sequence))
+    self._ids = [0] * size
+    self._segmentation = [0] * size
+    self._position = [0] * size
+    self._length = 0
+    self._num_tokens = 0
+    self._write(0, first_sequence, 1)
+
+  def _write(self, start, ids, segment_num):
+    end = start + len(ids)
+    if end > len(self._ids):
+      # Only sequences longer than packed_length get here.
+      padding = [0] * (end - len(self._ids))
+      self._ids.extend(padding)
+      self._segmentation.extend(padding)
+      self._position.extend(padding)
+    self._ids[start:end] = ids
+    self._segmentation[start:end] = [segment_num] * len(ids)
+    self._position[start:end] = _position_ids(len(ids))
+    self._length = end
+    self._num_tokens += len(ids)
 
   def add(self, ids):
-    padding = [0] * self._spacing
-    self._ids.extend(padding + ids)
-    next_segment_num = self._segmentation[-1] + 1 if self._segmentation else 1
-    self._segmentation.extend(padding + [next_segment_num] * len(ids))
-    self._position.extend(padding + range(len(ids)))
+    # The spacing is left as zeros.
+    next_segment_num = (self._segmentation[self._length - 1] + 1
+                        if self._length else 1)
+    self._write(self._length + self._spacing, ids, next_segment_num)
 
   def can_fit(self, ids, packed_length):
-    return len(self._ids) + self._spacing + len(ids) <= packed_length
+    return self._length + self._spacing + len(ids) <= packed_length
 
   def to_dict(self):
+    # Drop the unused end of the lists in place, instead of copying.
+    for values in (self._ids, self._segmentation, self._position):
+      del values[self._length:]
     return {"inputs": [0],
             "targets": self._ids,
             "targets_segmentation": self._segmentation,
             "targets_position": self._position}
 
+  def remaining(self, packed_length):
+    """Room left for spacing and another sequence."""
+    return packed_length - self._length
+
+  @property
+  def num_tokens(self):
+    """Number of non-padding ids."""
+    return self._num_tokens
+
 
 class SequencePairPacker(object):
   """Helper for packing sequence-to-sequence examples into bigger examples.
@@ -499,9 +1119,13 @@ class SequencePairPacker(object):
   See comments to pack_examples()
   """
 
-  def __init__(self, first_sequence_pair, spacing=2):
-    self._inputs = SequencePacker(first_sequence_pair[0], spacing)
-    self._targets = SequencePacker(first_sequence_pair[1], spacing)
+  __slots__ = ("_inputs", "_targets")
+
+  def __init__(self, first_sequence_pair, spacing=2, packed_length=None):
+    self._inputs = SequencePacker(first_sequence_pair[0], spacing,
+                                  packed_length)
+    self._targets = SequencePacker(first_sequence_pair[1], spacing,
+                                   packed_length)
 
   def add(self, pair):
     self._inputs.add(pair[0])
@@ -511,6 +1135,14 @@ class SequencePairPacker(object):
     return (self._inputs.can_fit(pair[0], packed_length) and
             self._targets.can_fit(pair[1], packed_length))
 
+  def remaining(self, packed_length):
+    """Room left in the targets; see SequencePacker.remaining()."""
+    return self._targets.remaining(packed_length)
+
+  @property
+  def num_tokens(self):
+    return self._inputs.num_tokens + self._targets.num_tokens
+
   def to_dict(self):
     ret = self._targets.to_dict()
     inputs_dict = self._inputs.to_dict()
@@ -520,12 +1152,53 @@ class SequencePairPacker(object):
     return ret
 
 
+class PackingStats(object):
+  """Counts of what pack_examples() did, to measure its efficiency."""
+
+  def __init__(self):
+    self.num_examples = 0
+    self.num_packed_examples = 0
+    self.num_tokens = 0
+    self.num_positions = 0
+
+  def add(self, packer, num_examples, num_sequences, packed_length):
+    """Records a packed example.
+
+    Args:
+      packer: a SequencePacker or SequencePairPacker.
+      num_examples: the number of examples it holds.
+      num_sequences: 1 for targets only, 2 for inputs and targets.
+      packed_length: an integer
+    """
+    self.num_examples += num_examples
+    self.num_packed_examples += 1
+    self.num_tokens += packer.num_tokens
+    self.num_positions += num_sequences * packed_length
+
+  @property
+  def efficiency(self):
+    """Fraction of the positions of the packed examples that are not padding.
+
+    Packed examples are padded to packed_length when they are batched, so
+    this counts that padding as well as the spacing between sequences.
+    """
+    if not self.num_positions:
+      return 0.0
+    return self.num_tokens / self.num_positions
+
+  def __str__(self):
+    return ("%d examples packed into %d, non-padding fraction %.4f" %
+            (self.num_examples, self.num_packed_examples, self.efficiency))
+
+
 def pack_examples(examples,
                   has_inputs,
                   packed_length=256,
                   spacing=2,
-                  queue_size=10,
-                  chop_long_sequences=False):
+                  queue_size=None,
+                  chop_long_sequences=False,
+                  best_fit=False,
+                  stats=None):
   """Pack examples into longer examples.
 
   If has_inputs=False, we are packing single-sequence examples with
@@ -556,39 +1229,265 @@ def pack_examples(examples,
        the original sequence.  This is useful for positional encodings.
        e.g. [0 1 2 3 4 5 0 0 0 1 2 0 0 0 1 2 3 4 0 0 0 1 2]
 
+  By default, each example goes into the first of the last queue_size packed
+  examples that it fits in (first fit). With best_fit, the examples are read
+  queue_size at a time and added longest first, each to the open packed
+  example with the least room that it fits in (best fit decreasing). Up to
+  queue_size packed examples are kept open, in a list sorted by the room
+  they have left. The best fit is found by bisection, and each insertion or
+  removal shifts the list, which is O(queue_size) but cheap, so queue_size
+  can be much larger than for first fit. When there are too many, the
+  fullest one is emitted. This packs more densely but changes the order of
+  the examples. Both modes pack examples with empty targets (or the empty
+  rest of a chopped sequence) as empty segments.
+
   Args:
     examples: a generator returning feature dictionaries.
     has_inputs: a boolean
     packed_length: an integer
     spacing: an integer
-    queue_size: an integer
+    queue_size: an optional integer; defaults to 10 for first fit and 1000 for
+      best fit.
     chop_long_sequences: a boolean
+    best_fit: a boolean
+    stats: an optional PackingStats to update. If None, the stats are logged
+      at the end instead.
 
   Yields:
     feature dictionaries.
   """
+  if queue_size is None:
+    queue_size = 1000 if best_fit else 10
+  log_stats = stats is None
+  if log_stats:
+    stats = PackingStats()
   packer = SequencePairPacker if has_inputs else SequencePacker
+  num_sequences = 2 if has_inputs else 1
+
+  def sequences():
+    """Yields (sequence, whether it is a full chopped fragment) pairs."""
+    for example in examples:
+      x = ((example["inputs"], example["targets"])
+           if has_inputs else example["targets"])
+      if chop_long_sequences and len(x) > packed_length:
+        assert not has_inputs
+        num_fragments = len(x) // packed_length
+        for i in xrange(num_fragments):
+          yield x[packed_length * i:packed_length * (i + 1)], True
+        x = x[packed_length * num_fragments:]
+      yield x, False
+
+  if best_fit:
+    packed = _pack_best_fit(sequences(), packer, packed_length, spacing,
+                            queue_size)
+  else:
+    packed = _pack_first_fit(sequences(), packer, packed_length, spacing,
+                             queue_size)
+  for p, num_examples in packed:
+    stats.add(p, num_examples, num_sequences, packed_length)
+    yield p.to_dict()
+  if log_stats:
+    tf.logging.info("Packing: %s", stats)
+
+
+def _pack_first_fit(sequences, packer, packed_length, spacing, queue_size):
+  """Yields (packer, number of sequences) pairs; see pack_examples()."""
+  # Each entry of `combined` is [packer, number of sequences, room left in
+  # the targets, room left in the inputs], so that finding the first packer
+  # with room does not call can_fit() on every one.
   combined = []
-  for example in examples:
-    x = ((example["inputs"], example["targets"])
-         if has_inputs else example["targets"])
-    if chop_long_sequences and len(x) > packed_length:
-      assert not has_inputs
-      num_fragments = len(x) // packed_length
-      for i in xrange(num_fragments):
-        yield packer(
-            x[packed_length * i:packed_length * (i + 1)], spacing).to_dict()
-      x = x[packed_length * num_fragments:]
+  for x, is_fragment in sequences:
+    if is_fragment:
+      yield packer(x, spacing, packed_length), 1
+      continue
+    if isinstance(x, tuple):
+      inputs_need = len(x[0]) + spacing
+      targets_need = len(x[1]) + spacing
+    else:
+      inputs_need = 0
+      targets_need = len(x) + spacing
     added = False
     for c in combined:
-      if c.can_fit(x, packed_length):
-        c.add(x)
+      if c[2] >= targets_need and c[3] >= inputs_need:
+        c[0].add(x)
+        c[1] += 1
+        c[2] -= targets_need
+        c[3] -= inputs_need
         added = True
         break
     if not added:
       if len(combined) == queue_size:
-        yield combined[0].to_dict()
-        combined = combined[1:]
-      combined.append(packer(x, spacing))
+        yield combined[0][0], combined[0][1]
+        del combined[0]
+      combined.append([packer(x, spacing, packed_length), 1,
+                       packed_length + spacing - targets_need,
+                       packed_length + spacing - inputs_need])
   for c in combined:
-    yield c.to_dict()
+    yield c[0], c[1]
+
+
+def _pack_best_fit(sequences, packer, packed_length, spacing, queue_size):
+  """Yields (packer, number of sequences) pairs; see pack_examples()."""
+  # The open packers are kept in `bins`, keyed by a serial number, and in
+  # `by_room`, a list of (room left, serial number) sorted by room, so the
+  # best fitting packer is found by bisection. Inserting into and removing
+  # from the list still shift its entries, which is O(queue_size) per
+  # example, but only moves pointers.
+  bins = {}
+  by_room = []
+  serial = itertools.count()
+
+  def length(x):
+    return max(len(x[0]), len(x[1])) if isinstance(x, tuple) else len(x)
+
+  def target_length(x):
+    return len(x[1]) if isinstance(x, tuple) else len(x)
+
+  def add(x):
+    """Adds x to the best packer, or a new one. Returns a full packer."""
+    i = bisect.bisect_left(by_room, (target_length(x) + spacing, -1))
+    # For pairs, the packers are sorted by the room left for targets, so
+    # the first one that fits the inputs too is the best fit.
+    while i < len(by_room) and not bins[by_room[i][1]][0].can_fit(
+        x, packed_length):
+      i += 1
+    if i < len(by_room):
+      _, key = by_room.pop(i)
+      p = bins[key]
+      p[0].add(x)
+      p[1] += 1
+    else:
+      key = next(serial)
+      p = bins[key] = [packer(x, spacing, packed_length), 1]
+    room = p[0].remaining(packed_length)
+    if room <= spacing:
+      # Nothing else fits.
+      del bins[key]
+      return p
+    bisect.insort(by_room, (room, key))
+    if len(by_room) > queue_size:
+      # Emit the fullest packer.
+      _, key = by_room.pop(0)
+      return bins.pop(key)
+    return None
+
+  window = []
+  for x, is_fragment in sequences:
+    if is_fragment:
+      yield packer(x, spacing, packed_length), 1
+      continue
+    window.append(x)
+    if len(window) < queue_size:
+      continue
+    window.sort(key=length, reverse=True)
+    for y in window:
+      full = add(y)
+      if full is not None:
+        yield tuple(full)
+    window = []
+  window.sort(key=length, reverse=True)
+  for y in window:
+    full = add(y)
+    if full is not None:
+      yield tuple(full)
+  for _, key in by_room:
+    yield tuple(bins[key])
+
+
+def pack_dataset(dataset,
+                 has_inputs,
+                 packed_length=256,
+                 spacing=2,
+                 window_size=1000,
+                 best_fit=False):
+  """Packs the examples of a Dataset into examples of packed_length.
+
+  This does what pack_examples() does at datagen time, as a step of the
+  input pipeline, so that the packed length can be changed without
+  regenerating the data. The examples are read window_size at a time and
+  packed by pack_examples() in a tf.py_func; packed examples are not
+  carried over from one window to the next.
+
+  As in pack_examples(), sequences of targets longer than packed_length
+  are chopped when has_inputs=False. With inputs, examples that do not
+  fit are dropped.
+
+  Args:
+    dataset: a Dataset of dicts with integer "targets" and, if has_inputs,
+      "inputs" features. Other features are dropped.
+    has_inputs: a boolean
+    packed_length: an integer
+    spacing: an integer
+    window_size: an integer; the number of examples packed together.
+    best_fit: a boolean; see pack_examples(). The window is then also the
+      queue size.
+
+  Returns:
+    a Dataset of dicts with "targets", "targets_segmentation" and
+    "targets_position" features, and their "inputs_*" counterparts if
+    has_inputs, all of shape [packed_length] and padded with zeros.
+
+  Raises:
+    ValueError: if the examples are already packed.
+  """
+  if "targets_segmentation" in dataset.output_types:
+    raise ValueError("The examples are already packed.")
+  keys = ["inputs", "targets"] if has_inputs else ["targets"]
+  packed_keys = [key + suffix for key in keys
+                 for suffix in ["", "_segmentation", "_position"]]
+  dtype = dataset.output_types["targets"]
+
+  def _flatten(example):
+    features = {}
+    for key in keys:
+      features[key] = tf.reshape(example[key], [-1])
+      features[key + "_length"] = tf.shape(features[key])[0]
+    return features
+
+  def _fits(example):
+    return tf.logical_and(example["inputs_length"] <= packed_length,
+                          example["targets_length"] <= packed_length)
+
+  def _pack_window(*arrays):
+    """Packs a window of padded sequences, given their lengths."""
+    ids = dict(zip(keys, arrays[:len(keys)]))
+    lengths = dict(zip(keys, arrays[len(keys):]))
+
+    def examples():
+      for i in xrange(len(lengths["targets"])):
+        yield {key: ids[key][i, :lengths[key][i]].tolist() for key in keys}
+
+    packed = list(pack_examples(
+        examples(), has_inputs, packed_length, spacing=spacing,
+        queue_size=window_size if best_fit else None,
+        chop_long_sequences=not has_inputs, best_fit=best_fit,
+        stats=PackingStats()))
+    outputs = []
+    for key in packed_keys:
+      output = np.zeros([len(packed), packed_length],
+                        dtype=ids["targets"].dtype)
+      for i, example in enumerate(packed):
+        output[i, :len(example[key])] = example[key]
+      outputs.append(output)
+    return outputs
+
+  def _pack(window):
+    packed = tf.py_func(
+        _pack_window,
+        [window[key] for key in keys] +
+        [window[key + "_length"] for key in keys],
+        [dtype] * len(packed_keys),
+        stateful=False)
+    for t in packed:
+      t.set_shape([None, packed_length])
+    return tf.data.Dataset.from_tensor_slices(dict(zip(packed_keys, packed)))
+
+  dataset = dataset.map(_flatten)
+  if has_inputs:
+    dataset = dataset.filter(_fits)
+  padded_shapes = {}
+  for key in keys:
+    padded_shapes[key] = [None]
+    padded_shapes[key + "_length"] = []
+  dataset = dataset.padded_batch(window_size, padded_shapes)
+  return dataset.flat_map(_pack)
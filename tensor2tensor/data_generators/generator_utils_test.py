@@ -21,14 +21,19 @@ from __future__ import print_function
 
 import gzip
 import io
+import itertools
 import os
+import random
 import tempfile
+import time
 
 # Dependency imports
 
 from builtins import bytes  # pylint: disable=redefined-builtin
+import mock
 
 from tensor2tensor.data_generators import generator_utils
+from tensor2tensor.data_generators import record_index
 
 import tensorflow as tf
 
@@ -52,6 +57,446 @@ class GeneratorUtilsTest(tf.test.TestCase):
     os.remove(tmp_file_path + "-train-00000-of-00001")
     os.remove(tmp_file_path)
 
+  def testGenerateFilesInPool(self):
+    def test_generator():
+      for i in range(1000):
+        if i % 7 == 0:
+          yield None
+        yield {"inputs": [i, i + 1], "targets": [float(i)], "id": [str(i)]}
+
+    def read_files(filenames):
+      contents = []
+      for filename in filenames:
+        with open(filename, "rb") as f:
+          contents.append(f.read())
+      return contents
+
+    tmp_dir = self.get_temp_dir()
+    for max_cases in [None, 500]:
+      filenames = generator_utils.train_data_filenames(
+          "serial%s" % max_cases, tmp_dir, 3)
+      generator_utils.generate_files(test_generator(), filenames, max_cases)
+      pool_filenames = generator_utils.train_data_filenames(
+          "pool%s" % max_cases, tmp_dir, 3)
+      generator_utils.generate_files(test_generator(), pool_filenames,
+                                     max_cases, num_processes=2)
+      self.assertEqual(read_files(filenames), read_files(pool_filenames))
+
+  def testGenerateFilesResumes(self):
+    def test_generator():
+      for i in range(100):
+        yield {"inputs": [i], "targets": [i + 1]}
+
+    def read_files(filenames):
+      contents = []
+      for filename in filenames:
+        with open(filename, "rb") as f:
+          contents.append(f.read())
+      return contents
+
+    tmp_dir = self.get_temp_dir()
+    filenames = generator_utils.train_data_filenames(
+        "full" + generator_utils.UNSHUFFLED_SUFFIX, tmp_dir, 3)
+    generator_utils.generate_files(test_generator(), filenames)
+    expected = read_files(filenames)
+    records = [generator_utils.read_records(f) for f in filenames]
+
+    for num_processes in [None, 2]:
+      resumed = generator_utils.train_data_filenames(
+          "resumed%s%s" % (num_processes, generator_utils.UNSHUFFLED_SUFFIX),
+          tmp_dir, 3)
+      # An interrupted run: the files hold different numbers of cases, and
+      # one ends in a torn record.
+      for shard, num_records in enumerate([20, 11, 15]):
+        writer = tf.python_io.TFRecordWriter(resumed[shard])
+        for record in records[shard][:num_records]:
+          writer.write(record)
+        writer.close()
+      with open(resumed[0], "ab") as f:
+        f.write(expected[0][len(expected[0]) // 2:][:10])
+      # Cases up to 33 are in all the files, and are not generated again.
+      generated = []
+
+      def resumed_generator():
+        for case in test_generator():
+          generated.append(case["inputs"][0])
+          yield case
+
+      generator_utils.generate_files(resumed_generator(), resumed,
+                                     num_processes=num_processes)
+      self.assertEqual(expected, read_files(resumed))
+      for filename in resumed:
+        self.assertTrue(record_index.is_complete(filename))
+        self.assertFalse(tf.gfile.Exists(filename + ".partial"))
+      self.assertEqual(list(range(100)), generated)
+
+  def testGenerateFilesResumesPartialResume(self):
+    tmp_dir = self.get_temp_dir()
+    filenames = generator_utils.train_data_filenames(
+        "twice" + generator_utils.UNSHUFFLED_SUFFIX, tmp_dir, 2)
+    cases = [{"targets": [i + 1]} for i in range(10)]
+    records = [generator_utils.to_example(case).SerializeToString()
+               for case in cases]
+    # A resume that was interrupted while copying file 0 from its partial
+    # file, which has more records.
+    for filename, shard_records in [(filenames[0] + ".partial", records[0:8:2]),
+                                    (filenames[0], records[0:4:2]),
+                                    (filenames[1], records[1:6:2])]:
+      writer = tf.python_io.TFRecordWriter(filename)
+      for record in shard_records:
+        writer.write(record)
+      writer.close()
+    generator_utils.generate_files(iter(cases), filenames)
+    self.assertEqual(records[0::2], generator_utils.read_records(filenames[0]))
+    self.assertEqual(records[1::2], generator_utils.read_records(filenames[1]))
+    self.assertFalse(tf.gfile.Exists(filenames[0] + ".partial"))
+
+  def testGenerateFilesAbortsOnError(self):
+    def failing_generator():
+      for i in range(10):
+        yield {"targets": [i + 1]}
+      raise ValueError("Generator failed")
+
+    for num_processes in [None, 2]:
+      filenames = generator_utils.train_data_filenames(
+          "failed%s%s" % (num_processes, generator_utils.UNSHUFFLED_SUFFIX),
+          self.get_temp_dir(), 2)
+      with self.assertRaises(ValueError):
+        generator_utils.generate_files(failing_generator(), filenames,
+                                       num_processes=num_processes)
+      for filename in filenames:
+        self.assertFalse(record_index.is_complete(filename))
+
+  def _write_unshuffled(self, name, num_shards, num_records):
+    filenames = generator_utils.train_data_filenames(
+        name + generator_utils.UNSHUFFLED_SUFFIX, self.get_temp_dir(),
+        num_shards)
+    for shard, filename in enumerate(filenames):
+      generator_utils.write_records(
+          [b"%d-%05d" % (shard, i) for i in range(num_records)], filename)
+    return filenames
+
+  def testShuffleDataset(self):
+    for max_memory_bytes in [None, 2000]:
+      for across_shards in [False, True]:
+        outputs = []
+        for _ in range(2):
+          name = "shuffle%s%s%d" % (max_memory_bytes, across_shards,
+                                    len(outputs))
+          filenames = self._write_unshuffled(name, 3, 500)
+          generator_utils.shuffle_dataset(
+              filenames, max_memory_bytes=max_memory_bytes, seed=123,
+              across_shards=across_shards)
+          shards = [generator_utils.read_records(
+              f.replace(generator_utils.UNSHUFFLED_SUFFIX, ""))
+                    for f in filenames]
+          for filename in filenames:
+            self.assertFalse(tf.gfile.Exists(filename))
+          self.assertEqual([500] * 3, [len(shard) for shard in shards])
+          all_records = sorted(sum(shards, []))
+          self.assertEqual(
+              sorted(b"%d-%05d" % (shard, i)
+                     for shard in range(3) for i in range(500)),
+              all_records)
+          if not across_shards:
+            for i, shard in enumerate(shards):
+              self.assertTrue(all(r.startswith(b"%d-" % i) for r in shard))
+          else:
+            self.assertFalse(all(r.startswith(b"0-") for r in shards[0]))
+          self.assertNotEqual(sorted(shards[0]), shards[0])
+          outputs.append(shards)
+        # Deterministic given the seed.
+        self.assertEqual(outputs[0], outputs[1])
+    # No bucket files are left behind.
+    self.assertFalse(tf.gfile.Glob(os.path.join(self.get_temp_dir(),
+                                                "*.bucket-*")))
+
+  def testShuffleDatasetResumes(self):
+    filenames = self._write_unshuffled("interrupted", 3, 100)
+    out_filenames = [f.replace(generator_utils.UNSHUFFLED_SUFFIX, "")
+                     for f in filenames]
+    # Shard 0 was shuffled and its input removed, shard 1 was shuffled but its
+    # input not removed yet, and shard 2 was being shuffled.
+    generator_utils.shuffle_dataset(filenames[:2])
+    generator_utils.write_records([b"1-%05d" % i for i in range(100)],
+                                  filenames[1])
+    shard1 = generator_utils.read_records(out_filenames[1])
+    with open(out_filenames[2], "wb") as f:
+      f.write(b"partial")
+
+    generator_utils.shuffle_dataset(filenames)
+    self.assertEqual(shard1, generator_utils.read_records(out_filenames[1]))
+    self.assertEqual(
+        sorted(b"2-%05d" % i for i in range(100)),
+        sorted(generator_utils.read_records(out_filenames[2])))
+    for filename, out_filename in zip(filenames, out_filenames):
+      self.assertFalse(tf.gfile.Exists(filename))
+      self.assertTrue(record_index.is_complete(out_filename))
+
+  def testShuffleDatasetKeepsShuffledFiles(self):
+    filename = os.path.join(self.get_temp_dir(), "data-train-00000-of-00001")
+    records = [b"%05d" % i for i in range(100)]
+    generator_utils.write_records(records, filename)
+    generator_utils.shuffle_dataset([filename])
+    self.assertEqual(records, generator_utils.read_records(filename))
+
+  def testReshardDataset(self):
+    filenames = self._write_unshuffled("reshard", 3, 200)
+    expected = sorted(b"%d-%05d" % (shard, i)
+                      for shard in range(3) for i in range(200))
+    outputs = []
+    for run, (max_memory_bytes, num_processes) in enumerate(
+        [(None, None), (1000, None), (None, 2)]):
+      out_dir = os.path.join(self.get_temp_dir(), "resharded%d" % run)
+      os.mkdir(out_dir)
+      out_filenames = generator_utils.train_data_filenames(
+          "reshard", out_dir, 5)
+      counts = generator_utils.reshard_dataset(
+          filenames, out_filenames, max_memory_bytes=max_memory_bytes,
+          seed=42, num_processes=num_processes)
+      shards = [generator_utils.read_records(f) for f in out_filenames]
+      self.assertEqual(counts, [len(shard) for shard in shards])
+      self.assertEqual(expected, sorted(sum(shards, [])))
+      # Records from every input end up in every output.
+      for shard in shards:
+        self.assertEqual(set([b"0", b"1", b"2"]),
+                         set(r.split(b"-")[0] for r in shard))
+      # Only the outputs and their indexes are left.
+      self.assertEqual(
+          sorted([os.path.basename(f) for f in out_filenames] +
+                 [os.path.basename(record_index.index_filename(f))
+                  for f in out_filenames]),
+          sorted(os.listdir(out_dir)))
+      outputs.append(shards)
+    # Deterministic given the seed, with or without a pool.
+    self.assertEqual(outputs[0], outputs[2])
+
+  def testReshardDatasetLimitsOpenWriters(self):
+    filenames = self._write_unshuffled("buckets", 3, 200)
+    out_filenames = generator_utils.train_data_filenames(
+        "buckets", self.get_temp_dir(), 7)
+    open_writers = set()
+    max_open_writers = [0]
+    record_writer = tf.python_io.TFRecordWriter
+
+    class CountingWriter(record_writer):
+
+      def __init__(self, fname):
+        super(CountingWriter, self).__init__(fname)
+        open_writers.add(self)
+        max_open_writers[0] = max(max_open_writers[0], len(open_writers))
+
+      def close(self):
+        open_writers.discard(self)
+        super(CountingWriter, self).close()
+
+    with mock.patch.object(generator_utils, "_MAX_OPEN_WRITERS", 3):
+      with mock.patch.object(tf.python_io, "TFRecordWriter", CountingWriter):
+        counts = generator_utils.reshard_dataset(filenames, out_filenames,
+                                                 seed=1)
+    self.assertEqual(3, max_open_writers[0])
+    shards = [generator_utils.read_records(f) for f in out_filenames]
+    self.assertEqual(counts, [len(shard) for shard in shards])
+    self.assertEqual(
+        sorted(b"%d-%05d" % (shard, i) for shard in range(3)
+               for i in range(200)),
+        sorted(sum(shards, [])))
+    # Every bucket was split; a bucket with no records at all is unlikely.
+    self.assertTrue(all(shards))
+    self.assertFalse(tf.gfile.Glob(
+        os.path.join(self.get_temp_dir(), "*.reshard-*")))
+
+  def testRandomAccessRecordReader(self):
+    records = [b"record %d" % i + b"x" * (i % 7) for i in range(100)]
+    indexed = os.path.join(self.get_temp_dir(), "indexed")
+    generator_utils.write_records(records, indexed)
+    unindexed = os.path.join(self.get_temp_dir(), "unindexed")
+    writer = tf.python_io.TFRecordWriter(unindexed)
+    for record in records:
+      writer.write(record)
+    writer.close()
+
+    for filename in [indexed, unindexed]:
+      with generator_utils.RandomAccessRecordReader(filename) as reader:
+        self.assertEqual(len(records), len(reader))
+        self.assertEqual(records[37], reader[37])
+        self.assertEqual(records[-1], reader[-1])
+        self.assertEqual([records[i] for i in [5, 99, 0, 5]],
+                         reader.read_batch([5, 99, 0, 5]))
+        with self.assertRaises(IndexError):
+          _ = reader[100]
+
+  def testRandomAccessRecordReaderSeeksInNonLocalFiles(self):
+    records = [b"record %d" % i + b"x" * (i % 7) for i in range(100)]
+    filename = os.path.join(self.get_temp_dir(), "remote")
+    generator_utils.write_records(records, filename)
+
+    def fail_to_open(*unused_args):
+      raise IOError("Not a local file")
+
+    for with_index in [True, False]:
+      if not with_index:
+        tf.gfile.Remove(record_index.index_filename(filename))
+      with mock.patch.object(generator_utils, "open", fail_to_open,
+                             create=True):
+        with generator_utils.RandomAccessRecordReader(filename) as reader:
+          self.assertIsNone(reader._buf)
+          self.assertEqual(len(records), len(reader))
+          self.assertEqual(records[-1], reader[-1])
+          self.assertEqual([records[i] for i in [5, 99, 0, 5]],
+                           reader.read_batch([5, 99, 0, 5]))
+        self.assertIsNone(reader._file)
+
+  def testPackExamples(self):
+    examples = [{"targets": [1, 2, 3]}, {"targets": [4, 5]},
+                {"targets": [6, 7, 8, 9]}, {"targets": [10]}]
+    packed = list(generator_utils.pack_examples(
+        iter(examples), False, packed_length=8, spacing=1, queue_size=2))
+    self.assertEqual(
+        [{"inputs": [0],
+          "targets": [1, 2, 3, 0, 4, 5, 0, 10],
+          "targets_segmentation": [1, 1, 1, 0, 2, 2, 0, 3],
+          "targets_position": [0, 1, 2, 0, 0, 1, 0, 0]},
+         {"inputs": [0],
+          "targets": [6, 7, 8, 9],
+          "targets_segmentation": [1, 1, 1, 1],
+          "targets_position": [0, 1, 2, 3]}],
+        packed)
+
+  def testPackExamplesPairs(self):
+    examples = [{"inputs": [1, 2], "targets": [3]},
+                {"inputs": [4], "targets": [5, 6, 7, 8, 9, 10]},
+                {"inputs": [11], "targets": [12, 13]}]
+    packed = list(generator_utils.pack_examples(
+        iter(examples), True, packed_length=5, spacing=1))
+    self.assertEqual(
+        [{"inputs": [1, 2, 0, 11],
+          "inputs_segmentation": [1, 1, 0, 2],
+          "inputs_position": [0, 1, 0, 0],
+          "targets": [3, 0, 12, 13],
+          "targets_segmentation": [1, 0, 2, 2],
+          "targets_position": [0, 0, 0, 1]},
+         # Longer than packed_length, but not chopped.
+         {"inputs": [4],
+          "inputs_segmentation": [1],
+          "inputs_position": [0],
+          "targets": [5, 6, 7, 8, 9, 10],
+          "targets_segmentation": [1, 1, 1, 1, 1, 1],
+          "targets_position": [0, 1, 2, 3, 4, 5]}],
+        packed)
+
+  def _unpack(self, packed, feature):
+    """Recovers the sequences of `feature` from packed examples."""
+    sequences = []
+    for example in packed:
+      ids = example[feature]
+      segmentation = example.get(feature + "_segmentation", [1] * len(ids))
+      for i, (token, segment) in enumerate(zip(ids, segmentation)):
+        if not segment:
+          continue
+        if not i or segment != segmentation[i - 1]:
+          sequences.append([])
+        sequences[-1].append(token)
+    return sequences
+
+  def testPackExamplesBestFit(self):
+    rng = random.Random(1)
+    examples = [{"inputs": [rng.randint(1, 9)
+                            for _ in range(rng.randint(1, 20))],
+                 "targets": [rng.randint(1, 9)
+                             for _ in range(rng.randint(1, 30))]}
+                for _ in range(500)]
+    for has_inputs in [False, True]:
+      features = ["inputs", "targets"] if has_inputs else ["targets"]
+      first_fit_stats = generator_utils.PackingStats()
+      list(generator_utils.pack_examples(
+          iter(examples), has_inputs, packed_length=32, queue_size=50,
+          stats=first_fit_stats))
+      best_fit_stats = generator_utils.PackingStats()
+      packed = list(generator_utils.pack_examples(
+          iter(examples), has_inputs, packed_length=32, queue_size=50,
+          best_fit=True, stats=best_fit_stats))
+
+      for example in packed:
+        for feature in features:
+          self.assertLessEqual(len(example[feature]), 32)
+      # Every example is packed exactly once.
+      unpacked = zip(*[self._unpack(packed, f) for f in features])
+      expected = zip(*[[e[f] for e in examples] for f in features])
+      self.assertEqual(sorted(expected), sorted(unpacked))
+
+      self.assertEqual(len(examples), best_fit_stats.num_examples)
+      self.assertEqual(len(packed), best_fit_stats.num_packed_examples)
+      self.assertEqual(
+          sum(len(e[f]) for e in examples for f in features),
+          best_fit_stats.num_tokens)
+      self.assertEqual(len(packed) * len(features) * 32,
+                       best_fit_stats.num_positions)
+      self.assertGreater(best_fit_stats.efficiency, first_fit_stats.efficiency)
+
+  def testPackExamplesBestFitChopsLongSequences(self):
+    examples = [{"targets": list(range(1, 20))}, {"targets": [5, 6]}]
+    packed = list(generator_utils.pack_examples(
+        iter(examples), False, packed_length=8, chop_long_sequences=True,
+        best_fit=True))
+    self.assertEqual(
+        [list(range(1, 9)), list(range(9, 17)), [17, 18, 19], [5, 6]],
+        self._unpack(packed, "targets"))
+
+  def testPackExamplesEmptyTargetsInBothModes(self):
+    examples = [{"targets": [1, 2]}, {"targets": []},
+                {"targets": list(range(1, 9))}, {"targets": [3]}]
+    for best_fit in [False, True]:
+      stats = generator_utils.PackingStats()
+      packed = list(generator_utils.pack_examples(
+          iter(examples), False, packed_length=4, chop_long_sequences=True,
+          best_fit=best_fit, stats=stats))
+      # [1, ..., 8] is two fragments and an empty rest; the empty rest and the
+      # empty example are packed too.
+      self.assertEqual(len(examples) + 2, stats.num_examples)
+      self.assertEqual(
+          sorted([[1, 2], [1, 2, 3, 4], [5, 6, 7, 8], [3]]),
+          sorted(t for t in self._unpack(packed, "targets") if t))
+
+  def testPackDataset(self):
+    rng = random.Random(2)
+    examples = [{"inputs": [rng.randint(1, 9)
+                            for _ in range(rng.randint(1, 12))],
+                 "targets": [rng.randint(1, 9)
+                             for _ in range(rng.randint(1, 20))]}
+                for _ in range(50)]
+    for has_inputs in [False, True]:
+      keys = ["inputs", "targets"] if has_inputs else ["targets"]
+      dataset = tf.data.Dataset.from_generator(
+          lambda: iter(examples),  # pylint: disable=cell-var-from-loop
+          {"inputs": tf.int64, "targets": tf.int64},
+          {"inputs": [None], "targets": [None]})
+      dataset = generator_utils.pack_dataset(
+          dataset, has_inputs, packed_length=16, window_size=20)
+      packed = dataset.make_one_shot_iterator().get_next()
+      # Pairs that do not fit are dropped before the examples are windowed.
+      kept = [e for e in examples if not has_inputs or
+              max(len(e["inputs"]), len(e["targets"])) <= 16]
+      expected = []
+      for i in range(0, len(kept), 20):
+        expected.extend(generator_utils.pack_examples(
+            iter(kept[i:i + 20]), has_inputs, packed_length=16,
+            chop_long_sequences=not has_inputs))
+      with tf.train.MonitoredSession() as sess:
+        for expected_example in expected:
+          example = sess.run(packed)
+          self.assertEqual(
+              sorted(k + suffix for k in keys
+                     for suffix in ["", "_segmentation", "_position"]),
+              sorted(example))
+          for key, value in example.items():
+            self.assertEqual((16,), value.shape)
+            self.assertEqual(list(expected_example[key]),
+                             value[:len(expected_example[key])].tolist())
+            self.assertFalse(value[len(expected_example[key]):].any())
+        with self.assertRaises(tf.errors.OutOfRangeError):
+          sess.run(packed)
+
   def testMaybeDownload(self):
     tmp_dir = self.get_temp_dir()
     (_, tmp_file_path) = tempfile.mkstemp(dir=tmp_dir)
@@ -123,5 +568,100 @@ class GeneratorUtilsTest(tf.test.TestCase):
     self.assertIsNotNone(vocab2)
     self.assertEqual(vocab1.dump(), vocab2.dump())
 
+
+class GenerateFilesBenchmark(tf.test.Benchmark):
+  """Measures generate_files throughput with and without a worker pool.
+
+  Run with:
+    python generator_utils_test.py --benchmarks=GenerateFilesBenchmark
+  """
+
+  def _examples_per_sec(self, num_processes, num_cases):
+    def generator():
+      for i in range(num_cases):
+        yield {"inputs": list(range(i % 100, i % 100 + 256)),
+               "targets": [float(x) for x in range(64)]}
+
+    filenames = generator_utils.train_data_filenames(
+        "benchmark%d" % num_processes, tempfile.mkdtemp(), 10)
+    start_time = time.time()
+    generator_utils.generate_files(generator(), filenames,
+                                   num_processes=num_processes)
+    return num_cases / (time.time() - start_time)
+
+  def benchmark_generate_files(self):
+    num_cases = 20000
+    extras = {}
+    for num_processes in [1, 2, 4]:
+      extras["examples_per_sec_%d_processes" % num_processes] = (
+          self._examples_per_sec(num_processes, num_cases))
+    self.report_benchmark(iters=num_cases, extras=extras)
+
+
+class PackExamplesBenchmark(tf.test.Benchmark):
+  """Times packing language model examples.
+
+  Run with:
+    python generator_utils_test.py --benchmarks=PackExamplesBenchmark
+  """
+
+  def benchmark_pack_examples(self):
+    rng = random.Random(0)
+    examples = [{"targets": [rng.randrange(1000, 30000)
+                             for _ in range(rng.randint(5, 40))]}
+                for _ in range(50000)]
+    extras = {}
+    for best_fit in [False, True]:
+      stats = generator_utils.PackingStats()
+      start_time = time.time()
+      for _ in generator_utils.pack_examples(
+          iter(examples), False, packed_length=256, best_fit=best_fit,
+          stats=stats):
+        pass
+      name = "best_fit" if best_fit else "first_fit"
+      extras[name + "_secs"] = time.time() - start_time
+      extras[name + "_efficiency"] = stats.efficiency
+    self.report_benchmark(
+        iters=len(examples), wall_time=extras["first_fit_secs"], extras=extras)
+
+
+class RandomAccessRecordReaderBenchmark(tf.test.Benchmark):
+  """Compares reading random records by index and by iterating the file.
+
+  Run with:
+    python generator_utils_test.py \
+        --benchmarks=RandomAccessRecordReaderBenchmark
+  """
+
+  def benchmark_random_access(self):
+    filename = os.path.join(tempfile.mkdtemp(), "records")
+    num_records = 20000
+    generator_utils.write_records(
+        (b"%d" % i * 50 for i in range(num_records)), filename)
+    rng = random.Random(0)
+    num_reads = 100
+    indices = [rng.randrange(num_records) for _ in range(num_reads)]
+
+    start_time = time.time()
+    # Without an index, the file is read up to each record.
+    for i in indices:
+      expected = next(itertools.islice(
+          tf.python_io.tf_record_iterator(filename), i, None))
+    iterator_time = (time.time() - start_time) / num_reads
+
+    start_time = time.time()
+    with generator_utils.RandomAccessRecordReader(filename) as reader:
+      for i in indices:
+        record = reader[i]
+    random_access_time = (time.time() - start_time) / num_reads
+    assert record == expected
+
+    self.report_benchmark(
+        iters=num_reads,
+        wall_time=random_access_time,
+        extras={"tf_record_iterator_secs_per_record": iterator_time,
+                "random_access_secs_per_record": random_access_time})
+
+
 if __name__ == "__main__":
   tf.test.main()
@@ -26,8 +26,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import random
+
 # Dependency imports
 
+from tensor2tensor.data_generators import generator_utils
 from tensor2tensor.data_generators import text_encoder
 
 import tensorflow as tf
@@ -41,6 +44,9 @@ tf.flags.DEFINE_string("input_filename", "", "input filename")
 tf.flags.DEFINE_bool("print_inputs", False, "Print decoded inputs to stdout")
 tf.flags.DEFINE_bool("print_targets", False, "Print decoded targets to stdout")
 tf.flags.DEFINE_bool("print_all", False, "Print all fields")
+tf.flags.DEFINE_integer("num_samples", 0,
+                        "If positive, only inspect this many records, picked "
+                        "at random.")
 
 FLAGS = tf.flags.FLAGS
 
@@ -56,7 +62,15 @@ def main(_):
     encoder = text_encoder.ByteTextEncoder()
   else:
     encoder = None
-  reader = tf.python_io.tf_record_iterator(FLAGS.input_filename)
+  if FLAGS.num_samples > 0:
+    with generator_utils.RandomAccessRecordReader(
+        FLAGS.input_filename) as random_access_reader:
+      indices = sorted(random.sample(
+          range(len(random_access_reader)),
+          min(FLAGS.num_samples, len(random_access_reader))))
+      reader = random_access_reader.read_batch(indices)
+  else:
+    reader = tf.python_io.tf_record_iterator(FLAGS.input_filename)
   total_sequences = 0
   total_input_tokens = 0
   total_target_tokens = 0
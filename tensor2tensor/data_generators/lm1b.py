@@ -21,6 +21,8 @@ from __future__ import print_function
 
 from collections import defaultdict
 
+import itertools
+import multiprocessing
 import os
 import tarfile
 
@@ -40,6 +42,9 @@ import tensorflow as tf
 # RESERVED_TOKENS list in text_encoder.py)
 EOS = 1
 
+# Number of lines read and encoded at a time.
+_ENCODE_BATCH_SIZE = 4096
+
 
 def _original_vocab(tmp_dir):
   """Returns a set containing the original vocabulary.
@@ -214,11 +219,21 @@ class LanguagemodelLm1b32k(problem.Text2TextProblem):
       vocab_filepath = os.path.join(data_dir, self.vocab_file)
       encoder = _get_or_build_subword_text_encoder(
           tmp_dir, vocab_filepath, self.targeted_vocab_size)
-    for filepath in files:
-      tf.logging.info("filepath = %s", filepath)
-      for line in tf.gfile.Open(filepath):
-        tokens = encoder.encode(
-            _replace_oov(original_vocab, text_encoder.native_to_unicode(line)))
+
+    def read_lines():
+      for filepath in files:
+        tf.logging.info("filepath = %s", filepath)
+        with tf.gfile.Open(filepath) as f:
+          for line in f:
+            yield _replace_oov(original_vocab,
+                               text_encoder.native_to_unicode(line))
+
+    lines = read_lines()
+    batches = iter(lambda: list(itertools.islice(lines, _ENCODE_BATCH_SIZE)),
+                   [])
+    for batch in encoder.encode_batches(
+        batches, num_processes=multiprocessing.cpu_count()):
+      for tokens in batch:
         tokens.append(EOS)
         yield {"inputs": [0], "targets": tokens}
 
@@ -0,0 +1,269 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binary vocabulary files that can be memory-mapped.
+
+Text vocab files have to be parsed, unescaped and indexed by every process
+that loads them. A binary vocab file stores the vocabulary already indexed:
+
+  header   magic, format version, number of strings, number of hash index
+           slots and the length of the longest string, as "<8sIIII".
+  offsets  uint64 * (number of strings + 1). String i is the UTF-8 encoded
+           blob[offsets[i]:offsets[i + 1]].
+  index    int32 * number of slots. An open addressing hash table keyed by
+           the CRC32 of the UTF-8 strings, with linear probing. -1 marks an
+           empty slot.
+  blob     the UTF-8 encoded strings, concatenated.
+
+Local files are memory-mapped rather than read, so loading does not depend on
+the vocabulary size and forked worker processes share the same pages. Strings
+are decoded when they are accessed.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import mmap
+import struct
+import zlib
+
+# Dependency imports
+
+import numpy as np
+import six
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+import tensorflow as tf
+
+_MAGIC = b"T2TVOCAB"
+_VERSION = 1
+_HEADER = struct.Struct("<8sIIII")
+_EMPTY_SLOT = -1
+
+
+def _to_utf8(s):
+  return s.encode("utf-8") if isinstance(s, six.text_type) else s
+
+
+def _slot(key_bytes, num_slots):
+  return zlib.crc32(key_bytes) & (num_slots - 1)
+
+
+def is_mapped_vocab_file(filename):
+  """Whether filename is a binary vocab file, rather than a text one."""
+  with tf.gfile.Open(filename, "rb") as f:
+    return f.read(len(_MAGIC)) == _MAGIC
+
+
+def write_mapped_vocab(filename, strings, index_empty=True):
+  """Writes a binary vocab file.
+
+  Args:
+    filename: Full path of the file to write.
+    strings: a sequence of strings; the id of a string is its index. If a
+      string occurs more than once, looking it up gives its last id.
+    index_empty: if False, the empty string keeps its id but cannot be looked
+      up, as when SubwordTextEncoder loads a text vocab file.
+  """
+  encoded = [_to_utf8(s) for s in strings]
+  num_slots = 1
+  while num_slots < 2 * len(encoded):
+    num_slots *= 2
+  index = np.full(num_slots, _EMPTY_SLOT, dtype="<i4")
+  for i, s in enumerate(encoded):
+    if not s and not index_empty:
+      continue
+    slot = _slot(s, num_slots)
+    while index[slot] != _EMPTY_SLOT and encoded[index[slot]] != s:
+      slot = (slot + 1) & (num_slots - 1)
+    index[slot] = i
+  offsets = np.zeros(len(encoded) + 1, dtype="<u8")
+  offsets[1:] = np.cumsum([len(s) for s in encoded])
+  max_length = max([len(s) for s in strings] or [0])
+
+  with tf.gfile.Open(filename, "wb") as f:
+    f.write(_HEADER.pack(_MAGIC, _VERSION, len(encoded), num_slots,
+                         max_length))
+    f.write(offsets.tobytes())
+    f.write(index.tobytes())
+    f.write(b"".join(encoded))
+
+
+class MappedVocab(object):
+  """A read-only vocabulary loaded from a binary vocab file.
+
+  `id_to_string` and `string_to_id` can be used in place of the list and
+  dict the encoders build when loading text vocab files.
+  """
+
+  def __init__(self, filename):
+    self._filename = filename
+    self._init_from_buffer(self._read(filename))
+
+  def _read(self, filename):
+    try:
+      with open(filename, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError):
+      # Not a local file, e.g. on GCS; read it into memory instead.
+      with tf.gfile.Open(filename, "rb") as f:
+        return f.read()
+
+  def _init_from_buffer(self, buf):
+    """Set up views of the sections of the file."""
+    magic, version, num_strings, num_slots, max_length = (
+        _HEADER.unpack_from(buf, 0))
+    if magic != _MAGIC:
+      raise ValueError("%s is not a binary vocab file." % self._filename)
+    if version != _VERSION:
+      raise ValueError("%s has unsupported binary vocab version %d." %
+                       (self._filename, version))
+    self._buf = buf
+    position = _HEADER.size
+    self._offsets = np.frombuffer(buf, dtype="<u8", count=num_strings + 1,
+                                  offset=position)
+    position += self._offsets.nbytes
+    self._index = np.frombuffer(buf, dtype="<i4", count=num_slots,
+                                offset=position)
+    position += self._index.nbytes
+    self._blob_start = position
+    self.max_string_length = max_length
+    self.id_to_string = _IdToString(self)
+    self.string_to_id = _StringToId(self)
+
+  def __getstate__(self):
+    # Memory maps cannot be pickled; workers map the file again instead.
+    if isinstance(self._buf, mmap.mmap):
+      return {"filename": self._filename}
+    return {"filename": self._filename, "buf": self._buf}
+
+  def __setstate__(self, state):
+    self._filename = state["filename"]
+    if "buf" in state:
+      self._init_from_buffer(state["buf"])
+    else:
+      self._init_from_buffer(self._read(self._filename))
+
+  def __len__(self):
+    return len(self._offsets) - 1
+
+  def _string_bytes(self, i):
+    start = self._blob_start + self._offsets.item(i)
+    end = self._blob_start + self._offsets.item(i + 1)
+    return self._buf[start:end]
+
+  def string(self, i):
+    return self._string_bytes(i).decode("utf-8")
+
+  def chars(self):
+    """Returns the set of all characters in the vocabulary."""
+    return set(self._buf[self._blob_start:].decode("utf-8"))
+
+  def lookup(self, s):
+    """Returns the id of s, or -1 if it is not in the vocabulary."""
+    key_bytes = _to_utf8(s)
+    num_slots = len(self._index)
+    slot = _slot(key_bytes, num_slots)
+    while True:
+      i = self._index.item(slot)
+      if i == _EMPTY_SLOT or self._string_bytes(i) == key_bytes:
+        return i
+      slot = (slot + 1) & (num_slots - 1)
+
+  def ids(self):
+    """Returns the ids that lookup() can return, in hash index order."""
+    return self._index[self._index != _EMPTY_SLOT].tolist()
+
+
+class _IdToString(object):
+  """Sequence view of a MappedVocab, also supporting dict-style get()."""
+
+  def __init__(self, vocab):
+    self._vocab = vocab
+
+  def __len__(self):
+    return len(self._vocab)
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self._vocab)
+    if not 0 <= i < len(self._vocab):
+      raise IndexError("Id out of range: %d" % i)
+    return self._vocab.string(i)
+
+  def __iter__(self):
+    for i in xrange(len(self._vocab)):
+      yield self._vocab.string(i)
+
+  def get(self, i, default=None):
+    if not 0 <= i < len(self._vocab):
+      return default
+    return self._vocab.string(i)
+
+
+class _StringToId(dict):
+  """Read-only dict view of a MappedVocab.
+
+  The dict itself holds the strings that have been found, so looking up the
+  same token again is a plain dict lookup rather than a CRC32 and a probe of
+  the index. It holds at most the vocabulary, and only the part of it in
+  use.
+  """
+
+  def __init__(self, vocab):
+    super(_StringToId, self).__init__()
+    self._vocab = vocab
+    self._len = None
+
+  def __reduce__(self):
+    # Pickle the vocab, which pickles as its filename, not the found strings.
+    return _StringToId, (self._vocab,)
+
+  def __missing__(self, s):
+    i = self._vocab.lookup(s)
+    if i == _EMPTY_SLOT:
+      raise KeyError(s)
+    self[s] = i
+    return i
+
+  def __len__(self):
+    if self._len is None:
+      self._len = len(self._vocab.ids())
+    return self._len
+
+  def __contains__(self, s):
+    return self.get(s) is not None
+
+  def get(self, s, default=None):
+    try:
+      return self[s]
+    except KeyError:
+      return default
+
+  def __iter__(self):
+    return self.iterkeys()
+
+  def iterkeys(self):
+    for i in self._vocab.ids():
+      yield self._vocab.string(i)
+
+  def iteritems(self):
+    for i in self._vocab.ids():
+      yield self._vocab.string(i), i
+
+  # six.iterkeys and six.iteritems call these on Python 3.
+  keys = iterkeys
+  items = iteritems
@@ -0,0 +1,182 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tensor2tensor.data_generators.mapped_vocab."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import pickle
+import time
+
+# Dependency imports
+
+import six
+
+from tensor2tensor.data_generators import mapped_vocab
+from tensor2tensor.data_generators import text_encoder
+import tensorflow as tf
+
+_VOCAB_FILENAME = os.path.join(
+    os.path.dirname(__file__), "..", "test_data", "vocab.ende.32768")
+
+
+class MappedVocabTest(tf.test.TestCase):
+
+  def test_write_and_load(self):
+    strings = ["<pad>", "<EOS>", "a", "b_", "\U0001F638", "", "a"]
+    filename = os.path.join(self.get_temp_dir(), "strings.bin")
+    mapped_vocab.write_mapped_vocab(filename, strings)
+    self.assertTrue(mapped_vocab.is_mapped_vocab_file(filename))
+
+    vocab = mapped_vocab.MappedVocab(filename)
+    self.assertEqual(strings, list(vocab.id_to_string))
+    self.assertEqual("b_", vocab.id_to_string[3])
+    self.assertEqual("a", vocab.id_to_string[-1])
+    self.assertEqual("ID_9", vocab.id_to_string.get(9, "ID_9"))
+    with self.assertRaises(IndexError):
+      _ = vocab.id_to_string[7]
+
+    expected = {s: i for i, s in enumerate(strings)}
+    self.assertEqual(expected, dict(six.iteritems(vocab.string_to_id)))
+    self.assertEqual(len(expected), len(vocab.string_to_id))
+    self.assertEqual(4, vocab.string_to_id["\U0001F638"])
+    self.assertNotIn("c", vocab.string_to_id)
+    self.assertIsNone(vocab.string_to_id.get("b"))
+    with self.assertRaises(KeyError):
+      _ = vocab.string_to_id["c"]
+    self.assertEqual(5, vocab.max_string_length)
+
+    unpickled = pickle.loads(pickle.dumps(vocab))
+    self.assertEqual(strings, list(unpickled.id_to_string))
+    # The strings found so far are not pickled with the lookup dict.
+    string_to_id = pickle.loads(pickle.dumps(vocab.string_to_id))
+    self.assertFalse(dict.__len__(string_to_id))
+    self.assertEqual(expected, dict(six.iteritems(string_to_id)))
+
+    mapped_vocab.write_mapped_vocab(filename, strings, index_empty=False)
+    vocab = mapped_vocab.MappedVocab(filename)
+    self.assertEqual(strings, list(vocab.id_to_string))
+    self.assertNotIn("", vocab.string_to_id)
+    del expected[""]
+    self.assertEqual(expected, dict(six.iteritems(vocab.string_to_id)))
+
+  def test_rejects_text_vocab(self):
+    self.assertFalse(mapped_vocab.is_mapped_vocab_file(_VOCAB_FILENAME))
+    with self.assertRaises(ValueError):
+      mapped_vocab.MappedVocab(_VOCAB_FILENAME)
+
+  def test_subword_text_encoder(self):
+    encoder = text_encoder.SubwordTextEncoder(_VOCAB_FILENAME)
+    filename = os.path.join(self.get_temp_dir(), "vocab.ende.bin")
+    encoder.store_to_binary_file(filename)
+    binary_encoder = text_encoder.SubwordTextEncoder(filename)
+
+    self.assertEqual(encoder.vocab_size, binary_encoder.vocab_size)
+    self.assertEqual(encoder.all_subtoken_strings,
+                     binary_encoder.all_subtoken_strings)
+    self.assertEqual(encoder._alphabet, binary_encoder._alphabet)
+    self.assertEqual(encoder._max_subtoken_len,
+                     binary_encoder._max_subtoken_len)
+    text = "Die Katze saß auf der Matte, \U0001F638 und schnurrte 12345 Mal."
+    ids = encoder.encode(text)
+    self.assertEqual(ids, binary_encoder.encode(text))
+    self.assertEqual(text, binary_encoder.decode(ids))
+    self.assertEqual([ids] * 3,
+                     binary_encoder.encode_batch([text] * 3, num_processes=2))
+
+  def test_subword_text_encoder_with_empty_subtoken(self):
+    text_filename = os.path.join(self.get_temp_dir(), "empty.txt")
+    with tf.gfile.Open(text_filename, "w") as f:
+      f.write("'a'\n''\n'b_'\n")
+    encoder = text_encoder.SubwordTextEncoder(text_filename)
+    filename = os.path.join(self.get_temp_dir(), "empty.bin")
+    encoder.store_to_binary_file(filename)
+    binary_encoder = text_encoder.SubwordTextEncoder(filename)
+    self.assertEqual(list(encoder.all_subtoken_strings),
+                     list(binary_encoder.all_subtoken_strings))
+    self.assertEqual(encoder._subtoken_string_to_id,
+                     dict(six.iteritems(binary_encoder._subtoken_string_to_id)))
+
+  def test_token_text_encoder(self):
+    corpus = "A B C D E F G H I J K L M N O P Q R S T U V W X Y Z"
+    encoder = text_encoder.TokenTextEncoder(None, vocab_list=corpus.split(),
+                                            replace_oov="Z")
+    filename = os.path.join(self.get_temp_dir(), "abc.bin")
+    encoder.store_to_binary_file(filename)
+    binary_encoder = text_encoder.TokenTextEncoder(filename, replace_oov="Z")
+
+    self.assertEqual(encoder.vocab_size, binary_encoder.vocab_size)
+    ids = encoder.encode("A B unknown Y")
+    self.assertEqual(ids, binary_encoder.encode("A B unknown Y"))
+    self.assertEqual(encoder.decode(ids + [100]),
+                     binary_encoder.decode(ids + [100]))
+
+
+class MappedVocabBenchmark(tf.test.Benchmark):
+  """Compares loading text and binary vocab files.
+
+  Run with:
+    python mapped_vocab_test.py --benchmarks=MappedVocabBenchmark
+  """
+
+  def _time_load(self, filename, num_iters):
+    start_time = time.time()
+    for _ in range(num_iters):
+      encoder = text_encoder.SubwordTextEncoder(filename)
+      encoder.decode([100, 200, 300])
+    return (time.time() - start_time) / num_iters
+
+  def benchmark_load(self):
+    filename = os.path.join(tf.test.get_temp_dir(), "vocab.ende.bin")
+    text_encoder.SubwordTextEncoder(_VOCAB_FILENAME).store_to_binary_file(
+        filename)
+    num_iters = 20
+    text_time = self._time_load(_VOCAB_FILENAME, num_iters)
+    binary_time = self._time_load(filename, num_iters)
+    self.report_benchmark(
+        iters=num_iters,
+        wall_time=binary_time,
+        extras={"text_load_secs": text_time, "binary_load_secs": binary_time})
+
+  def _time_encode(self, encoder, text, num_iters):
+    start_time = time.time()
+    for _ in range(num_iters):
+      encoder.encode(text)
+    return (time.time() - start_time) / num_iters
+
+  def benchmark_token_encode(self):
+    words = ["w%d" % i for i in range(10000)]
+    encoder = text_encoder.TokenTextEncoder(None, vocab_list=words,
+                                            replace_oov="w0")
+    filename = os.path.join(tf.test.get_temp_dir(), "words.bin")
+    encoder.store_to_binary_file(filename)
+    binary_encoder = text_encoder.TokenTextEncoder(filename, replace_oov="w0")
+    text = " ".join(words[(i * 7919) % len(words)] for i in range(100000))
+    num_iters = 5
+    text_time = self._time_encode(encoder, text, num_iters)
+    binary_time = self._time_encode(binary_encoder, text, num_iters)
+    self.report_benchmark(
+        iters=num_iters,
+        wall_time=binary_time,
+        extras={"text_encode_secs": text_time,
+                "binary_encode_secs": binary_time})
+
+
+if __name__ == "__main__":
+  tf.test.main()
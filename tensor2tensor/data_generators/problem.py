@@ -17,12 +17,15 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
+import codecs
 import collections
+import itertools
 import os
 import random
 # Dependency imports
 import six
 from tensor2tensor.data_generators import generator_utils
+from tensor2tensor.data_generators import record_index
 from tensor2tensor.data_generators import text_encoder
 from tensor2tensor.utils import data_reader
 from tensor2tensor.utils import metrics
@@ -103,6 +106,7 @@ def default_model_hparams():
       max_target_seq_length=0,
       prepend_mode="none",
       split_to_length=0,
+      pack_to_length=0,
       data_dir=None)
 
 
@@ -132,9 +136,12 @@ def _file_num_records_cached(filename):
   # Cache the result, as this is expensive to compute
   if filename in _file_num_records_cache:
     return _file_num_records_cache[filename]
-  ret = 0
-  for _ in tf.python_io.tf_record_iterator(filename):
-    ret += 1
+  ret = record_index.num_records(filename)
+  if ret is None:
+    # No index; count the records.
+    ret = 0
+    for _ in tf.python_io.tf_record_iterator(filename):
+      ret += 1
   _file_num_records_cache[filename] = ret
   return ret
 
@@ -226,6 +233,23 @@ class Problem(object):
     """
     raise NotImplementedError()
 
+  def generate_task_size(self, data_dir, tmp_dir, task_id):
+    """Relative amount of work of a task, e.g. its number of input bytes.
+
+    If multiprocess_generate is True, the biggest tasks are started first
+    and the sizes are used to estimate the remaining time. This function is
+    called after prepare_to_generate.
+
+    Args:
+      data_dir: a string
+      tmp_dir: a string
+      task_id: an integer less than num_generate_tasks
+    Returns:
+      a number
+    """
+    del data_dir, tmp_dir, task_id
+    return 1
+
   def hparams(self, defaults, model_hparams):
     pass
 
@@ -239,8 +263,8 @@ class Problem(object):
     Returns:
       an integer
     """
-    return (model_hparams.split_to_length or model_hparams.max_length or
-            model_hparams.batch_size)
+    return (model_hparams.split_to_length or model_hparams.pack_to_length or
+            model_hparams.max_length or model_hparams.batch_size)
 
   def tpu_batch_size_per_shard(self, model_hparams):
     """Batch size in examples per TPU core.
@@ -539,6 +563,9 @@ class Problem(object):
                                      block_length=16)
     dataset = dataset.map(
         _maybe_reverse_and_copy, num_parallel_calls=num_threads)
+    if hparams.pack_to_length and mode != tf.estimator.ModeKeys.PREDICT:
+      dataset = generator_utils.pack_dataset(
+          dataset, self.has_inputs, hparams.pack_to_length)
 
     if output_buffer_size:
       dataset = dataset.prefetch(output_buffer_size)
@@ -968,6 +995,18 @@ class Text2TextProblem(Problem):
     """
     return None
 
+  @property
+  def packing_best_fit(self):
+    """Whether to pack examples by best fit rather than first fit.
+
+    Best fit packs more densely, but changes the order of the examples.
+    See generator_utils.pack_examples().
+
+    Returns:
+      a boolean
+    """
+    return False
+
   def max_length(self, model_hparams):
     """Maximum sequence length."""
     if self.packed_length:
@@ -1018,7 +1057,8 @@ class Text2TextProblem(Problem):
           generator,
           self.has_inputs,
           self.packed_length,
-          chop_long_sequences=not self.has_inputs)
+          chop_long_sequences=not self.has_inputs,
+          best_fit=self.packing_best_fit)
     else:
       return generator
 
@@ -1111,6 +1151,11 @@ class ChoppedTextProblem(Text2TextProblem):
   then split into examples, each of length self.sequence_length().
   """
 
+  def __init__(self, was_reversed=False, was_copy=False):
+    super(ChoppedTextProblem, self).__init__(was_reversed, was_copy)
+    # (vocab filepath, encoder); see get_or_generate_vocab().
+    self._generate_vocab = None
+
   def train_text_filepaths(self, tmp_dir):
     """Local filepaths of text files containing training data.
 
@@ -1183,9 +1228,37 @@ class ChoppedTextProblem(Text2TextProblem):
     Yields:
       unicode strings.
     """
-    f = tf.gfile.Open(filepath)
-    b = f.read()
-    yield to_unicode_ignore_erros(b)
+    yield u"".join(_read_unicode_chunks(filepath, self.read_chunk_size))
+
+  def filepath_to_unicode_streams(self, filepath):
+    """Read text out of an input file, in pieces.
+
+    Each stream is an iterable of unicode strings that are tokenized as if
+    they were concatenated, and corresponds to one string yielded by
+    filepath_to_unicode_strings().
+
+    By default the file is one stream, read self.read_chunk_size bytes
+    at a time, so that the whole file is never held in memory. If a subclass
+    overrides filepath_to_unicode_strings(), each of its strings is a stream.
+
+    Args:
+      filepath: a string
+    Yields:
+      iterables of unicode strings.
+    """
+    to_strings = six.get_unbound_function(
+        type(self).filepath_to_unicode_strings)
+    if to_strings is six.get_unbound_function(
+        ChoppedTextProblem.filepath_to_unicode_strings):
+      yield _read_unicode_chunks(filepath, self.read_chunk_size)
+    else:
+      for text in self.filepath_to_unicode_strings(filepath):
+        yield [text]
+
+  @property
+  def read_chunk_size(self):
+    """Number of bytes to read from an input file at a time."""
+    return 2**20
 
   def file_generator(self,
                      filepaths,
@@ -1227,6 +1300,41 @@ class ChoppedTextProblem(Text2TextProblem):
         if max_chars_per_file and chars_this_file >= max_chars_per_file:
           break
 
+  def file_stream_generator(self, filepaths, max_chars_per_file=None):
+    """Read the text of input files and yield it as streams of pieces.
+
+    Like file_generator(), but yields the iterables of
+    filepath_to_unicode_streams() instead of complete strings.
+
+    Args:
+      filepaths: a list of strings
+      max_chars_per_file: an optional integer
+    Yields:
+      iterables of unicode strings
+    """
+    for fname in filepaths:
+      tf.logging.info("reading file %s" % fname)
+      # Shared by the streams of the file, which are consumed one at a time.
+      chars_this_file = [0]
+
+      def truncate(stream):
+        for text in stream:
+          if chars_this_file[0] + len(text) > max_chars_per_file:
+            text = text[:max_chars_per_file - chars_this_file[0]]
+          chars_this_file[0] += len(text)
+          if text:
+            yield text
+          if chars_this_file[0] >= max_chars_per_file:
+            return
+
+      for stream in self.filepath_to_unicode_streams(fname):
+        if not max_chars_per_file:
+          yield stream
+          continue
+        if chars_this_file[0] >= max_chars_per_file:
+          break
+        yield truncate(stream)
+
   def example_generator(self, encoder, tmp_dir, task_id):
     """Generator for examples.
 
@@ -1245,15 +1353,17 @@ class ChoppedTextProblem(Text2TextProblem):
     else:
       max_chars_per_file = None
     tokens = []
-    for ftext in self.file_generator(
+    for stream in self.file_stream_generator(
         filepaths, max_chars_per_file=max_chars_per_file):
-      tokens.extend(encoder.encode(ftext))
-      pos = 0
-      while pos + self.sequence_length <= len(tokens):
-        yield {"inputs": [0], "targets": tokens[pos:pos + self.sequence_length]}
-        pos += self.sequence_length
-      if pos > 0:
-        tokens = tokens[pos:]
+      ids = encoder.encode_stream(stream)
+      while True:
+        tokens.extend(
+            itertools.islice(ids, self.sequence_length - len(tokens)))
+        if len(tokens) < self.sequence_length:
+          # The stream is exhausted; carry the rest over to the next one.
+          break
+        yield {"inputs": [0], "targets": tokens}
+        tokens = []
     if self.remainder_policy == "pad":
       if tokens:
         targets = tokens + [0] * (self.sequence_length - len(tokens))
@@ -1277,11 +1387,24 @@ class ChoppedTextProblem(Text2TextProblem):
     self.dev_text_filepaths(tmp_dir)
 
   def get_or_generate_vocab(self, data_dir, tmp_dir):
-    return generator_utils.get_or_generate_vocab_inner(
+    # A datagen worker generates several tasks; load the vocab only once.
+    vocab_filepath = os.path.join(data_dir, self.vocab_file)
+    if self._generate_vocab and self._generate_vocab[0] == vocab_filepath:
+      return self._generate_vocab[1]
+    encoder = generator_utils.get_or_generate_vocab_inner(
         data_dir, self.vocab_file, self.targeted_vocab_size,
         self.file_generator(
             self.train_text_filepaths(tmp_dir),
             max_chars_total=self.max_chars_for_vocab))
+    self._generate_vocab = (vocab_filepath, encoder)
+    return encoder
+
+  def generate_task_size(self, data_dir, tmp_dir, task_id):
+    """Number of bytes of the input files of a task."""
+    del data_dir
+    return sum(tf.gfile.Stat(f).length
+               for f in self.text_filepaths_for_task(tmp_dir, task_id)
+               if tf.gfile.Exists(f))
 
   def generate_data(self, data_dir, tmp_dir, task_id=-1):
     """Generates training/dev data.
@@ -1305,6 +1428,8 @@ class ChoppedTextProblem(Text2TextProblem):
           shuffled=False)[task_id - self.num_train_shards]
     generator_utils.generate_files(
         self.example_generator(encoder, tmp_dir, task_id), [out_file])
+    tf.logging.info("Token cache stats for task_id=%s: %s",
+                    task_id, encoder.cache_stats)
     generator_utils.shuffle_dataset([out_file])
 
   @property
@@ -1358,6 +1483,26 @@ def to_unicode_ignore_erros(s):
           if six.PY2 else s.decode("utf-8", "ignore"))
 
 
+def _read_unicode_chunks(filepath, chunk_size):
+  """Yields the text of a file in pieces, like to_unicode_ignore_erros().
+
+  Args:
+    filepath: a string
+    chunk_size: number of bytes to read at a time.
+  Yields:
+    unicode strings
+  """
+  decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+  with tf.gfile.Open(filepath, "rb") as f:
+    while True:
+      b = f.read(chunk_size)
+      text = decoder.decode(b, final=not b)
+      if text:
+        yield text
+      if not b:
+        break
+
+
 def _are_shapes_fully_defined(shapes_dict):
   for shape in shapes_dict.values():
     if not shape.is_fully_defined():
@@ -0,0 +1,149 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tensor2tensor.data_generators.problem."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import collections
+import io
+import os
+
+# Dependency imports
+
+from tensor2tensor.data_generators import generator_utils
+from tensor2tensor.data_generators import problem
+from tensor2tensor.data_generators import record_index
+from tensor2tensor.data_generators import text_encoder
+import tensorflow as tf
+
+
+class _ChoppedText(problem.ChoppedTextProblem):
+
+  def __init__(self, filepaths, read_chunk_size):
+    super(_ChoppedText, self).__init__()
+    self._filepaths = filepaths
+    self._read_chunk_size = read_chunk_size
+
+  def train_text_filepaths(self, tmp_dir):
+    return self._filepaths
+
+  def dev_text_filepaths(self, tmp_dir):
+    return self._filepaths
+
+  @property
+  def sequence_length(self):
+    return 7
+
+  @property
+  def read_chunk_size(self):
+    return self._read_chunk_size
+
+  @property
+  def num_train_shards(self):
+    return 1
+
+  @property
+  def max_dev_chars(self):
+    return 50
+
+
+class _ChoppedLines(_ChoppedText):
+
+  def filepath_to_unicode_strings(self, filepath):
+    with io.open(filepath, encoding="utf-8") as f:
+      for line in f:
+        yield line
+
+
+class ChoppedTextProblemTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(ChoppedTextProblemTest, self).setUp()
+    text = ("Die Katze saß auf der Matte.\n"
+            "\U0001F638 The cat sat on the mat, and purred 12345 times.\n")
+    self.filepaths = []
+    for i in range(2):
+      filepath = os.path.join(self.get_temp_dir(), "text%d.txt" % i)
+      with io.open(filepath, "w", encoding="utf-8") as f:
+        f.write(text * (i + 1))
+      self.filepaths.append(filepath)
+    token_counts = collections.Counter(text.split())
+    self.encoder = text_encoder.SubwordTextEncoder.build_to_target_size(
+        100, token_counts, 1, 10)
+
+  def _expected_targets(self, texts, sequence_length):
+    tokens = []
+    for text in texts:
+      tokens.extend(self.encoder.encode(text))
+    targets = [tokens[i:i + sequence_length]
+               for i in range(0, len(tokens), sequence_length)]
+    targets[-1] += [0] * (sequence_length - len(targets[-1]))
+    return targets
+
+  def _targets(self, chopped, task_id):
+    return [example["targets"] for example in chopped.example_generator(
+        self.encoder, self.get_temp_dir(), task_id)]
+
+  def test_chunks_are_tokenized_as_one_string(self):
+    texts = []
+    for filepath in self.filepaths:
+      with io.open(filepath, encoding="utf-8") as f:
+        texts.append(f.read())
+    expected = self._expected_targets(texts, 7)
+    # Small chunks split words and UTF-8 sequences.
+    for read_chunk_size in [1, 5, 2**20]:
+      chopped = _ChoppedText(self.filepaths, read_chunk_size)
+      self.assertEqual(expected, self._targets(chopped, 0))
+
+  def test_dev_data_is_truncated(self):
+    chopped = _ChoppedText(self.filepaths, 5)
+    texts = list(chopped.file_generator(self.filepaths, max_chars_per_file=25))
+    self.assertEqual(self._expected_targets(texts, 7),
+                     self._targets(chopped, 1))
+
+  def test_overridden_strings_are_tokenized_separately(self):
+    chopped = _ChoppedLines(self.filepaths, 5)
+    texts = list(chopped.file_generator(self.filepaths))
+    self.assertEqual(4 + 2, len(texts))
+    self.assertEqual(self._expected_targets(texts, 7),
+                     self._targets(chopped, 0))
+    texts = list(chopped.file_generator(self.filepaths, max_chars_per_file=25))
+    self.assertEqual(self._expected_targets(texts, 7),
+                     self._targets(chopped, 1))
+
+  def test_generate_task_size(self):
+    chopped = _ChoppedText(self.filepaths, 5)
+    sizes = [os.path.getsize(filepath) for filepath in self.filepaths]
+    self.assertEqual(sum(sizes),
+                     chopped.generate_task_size(None, None, 0))
+
+
+class FileNumRecordsTest(tf.test.TestCase):
+
+  def test_with_and_without_index(self):
+    filename = os.path.join(self.get_temp_dir(), "records")
+    generator_utils.write_records([b"a", b"b", b"c"], filename)
+    self.assertEqual(3, problem._file_num_records_cached(filename))
+    tf.gfile.Remove(record_index.index_filename(filename))
+    del problem._file_num_records_cache[filename]
+    self.assertEqual(3, problem._file_num_records_cached(filename))
+
+
+if __name__ == "__main__":
+  tf.test.main()
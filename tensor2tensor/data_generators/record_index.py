@@ -0,0 +1,246 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sidecar index files for TFRecord files.
+
+Counting the records of a TFRecord file, or finding the n-th one, means
+reading the whole file. When a file is written with IndexedRecordWriter, an
+index of it is written next to it, so that these take one small read:
+
+  header   magic, format version, number of records and the length of the
+           TFRecord file in bytes, as "<8sIQQ".
+  offsets  uint64 * number of records; the position of each record in the
+           TFRecord file.
+
+The index of "dir/name" is "dir/.name.index". The leading dot keeps it out of
+data file patterns such as "dir/name*". An index whose recorded file length
+differs from the actual one is stale and is ignored.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import struct
+
+# Dependency imports
+
+import numpy as np
+
+import tensorflow as tf
+
+_MAGIC = b"T2TRIDX\x00"
+_VERSION = 1
+_HEADER = struct.Struct("<8sIQQ")
+# Each TFRecord is framed by a uint64 length, a uint32 CRC of the length and
+# a uint32 CRC of the data.
+_RECORD_OVERHEAD = 16
+_LENGTH = struct.Struct("<Q")
+
+
+def index_filename(filename):
+  """Returns the name of the index of a TFRecord file."""
+  dirname, basename = os.path.split(filename)
+  return os.path.join(dirname, ".%s.index" % basename)
+
+
+def write_index(filename, offsets, file_length):
+  """Writes the index of a TFRecord file.
+
+  Args:
+    filename: the name of the TFRecord file.
+    offsets: the position of each record in the file.
+    file_length: the length of the file in bytes.
+  """
+  with tf.gfile.Open(index_filename(filename), "wb") as f:
+    f.write(_HEADER.pack(_MAGIC, _VERSION, len(offsets), file_length))
+    f.write(np.asarray(offsets, dtype="<u8").tobytes())
+
+
+def _read_header(filename):
+  """Returns (index file, number of records), or None if there is no index."""
+  index_fname = index_filename(filename)
+  try:
+    f = tf.gfile.Open(index_fname, "rb")
+    header = f.read(_HEADER.size)
+  except tf.errors.NotFoundError:
+    return None
+  if len(header) < _HEADER.size:
+    f.close()
+    return None
+  magic, version, num_records, file_length = _HEADER.unpack(header)
+  if (magic != _MAGIC or version != _VERSION or
+      file_length != tf.gfile.Stat(filename).length):
+    tf.logging.warning("Ignoring invalid or stale index %s", index_fname)
+    f.close()
+    return None
+  return f, num_records
+
+
+def num_records(filename):
+  """Returns the number of records in a TFRecord file, from its index.
+
+  Args:
+    filename: the name of the TFRecord file.
+
+  Returns:
+    an integer, or None if the file has no valid index.
+  """
+  header = _read_header(filename)
+  if header is None:
+    return None
+  f, count = header
+  f.close()
+  return count
+
+
+def read_offsets(filename):
+  """Returns the positions of the records of a TFRecord file, from its index.
+
+  Args:
+    filename: the name of the TFRecord file.
+
+  Returns:
+    a uint64 NumPy array, or None if the file has no valid index.
+  """
+  header = _read_header(filename)
+  if header is None:
+    return None
+  f, count = header
+  with f:
+    return np.frombuffer(f.read(8 * count), dtype="<u8", count=count)
+
+
+def scan_offsets(buf):
+  """Finds the positions of the records in the contents of a TFRecord file.
+
+  Only the length fields are read, so this is much faster than parsing the
+  records, but it does not check them.
+
+  Args:
+    buf: the contents of a TFRecord file, e.g. bytes or an mmap.
+
+  Returns:
+    a uint64 NumPy array.
+  """
+  offsets = []
+  position = 0
+  end = len(buf)
+  while position < end:
+    offsets.append(position)
+    length, = _LENGTH.unpack_from(buf, position)
+    position += length + _RECORD_OVERHEAD
+  if position != end:
+    raise ValueError("Truncated TFRecord file.")
+  return np.array(offsets, dtype="<u8")
+
+
+def scan_file_offsets(f, chunk_size=2**22):
+  """Like scan_offsets, for a file that is read sequentially, in chunks.
+
+  Args:
+    f: a TFRecord file opened for reading in binary mode, at its start.
+    chunk_size: number of bytes to read at a time.
+
+  Returns:
+    a uint64 NumPy array.
+  """
+  offsets = []
+  position = 0
+  # data holds the file from data_start on, up to what has been read.
+  data = b""
+  data_start = 0
+  while True:
+    while position + _LENGTH.size <= data_start + len(data):
+      offsets.append(position)
+      length, = _LENGTH.unpack_from(data, position - data_start)
+      position += length + _RECORD_OVERHEAD
+    chunk = f.read(chunk_size)
+    if not chunk:
+      break
+    # Keep just what is left of the next length field, if it has been read.
+    keep = max(0, data_start + len(data) - position)
+    data_start += len(data) - keep
+    data = data[len(data) - keep:] + chunk
+  if position != data_start + len(data):
+    raise ValueError("Truncated TFRecord file.")
+  return np.array(offsets, dtype="<u8")
+
+
+def remove(filename):
+  """Removes a TFRecord file and its index, if it has one."""
+  tf.gfile.Remove(filename)
+  remove_index(filename)
+
+
+def remove_index(filename):
+  """Removes the index of a TFRecord file, if it has one."""
+  if tf.gfile.Exists(index_filename(filename)):
+    tf.gfile.Remove(index_filename(filename))
+
+
+def is_complete(filename):
+  """Whether a TFRecord file has a valid index.
+
+  IndexedRecordWriter only writes the index once the file is closed, so
+  this tells apart the files it finished writing from interrupted ones.
+
+  Args:
+    filename: the name of the TFRecord file.
+
+  Returns:
+    a boolean
+  """
+  if not tf.gfile.Exists(filename):
+    return False
+  return num_records(filename) is not None
+
+
+class IndexedRecordWriter(object):
+  """A TFRecordWriter that also writes the index of the file when closed."""
+
+  def __init__(self, filename):
+    self._filename = filename
+    # Until the file is closed, it has no index.
+    remove_index(filename)
+    self._writer = tf.python_io.TFRecordWriter(filename)
+    self._offsets = []
+    self._position = 0
+
+  def write(self, record):
+    self._writer.write(record)
+    self._offsets.append(self._position)
+    self._position += len(record) + _RECORD_OVERHEAD
+
+  def close(self):
+    if self._writer is None:
+      return
+    self._writer.close()
+    self._writer = None
+    write_index(self._filename, self._offsets, self._position)
+
+  def abort(self):
+    """Closes the file without writing its index, e.g. after an error."""
+    if self._writer is None:
+      return
+    self._writer.close()
+    self._writer = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.close()
@@ -0,0 +1,106 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tensor2tensor.data_generators.record_index."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+# Dependency imports
+
+from tensor2tensor.data_generators import generator_utils
+from tensor2tensor.data_generators import record_index
+import tensorflow as tf
+
+
+class RecordIndexTest(tf.test.TestCase):
+
+  def test_write_and_read_index(self):
+    filename = os.path.join(self.get_temp_dir(), "data-train-00000-of-00001")
+    records = [b"a" * i for i in range(50)]
+    with record_index.IndexedRecordWriter(filename) as writer:
+      for record in records:
+        writer.write(record)
+
+    self.assertEqual(50, record_index.num_records(filename))
+    offsets = record_index.read_offsets(filename)
+    self.assertEqual(50, len(offsets))
+    # Every offset is where a record starts.
+    with open(filename, "rb") as f:
+      data = f.read()
+    for record, offset in zip(records, offsets):
+      length = len(record)
+      self.assertEqual(record, data[offset + 12:offset + 12 + length])
+    # The index does not match data file patterns.
+    self.assertEqual(
+        [filename],
+        tf.gfile.Glob(os.path.join(self.get_temp_dir(), "data-train*")))
+
+    record_index.remove(filename)
+    self.assertFalse(tf.gfile.Exists(filename))
+    self.assertFalse(tf.gfile.Exists(record_index.index_filename(filename)))
+
+  def test_missing_or_stale_index(self):
+    filename = os.path.join(self.get_temp_dir(), "stale")
+    writer = tf.python_io.TFRecordWriter(filename)
+    writer.write(b"record")
+    writer.close()
+    self.assertIsNone(record_index.num_records(filename))
+    self.assertIsNone(record_index.read_offsets(filename))
+
+    generator_utils.write_records([b"a", b"b"], filename)
+    self.assertEqual(2, record_index.num_records(filename))
+    # Rewrite the file without updating the index.
+    writer = tf.python_io.TFRecordWriter(filename)
+    writer.write(b"record")
+    writer.close()
+    self.assertIsNone(record_index.num_records(filename))
+
+  def test_scan_file_offsets(self):
+    filename = os.path.join(self.get_temp_dir(), "scanned")
+    records = [b"a" * i for i in range(30)]
+    generator_utils.write_records(records, filename)
+    expected = record_index.read_offsets(filename)
+    with open(filename, "rb") as f:
+      data = f.read()
+    self.assertAllEqual(expected, record_index.scan_offsets(data))
+    # Chunks split the length fields and the records.
+    for chunk_size in [1, 5, 13, 2**20]:
+      with open(filename, "rb") as f:
+        self.assertAllEqual(
+            expected, record_index.scan_file_offsets(f, chunk_size))
+    with open(filename, "wb") as f:
+      f.write(data[:-1])
+    with open(filename, "rb") as f:
+      with self.assertRaises(ValueError):
+        record_index.scan_file_offsets(f, 5)
+
+  def test_generate_files_writes_indexes(self):
+    def generator():
+      for i in range(10):
+        yield {"inputs": [i]}
+
+    filenames = generator_utils.train_data_filenames(
+        "indexed", self.get_temp_dir(), 3)
+    generator_utils.generate_files(generator(), filenames)
+    self.assertEqual([4, 3, 3],
+                     [record_index.num_records(f) for f in filenames])
+
+
+if __name__ == "__main__":
+  tf.test.main()
@@ -26,6 +26,7 @@ from __future__ import print_function
 
 import collections
 from itertools import chain
+import multiprocessing
 import re
 import tempfile
 
@@ -33,6 +34,8 @@ import tempfile
 
 import six
 from six.moves import xrange  # pylint: disable=redefined-builtin
+from tensor2tensor.data_generators import compact_counts
+from tensor2tensor.data_generators import mapped_vocab
 from tensor2tensor.data_generators import tokenizer
 
 import tensorflow as tf
@@ -75,6 +78,44 @@ else:  # No conversion required on Python >= 3.
     return s
 
 
+# Encoder used by the worker processes of TextEncoder.encode_batch and
+# TextEncoder.decode_batch. Each worker receives its copy once, at startup.
+_worker_encoder = None
+
+
+def _init_batch_worker(encoder):
+  global _worker_encoder
+  _worker_encoder = encoder
+
+
+def _encode_in_worker(s):
+  return _worker_encoder.encode(s)
+
+
+def _decode_in_worker(ids):
+  return _worker_encoder.decode(ids)
+
+
+# Escaped token counts and maximum subtoken length used by the worker
+# processes of _SubwordVocabBuilder. Each worker receives them once, at startup.
+_worker_escaped_token_counts = None
+_worker_max_subtoken_length = None
+
+
+def _init_count_worker(escaped_token_counts, max_subtoken_length):
+  global _worker_escaped_token_counts, _worker_max_subtoken_length
+  _worker_escaped_token_counts = escaped_token_counts
+  _worker_max_subtoken_length = max_subtoken_length
+
+
+def _count_subtokens_in_worker(args):
+  encoder, shard, num_shards = args
+  return _count_subtokens(
+      encoder,
+      _worker_escaped_token_counts.iteritems_of_shard(shard, num_shards),
+      _worker_max_subtoken_length)
+
+
 class TextEncoder(object):
   """Base class for converting from ints to/from human readable strings."""
 
@@ -101,6 +142,22 @@ class TextEncoder(object):
     """
     return [int(w) + self._num_reserved_ids for w in s.split()]
 
+  def encode_stream(self, chunks):
+    """Transform text that arrives in pieces into a stream of int ids.
+
+    Yields the same ids as encode() of the concatenated pieces. This default
+    joins the pieces; subclasses that can encode them incrementally override
+    it so that the whole text is never held in memory.
+
+    Args:
+      chunks: iterable of human-readable strings.
+
+    Yields:
+      integers
+    """
+    for id_ in self.encode("".join(chunks)):
+      yield id_
+
   def decode(self, ids):
     """Transform a sequence of int ids into a human-readable string.
 
@@ -135,6 +192,77 @@ class TextEncoder(object):
         decoded_ids.append(id_ - self._num_reserved_ids)
     return [str(d) for d in decoded_ids]
 
+  def encode_batch(self, strings, num_processes=None):
+    """Transform a batch of human-readable strings into sequences of int ids.
+
+    Args:
+      strings: iterable of human-readable strings to be converted.
+      num_processes: If greater than 1, encode in a pool of this many worker
+        processes. Each worker receives a copy of this encoder once.
+
+    Returns:
+      ids: list of lists of integers, in the same order as strings.
+    """
+    return self._map_batch(self.encode, _encode_in_worker, strings,
+                           num_processes)
+
+  def encode_batches(self, batches, num_processes=None):
+    """Like encode_batch, for a stream of batches.
+
+    With num_processes, one pool of workers encodes all the batches, and only
+    one batch is in memory at a time.
+
+    Args:
+      batches: iterable of lists of human-readable strings.
+      num_processes: If greater than 1, encode in a pool of this many worker
+        processes. Each worker receives a copy of this encoder once.
+
+    Yields:
+      for each batch, a list of lists of integers, in the same order as its
+      strings.
+    """
+    return self._map_batches(self.encode, _encode_in_worker, batches,
+                             num_processes)
+
+  def decode_batch(self, ids_batch, num_processes=None):
+    """Transform a batch of int id sequences into human-readable strings.
+
+    Args:
+      ids_batch: iterable of lists of integers to be converted.
+      num_processes: If greater than 1, decode in a pool of this many worker
+        processes. Each worker receives a copy of this encoder once.
+
+    Returns:
+      strs: list of human-readable strings, in the same order as ids_batch.
+    """
+    return self._map_batch(self.decode, _decode_in_worker, ids_batch,
+                           num_processes)
+
+  def _map_batch(self, fn, worker_fn, items, num_processes):
+    """Applies fn to every item, optionally in a pool of processes."""
+    return list(self._map_batches(fn, worker_fn, [items], num_processes))[0]
+
+  def _map_batches(self, fn, worker_fn, batches, num_processes):
+    """Applies fn to every item of every batch, optionally in one pool."""
+    if multiprocessing.current_process().daemon:
+      # Already in a worker of a pool, e.g. one of t2t-datagen's; daemonic
+      # processes cannot start pools of their own.
+      num_processes = 1
+    if not num_processes or num_processes <= 1:
+      for items in batches:
+        yield [fn(item) for item in items]
+      return
+    pool = multiprocessing.Pool(processes=num_processes,
+                                initializer=_init_batch_worker,
+                                initargs=(self,))
+    try:
+      for items in batches:
+        # Pool.map returns the results in the order of the inputs.
+        yield pool.map(worker_fn, items)
+    finally:
+      pool.terminate()
+      pool.join()
+
   @property
   def vocab_size(self):
     raise NotImplementedError()
@@ -152,6 +280,12 @@ class ByteTextEncoder(TextEncoder):
     # Python3: explicitly convert to UTF-8
     return [c + numres for c in s.encode("utf-8")]
 
+  def encode_stream(self, chunks):
+    # The bytes of a concatenation are the concatenation of the bytes.
+    for chunk in chunks:
+      for id_ in self.encode(chunk):
+        yield id_
+
   def decode(self, ids):
     numres = self._num_reserved_ids
     decoded_ids = []
@@ -275,8 +409,15 @@ class TokenTextEncoder(TextEncoder):
     """Load vocab from a file.
 
     Args:
-      filename: The file to load vocabulary from.
+      filename: The file to load vocabulary from. It can be a text file or a
+        binary vocab file written by store_to_binary_file.
     """
+    if mapped_vocab.is_mapped_vocab_file(filename):
+      vocab = mapped_vocab.MappedVocab(filename)
+      self._id_to_token = vocab.id_to_string
+      self._token_to_id = vocab.string_to_id
+      return
+
     def token_gen():
       with tf.gfile.Open(filename) as f:
         for line in f:
@@ -331,6 +472,68 @@ class TokenTextEncoder(TextEncoder):
       for i in xrange(len(self._id_to_token)):
         f.write(self._id_to_token[i] + "\n")
 
+  def store_to_binary_file(self, filename):
+    """Write a binary vocab file, which loads faster than a text one.
+
+    Args:
+      filename: Full path of the file to store the vocab to.
+    """
+    mapped_vocab.write_mapped_vocab(
+        filename, [native_to_unicode(self._id_to_token[i])
+                   for i in xrange(len(self._id_to_token))])
+
+
+class LRUCache(object):
+  """A bounded mapping that evicts the least recently used entry.
+
+  Hit, miss and eviction counters are kept so that the capacity can be sized
+  for a given corpus.
+  """
+
+  def __init__(self, capacity):
+    self._capacity = capacity
+    self._entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @property
+  def capacity(self):
+    return self._capacity
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    """Returns the value cached for key, or None if it is not cached."""
+    value = self._entries.pop(key, None)
+    if value is None:
+      self.misses += 1
+      return None
+    # Re-inserting moves the entry to the most recently used end.
+    self._entries[key] = value
+    self.hits += 1
+    return value
+
+  def put(self, key, value):
+    """Caches a non-None value, evicting the least recently used entry."""
+    self._entries[key] = value
+    if len(self._entries) > self._capacity:
+      self._entries.popitem(last=False)
+      self.evictions += 1
+
+  def stats(self):
+    """Returns a dictionary of the cache counters."""
+    lookups = self.hits + self.misses
+    return {
+        "capacity": self._capacity,
+        "size": len(self._entries),
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+    }
+
 
 def _escape_token(token, alphabet):
   """Escape away underscores and OOV characters and append '_'.
@@ -413,14 +616,16 @@ class SubwordTextEncoder(TextEncoder):
 
   """
 
-  def __init__(self, filename=None):
+  def __init__(self, filename=None, cache_size=2**20):
     """Initialize and read from a file, if provided.
 
     Args:
       filename: filename from which to read vocab. If None, do not load a
         vocab
+      cache_size: maximum number of tokens whose subtoken ids are cached.
     """
     self._alphabet = set()
+    self._cache_size = cache_size
     if filename is not None:
       self._load_from_file(filename)
     super(SubwordTextEncoder, self).__init__(num_reserved_ids=None)
@@ -436,6 +641,22 @@ class SubwordTextEncoder(TextEncoder):
     return self._tokens_to_subtoken_ids(
         tokenizer.encode(native_to_unicode(raw_text)))
 
+  def encode_stream(self, chunks):
+    """Converts native strings that arrive in pieces to subtoken ids.
+
+    Tokens that straddle two pieces are encoded as if the pieces were one
+    string; see tokenizer.encode_stream().
+
+    Args:
+      chunks: an iterable of native strings.
+    Yields:
+      integers in the range [0, vocab_size)
+    """
+    for token in tokenizer.encode_stream(
+        native_to_unicode(chunk) for chunk in chunks):
+      for subtoken_id in self._token_to_subtoken_ids(token):
+        yield subtoken_id
+
   def encode_without_tokenizing(self, token_text):
     """Converts string to list of subtoken ids without calling tokenizer.
 
@@ -461,8 +682,29 @@ class SubwordTextEncoder(TextEncoder):
     Returns:
       a native string
     """
-    return unicode_to_native(
-        tokenizer.decode(self._subtoken_ids_to_tokens(subtokens)))
+    if self._decode_table is None:
+      self._init_decode_table()
+    text = self._fast_decode(subtokens)
+    if text is None:
+      text = tokenizer.decode(self._subtoken_ids_to_tokens(subtokens))
+    return unicode_to_native(text)
+
+  def decode_batch(self, ids_batch, num_processes=None):
+    """Transform a batch of subtoken id sequences into native strings.
+
+    Args:
+      ids_batch: iterable of lists of integers in the range [0, vocab_size).
+      num_processes: If greater than 1, decode in a pool of this many worker
+        processes. Each worker receives a copy of this encoder once.
+
+    Returns:
+      a list of native strings, in the same order as ids_batch.
+    """
+    # Build the table before the encoder is copied to any workers.
+    if self._decode_table is None:
+      self._init_decode_table()
+    return super(SubwordTextEncoder, self).decode_batch(
+        ids_batch, num_processes=num_processes)
 
   def decode_list(self, subtokens):
     return [self._subtoken_id_to_subtoken_string(s) for s in subtokens]
@@ -472,6 +714,20 @@ class SubwordTextEncoder(TextEncoder):
     """The subtoken vocabulary size."""
     return len(self._all_subtoken_strings)
 
+  @property
+  def cache_stats(self):
+    """Counters of the token cache; see LRUCache.stats()."""
+    return self._cache.stats()
+
+  def __getstate__(self):
+    # The trie and the cache are rebuilt on demand, so worker processes do not
+    # need to receive them.
+    state = self.__dict__.copy()
+    if "_cache" in state:
+      state["_subtoken_trie"] = None
+      state["_cache"] = LRUCache(self._cache_size)
+    return state
+
   def _tokens_to_subtoken_ids(self, tokens):
     """Converts a list of tokens to a list of subtoken ids.
 
@@ -493,13 +749,11 @@ class SubwordTextEncoder(TextEncoder):
     Returns:
       a list of integers in the range [0, vocab_size)
     """
-    cache_location = hash(token) % self._cache_size
-    cache_key, cache_value = self._cache[cache_location]
-    if cache_key == token:
-      return cache_value
-    ret = self._escaped_token_to_subtoken_ids(
-        _escape_token(token, self._alphabet))
-    self._cache[cache_location] = (token, ret)
+    ret = self._cache.get(token)
+    if ret is None:
+      ret = self._escaped_token_to_subtoken_ids(
+          _escape_token(token, self._alphabet))
+      self._cache.put(token, ret)
     return ret
 
   def _subtoken_ids_to_tokens(self, subtokens):
@@ -521,6 +775,71 @@ class SubwordTextEncoder(TextEncoder):
           ret.append(unescaped)
     return ret
 
+  def _init_decode_table(self):
+    """Precomputes what decoding needs to know about every subtoken.
+
+    For each subtoken id the table holds a `(surface, ends_token,
+    starts_alnum)` tuple: the unescaped text of the subtoken, whether it ends
+    a token, and whether that text starts with an alphanumeric character.
+
+    Escape sequences may span several subtokens, e.g. "\\12" and "3;". The
+    entry is None for subtokens with such an incomplete escape sequence, and
+    for the subtokens with an underscore before their end; _fast_decode gives
+    up on those.
+    """
+    # pylint: disable=protected-access
+    alphanumeric_char_set = tokenizer._alphanumeric_char_set()
+    # pylint: enable=protected-access
+    self._decode_table = []
+    for subtoken_string in self._all_subtoken_strings:
+      ends_token = subtoken_string.endswith(u"_")
+      escaped = subtoken_string[:-1] if ends_token else subtoken_string
+      if u"_" in escaped or u"\\" in _UNESCAPE_REGEX.sub(u"", escaped):
+        self._decode_table.append(None)
+        continue
+      surface = _unescape_token(escaped)
+      self._decode_table.append(
+          (surface, ends_token,
+           bool(surface) and surface[0] in alphanumeric_char_set))
+
+  def _fast_decode(self, subtokens):
+    """Decodes subtoken ids without the regex of _unescape_token.
+
+    Does what tokenizer.decode(self._subtoken_ids_to_tokens(subtokens)) does:
+    a space goes between two consecutive tokens that both start with an
+    alphanumeric character.
+
+    Args:
+      subtokens: a list of integers.
+    Returns:
+      a unicode string, or None if one of the subtokens has no entry in the
+      decode table.
+    """
+    decode_table = self._decode_table
+    vocab_size = len(decode_table)
+    pieces = []
+    # Whether the last non-empty token and the current one, if it is not empty
+    # so far, start with an alphanumeric character.
+    last_token_alnum = False
+    token_alnum = None
+    for subtoken in subtokens:
+      if not 0 <= subtoken < vocab_size:
+        continue
+      entry = decode_table[subtoken]
+      if entry is None:
+        return None
+      surface, ends_token, starts_alnum = entry
+      if surface:
+        if token_alnum is None:
+          token_alnum = starts_alnum
+          if last_token_alnum and token_alnum:
+            pieces.append(u" ")
+        pieces.append(surface)
+      if ends_token and token_alnum is not None:
+        last_token_alnum = token_alnum
+        token_alnum = None
+    return u"".join(pieces)
+
   def _subtoken_id_to_subtoken_string(self, subtoken):
     """Converts a subtoken integer ID to a subtoken string."""
     if 0 <= subtoken < self.vocab_size:
@@ -535,27 +854,10 @@ class SubwordTextEncoder(TextEncoder):
     Returns:
       A list of subtokens as unicode strings.
     """
-    # NOTE: This algorithm is greedy; it won't necessarily produce the "best"
-    # list of subtokens.
-    ret = []
-    start = 0
-    token_len = len(escaped_token)
-    while start < token_len:
-      for end in xrange(
-          min(token_len, start + self._max_subtoken_len), start, -1):
-        subtoken = escaped_token[start:end]
-        if subtoken in self._subtoken_string_to_id:
-          ret.append(subtoken)
-          start = end
-          break
-
-      else:  # Did not break
-        # If there is no possible encoding of the escaped token then one of the
-        # characters in the token is not in the alphabet. This should be
-        # impossible and would be indicative of a bug.
-        assert False, "Token substring not found in subtoken vocabulary."
-
-    return ret
+    return [
+        self._all_subtoken_strings[subtoken_id]
+        for subtoken_id in self._escaped_token_to_subtoken_ids(escaped_token)
+    ]
 
   def _escaped_token_to_subtoken_ids(self, escaped_token):
     """Converts an escaped token string to a list of subtoken IDs.
@@ -565,10 +867,36 @@ class SubwordTextEncoder(TextEncoder):
     Returns:
       A list of subtoken IDs as integers.
     """
-    return [
-        self._subtoken_string_to_id[subtoken]
-        for subtoken in self._escaped_token_to_subtoken_strings(escaped_token)
-    ]
+    # NOTE: This algorithm is greedy; it won't necessarily produce the "best"
+    # list of subtokens.  At each position we walk the prefix trie as far as
+    # the token allows and keep the longest subtoken seen along the way.
+    ret = []
+    start = 0
+    token_len = len(escaped_token)
+    if self._subtoken_trie is None:
+      self._init_subtoken_trie()
+    trie = self._subtoken_trie
+    while start < token_len:
+      node = trie
+      match_id = None
+      match_end = start
+      for end in xrange(start, token_len):
+        entry = node.get(escaped_token[end])
+        if entry is None:
+          break
+        subtoken_id, node = entry
+        if subtoken_id is not None:
+          match_id = subtoken_id
+          match_end = end + 1
+      # If there is no possible encoding of the escaped token then one of the
+      # characters in the token is not in the alphabet. This should be
+      # impossible and would be indicative of a bug.
+      assert match_id is not None, (
+          "Token substring not found in subtoken vocabulary.")
+      ret.append(match_id)
+      start = match_end
+
+    return ret
 
   @classmethod
   def build_to_target_size(cls,
@@ -578,7 +906,8 @@ class SubwordTextEncoder(TextEncoder):
                            max_val,
                            max_subtoken_length=None,
                            reserved_tokens=None,
-                           num_iterations=4):
+                           num_iterations=4,
+                           num_processes=None):
     """Builds a SubwordTextEncoder that has `vocab_size` near `target_size`.
 
     Uses simple recursive binary search to find a minimum token count that most
@@ -597,6 +926,8 @@ class SubwordTextEncoder(TextEncoder):
         `RESERVED_TOKENS` must be a prefix of `reserved_tokens`. If this
         argument is `None`, it will use `RESERVED_TOKENS`.
       num_iterations: An integer; how many iterations of refinement.
+      num_processes: If greater than 1, count substrings in a pool of this
+        many worker processes. The vocabulary does not depend on it.
 
     Returns:
       A SubwordTextEncoder instance.
@@ -610,18 +941,19 @@ class SubwordTextEncoder(TextEncoder):
     if target_size < 1:
       raise ValueError("Target size must be positive.")
 
-    if reserved_tokens is None:
-      reserved_tokens = RESERVED_TOKENS
+    # Everything that does not depend on min_count is computed once here and
+    # shared by all the probes of the bisection.
+    builder = _SubwordVocabBuilder(token_counts,
+                                   reserved_tokens=reserved_tokens,
+                                   max_subtoken_length=max_subtoken_length,
+                                   num_processes=num_processes)
 
     def bisect(min_val, max_val):
       """Bisection to find the right size."""
       present_count = (max_val + min_val) // 2
       tf.logging.info("Trying min_count %d" % present_count)
       subtokenizer = cls()
-      subtokenizer.build_from_token_counts(
-          token_counts, present_count, num_iterations,
-          max_subtoken_length=max_subtoken_length,
-          reserved_tokens=reserved_tokens)
+      builder.build(subtokenizer, present_count, num_iterations)
 
       # Being within 1% of the target size is ok.
       is_ok = abs(subtokenizer.vocab_size - target_size) * 100 < target_size
@@ -642,14 +974,18 @@ class SubwordTextEncoder(TextEncoder):
         return other_subtokenizer
       return subtokenizer
 
-    return bisect(min_val, max_val)
+    try:
+      return bisect(min_val, max_val)
+    finally:
+      builder.close()
 
   def build_from_token_counts(self,
                               token_counts,
                               min_count,
                               num_iterations=4,
                               reserved_tokens=None,
-                              max_subtoken_length=None):
+                              max_subtoken_length=None,
+                              num_processes=None):
     """Train a SubwordTextEncoder based on a dictionary of word counts.
 
     Args:
@@ -663,94 +999,22 @@ class SubwordTextEncoder(TextEncoder):
         then the runtime and memory use of creating the vocab is quadratic in
         the length of the longest token. If this is set, then it is instead
         O(max_subtoken_length * length of longest token).
+      num_processes: If greater than 1, count substrings in a pool of this
+        many worker processes. The vocabulary does not depend on it.
 
     Raises:
       ValueError: if reserved is not 0 or len(RESERVED_TOKENS). In this case, it
         is not clear what the space is being reserved for, or when it will be
         filled in.
     """
-    if reserved_tokens is None:
-      reserved_tokens = RESERVED_TOKENS
-    else:
-      # There is not complete freedom in replacing RESERVED_TOKENS.
-      for default, proposed in zip(RESERVED_TOKENS, reserved_tokens):
-        if default != proposed:
-          raise ValueError("RESERVED_TOKENS must be a prefix of "
-                           "reserved_tokens.")
-
-    # Initialize the alphabet. Note, this must include reserved tokens or it can
-    # result in encoding failures.
-    alphabet_tokens = chain(six.iterkeys(token_counts),
-                            [native_to_unicode(t) for t in reserved_tokens])
-
-    self._init_alphabet_from_tokens(alphabet_tokens)
-
-    # Bootstrap the initial list of subtokens with the characters from the
-    # alphabet plus the escaping characters.
-    self._init_subtokens_from_list(list(self._alphabet),
-                                   reserved_tokens=reserved_tokens)
-
-    # We build iteratively.  On each iteration, we segment all the words,
-    # then count the resulting potential subtokens, keeping the ones
-    # with high enough counts for our new vocabulary.
-    if min_count < 1:
-      min_count = 1
-    for i in xrange(num_iterations):
-      tf.logging.info("Iteration {0}".format(i))
-
-      # Collect all substrings of the encoded token that break along current
-      # subtoken boundaries.
-      subtoken_counts = collections.defaultdict(int)
-      for token, count in six.iteritems(token_counts):
-        escaped_token = _escape_token(token, self._alphabet)
-        subtokens = self._escaped_token_to_subtoken_strings(escaped_token)
-        start = 0
-        for subtoken in subtokens:
-          last_position = len(escaped_token) + 1
-          if max_subtoken_length is not None:
-            last_position = min(last_position, start + max_subtoken_length)
-
-          for end in xrange(start + 1, last_position):
-            new_subtoken = escaped_token[start:end]
-            subtoken_counts[new_subtoken] += count
-          start += len(subtoken)
-
-      # Array of sets of candidate subtoken strings, by length.
-      len_to_subtoken_strings = []
-      for subtoken_string, count in six.iteritems(subtoken_counts):
-        lsub = len(subtoken_string)
-        if count >= min_count:
-          while len(len_to_subtoken_strings) <= lsub:
-            len_to_subtoken_strings.append(set())
-          len_to_subtoken_strings[lsub].add(subtoken_string)
-
-      # Consider the candidates longest to shortest, so that if we accept
-      # a longer subtoken string, we can decrement the counts of its prefixes.
-      new_subtoken_strings = []
-      for lsub in xrange(len(len_to_subtoken_strings) - 1, 0, -1):
-        subtoken_strings = len_to_subtoken_strings[lsub]
-        for subtoken_string in subtoken_strings:
-          count = subtoken_counts[subtoken_string]
-          if count >= min_count:
-            # Exclude alphabet tokens here, as they must be included later,
-            # explicitly, regardless of count.
-            if subtoken_string not in self._alphabet:
-              new_subtoken_strings.append((count, subtoken_string))
-            for l in xrange(1, lsub):
-              subtoken_counts[subtoken_string[:l]] -= count
-
-      # Include the alphabet explicitly to guarantee all strings are encodable.
-      new_subtoken_strings.extend((subtoken_counts.get(a, 0), a)
-                                  for a in self._alphabet)
-      new_subtoken_strings.sort(reverse=True)
-
-      # Reinitialize to the candidate vocabulary.
-      new_subtoken_strings = [subtoken for _, subtoken in new_subtoken_strings]
-      if reserved_tokens:
-        new_subtoken_strings = reserved_tokens + new_subtoken_strings
-
-      self._init_subtokens_from_list(new_subtoken_strings)
-      tf.logging.info("vocab_size = %d" % self.vocab_size)
+    builder = _SubwordVocabBuilder(token_counts,
+                                   reserved_tokens=reserved_tokens,
+                                   max_subtoken_length=max_subtoken_length,
+                                   num_processes=num_processes)
+    try:
+      builder.build(self, min_count, num_iterations)
+    finally:
+      builder.close()
 
   @property
   def all_subtoken_strings(self):
@@ -792,9 +1056,31 @@ class SubwordTextEncoder(TextEncoder):
         s: i + len(reserved_tokens)
         for i, s in enumerate(subtoken_strings) if s
     }
+    # The segmentation trie is built lazily on first use, so that processes
+    # which only decode do not pay for it. Likewise for the decode table.
+    self._subtoken_trie = None
+    self._decode_table = None
     # Initialize the cache to empty.
-    self._cache_size = 2 ** 20
-    self._cache = [(None, None)] * self._cache_size
+    self._cache = LRUCache(self._cache_size)
+
+  def _init_subtoken_trie(self):
+    """Builds the prefix trie used for greedy longest-match segmentation.
+
+    Each node maps a character to a `[subtoken_id, children]` pair, where
+    `subtoken_id` is None if the path to this node is not itself a subtoken.
+    """
+    self._subtoken_trie = {}
+    for subtoken_string, subtoken_id in six.iteritems(
+        self._subtoken_string_to_id):
+      if not subtoken_string:
+        continue
+      node = self._subtoken_trie
+      for c in subtoken_string:
+        entry = node.get(c)
+        if entry is None:
+          entry = node[c] = [None, {}]
+        node = entry[1]
+      entry[0] = subtoken_id
 
   def _init_alphabet_from_tokens(self, tokens):
     """Initialize alphabet from an iterable of token or subtoken strings."""
@@ -820,12 +1106,30 @@ class SubwordTextEncoder(TextEncoder):
     self._init_subtokens_from_list(subtoken_strings)
     self._init_alphabet_from_tokens(subtoken_strings)
 
+  def _load_from_mapped_vocab(self, vocab):
+    """Load from a MappedVocab, without copying the subtoken strings.
+
+    Args:
+      vocab: a mapped_vocab.MappedVocab
+    """
+    self._all_subtoken_strings = vocab.id_to_string
+    self._subtoken_string_to_id = vocab.string_to_id
+    self._max_subtoken_len = vocab.max_string_length
+    self._subtoken_trie = None
+    self._decode_table = None
+    self._cache = LRUCache(self._cache_size)
+    self._alphabet = vocab.chars() | _ESCAPE_CHARS
+
   def _load_from_file(self, filename):
     """Load from a file.
 
     Args:
-      filename: Filename to load vocabulary from
+      filename: Filename to load vocabulary from. It can be a text file or a
+        binary vocab file written by store_to_binary_file.
     """
+    if mapped_vocab.is_mapped_vocab_file(filename):
+      self._load_from_mapped_vocab(mapped_vocab.MappedVocab(filename))
+      return
     with tf.gfile.Open(filename) as f:
       self._load_from_file_object(f)
 
@@ -837,6 +1141,239 @@ class SubwordTextEncoder(TextEncoder):
         else:
           f.write(unicode_to_native(subtoken_string) + "\n")
 
+  def store_to_binary_file(self, filename):
+    """Write a binary vocab file, which loads faster than a text one.
+
+    Args:
+      filename: Full path of the file to store the vocab to.
+    """
+    mapped_vocab.write_mapped_vocab(filename, self._all_subtoken_strings,
+                                    index_empty=False)
+
+
+class _SubwordVocabBuilder(object):
+  """Builds SubwordTextEncoder vocabularies from one table of token counts.
+
+  Building a vocabulary starts from the alphabet, so the escaped tokens and
+  the substring counts of the first iteration do not depend on `min_count`.
+  They are computed once here and reused by every call to `build`, which is
+  what makes the bisection in `SubwordTextEncoder.build_to_target_size` cheap.
+
+  The escaped tokens and all substring counts are kept in CompactCounts
+  tables, and only the substrings that can be selected are put in a dict.
+  """
+
+  def __init__(self, token_counts, reserved_tokens=None,
+               max_subtoken_length=None, num_processes=None):
+    """Initialize and count the substrings of the first iteration.
+
+    Call close() when done with the builder.
+
+    Args:
+      token_counts: a dictionary of Unicode strings to int.
+      reserved_tokens: List of reserved tokens. The global variable
+        `RESERVED_TOKENS` must be a prefix of `reserved_tokens`. If this
+        argument is `None`, it will use `RESERVED_TOKENS`.
+      max_subtoken_length: Maximum length of a subtoken, or None.
+      num_processes: If greater than 1, count substrings in a pool of this
+        many worker processes, each of which counts a fixed shard of the
+        tokens.
+
+    Raises:
+      ValueError: if `RESERVED_TOKENS` is not a prefix of `reserved_tokens`.
+    """
+    if reserved_tokens is None:
+      reserved_tokens = RESERVED_TOKENS
+    else:
+      # There is not complete freedom in replacing RESERVED_TOKENS.
+      for default, proposed in zip(RESERVED_TOKENS, reserved_tokens):
+        if default != proposed:
+          raise ValueError("RESERVED_TOKENS must be a prefix of "
+                           "reserved_tokens.")
+    self._reserved_tokens = reserved_tokens
+    self._max_subtoken_length = max_subtoken_length
+
+    # Initialize the alphabet. Note, this must include reserved tokens or it can
+    # result in encoding failures.
+    alphabet_tokens = chain(six.iterkeys(token_counts),
+                            [native_to_unicode(t) for t in reserved_tokens])
+    initial_encoder = SubwordTextEncoder()
+    initial_encoder._init_alphabet_from_tokens(alphabet_tokens)
+    self._alphabet = initial_encoder._alphabet
+    self._init_encoder(initial_encoder)
+
+    counter = compact_counts.CompactCounter()
+    escaped_token_counts = counter.counts
+    for token, count in six.iteritems(token_counts):
+      escaped_token_counts[_escape_token(token, self._alphabet)] += count
+      counter.maybe_flush()
+    self._escaped_token_counts = counter.compact()
+
+    self._pool = None
+    self._num_processes = num_processes
+    if num_processes and num_processes > 1:
+      self._pool = multiprocessing.Pool(
+          processes=num_processes, initializer=_init_count_worker,
+          initargs=(self._escaped_token_counts, max_subtoken_length))
+    try:
+      self._initial_subtoken_counts = self._count_subtokens(initial_encoder)
+    except:  # pylint: disable=bare-except
+      self.close()
+      raise
+
+  def close(self):
+    """Stop the worker processes, if any."""
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool.join()
+      self._pool = None
+
+  def _init_encoder(self, encoder):
+    encoder._alphabet = set(self._alphabet)
+    # Bootstrap the initial list of subtokens with the characters from the
+    # alphabet plus the escaping characters.
+    encoder._init_subtokens_from_list(list(self._alphabet),
+                                      reserved_tokens=self._reserved_tokens)
+
+  def build(self, encoder, min_count, num_iterations=4):
+    """Train `encoder` on the token counts.
+
+    Args:
+      encoder: a SubwordTextEncoder; its vocabulary is replaced.
+      min_count: an integer - discard subtokens with lower counts.
+      num_iterations: an integer.  how many iterations of refinement.
+    """
+    self._init_encoder(encoder)
+
+    # We build iteratively.  On each iteration, we segment all the words,
+    # then count the resulting potential subtokens, keeping the ones
+    # with high enough counts for our new vocabulary.
+    if min_count < 1:
+      min_count = 1
+    for i in xrange(num_iterations):
+      tf.logging.info("Iteration {0}".format(i))
+      if i == 0:
+        all_counts = self._initial_subtoken_counts
+      else:
+        all_counts = self._count_subtokens(encoder)
+      subtoken_counts = self._candidate_counts(all_counts, min_count)
+      del all_counts
+      encoder._init_subtokens_from_list(
+          self._select_subtokens(subtoken_counts, min_count))
+      tf.logging.info("vocab_size = %d" % encoder.vocab_size)
+
+  def _candidate_counts(self, all_counts, min_count):
+    """Returns the counts that _select_subtokens can use.
+
+    A prefix is counted wherever the longer substring is, so the prefixes of
+    a candidate are candidates too. The substrings with lower counts are never
+    selected nor decremented, and only the alphabet needs their counts.
+
+    Args:
+      all_counts: a CompactCounts of all substrings.
+      min_count: an integer - discard subtokens with lower counts.
+
+    Returns:
+      a dictionary of substrings to counts.
+    """
+    subtoken_counts = dict(all_counts.iteritems(min_count))
+    for a in self._alphabet:
+      if a not in subtoken_counts:
+        subtoken_counts[a] = all_counts.get(a, 0)
+    return subtoken_counts
+
+  def _count_subtokens(self, encoder):
+    """Count the substrings of all escaped tokens, possibly in the pool.
+
+    Returns:
+      a CompactCounts.
+    """
+    if self._pool is None:
+      return _count_subtokens(encoder,
+                              six.iteritems(self._escaped_token_counts),
+                              self._max_subtoken_length)
+    # The shards are the same for every call, so each worker walks the same
+    # tokens; summing integer counts makes the result independent of the order
+    # in which the shards finish.
+    return compact_counts.merge(list(self._pool.imap_unordered(
+        _count_subtokens_in_worker,
+        [(encoder, shard, self._num_processes)
+         for shard in xrange(self._num_processes)])))
+
+  def _select_subtokens(self, subtoken_counts, min_count):
+    """Choose the next vocabulary from the substring counts.
+
+    Args:
+      subtoken_counts: a dictionary of substrings to counts. It is modified.
+      min_count: an integer - discard subtokens with lower counts.
+
+    Returns:
+      a list of subtoken strings, starting with the reserved tokens.
+    """
+    # Array of sets of candidate subtoken strings, by length.
+    len_to_subtoken_strings = []
+    for subtoken_string, count in six.iteritems(subtoken_counts):
+      lsub = len(subtoken_string)
+      if count >= min_count:
+        while len(len_to_subtoken_strings) <= lsub:
+          len_to_subtoken_strings.append(set())
+        len_to_subtoken_strings[lsub].add(subtoken_string)
+
+    # Consider the candidates longest to shortest, so that if we accept
+    # a longer subtoken string, we can decrement the counts of its prefixes.
+    new_subtoken_strings = []
+    for lsub in xrange(len(len_to_subtoken_strings) - 1, 0, -1):
+      subtoken_strings = len_to_subtoken_strings[lsub]
+      for subtoken_string in subtoken_strings:
+        count = subtoken_counts[subtoken_string]
+        if count >= min_count:
+          # Exclude alphabet tokens here, as they must be included later,
+          # explicitly, regardless of count.
+          if subtoken_string not in self._alphabet:
+            new_subtoken_strings.append((count, subtoken_string))
+          for l in xrange(1, lsub):
+            subtoken_counts[subtoken_string[:l]] -= count
+
+    # Include the alphabet explicitly to guarantee all strings are encodable.
+    new_subtoken_strings.extend((subtoken_counts.get(a, 0), a)
+                                for a in self._alphabet)
+    new_subtoken_strings.sort(reverse=True)
+
+    new_subtoken_strings = [subtoken for _, subtoken in new_subtoken_strings]
+    if self._reserved_tokens:
+      new_subtoken_strings = self._reserved_tokens + new_subtoken_strings
+    return new_subtoken_strings
+
+
+def _count_subtokens(encoder, escaped_token_counts, max_subtoken_length):
+  """Collect all substrings of the escaped tokens that break along current
+  subtoken boundaries.
+
+  Args:
+    encoder: a SubwordTextEncoder giving the current subtoken boundaries.
+    escaped_token_counts: an iterable of (escaped token, count) pairs.
+    max_subtoken_length: Maximum length of a subtoken, or None.
+
+  Returns:
+    a CompactCounts mapping substrings to their counts.
+  """
+  counter = compact_counts.CompactCounter()
+  subtoken_counts = counter.counts
+  for escaped_token, count in escaped_token_counts:
+    subtokens = encoder._escaped_token_to_subtoken_strings(escaped_token)
+    start = 0
+    for subtoken in subtokens:
+      last_position = len(escaped_token) + 1
+      if max_subtoken_length is not None:
+        last_position = min(last_position, start + max_subtoken_length)
+
+      for end in xrange(start + 1, last_position):
+        new_subtoken = escaped_token[start:end]
+        subtoken_counts[new_subtoken] += count
+      start += len(subtoken)
+    counter.maybe_flush()
+  return counter.compact()
+
 
 class ImageEncoder(object):
   """Encoder class for saving and loading images."""
@@ -0,0 +1,66 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+r"""Program to convert a text vocab file to a binary vocab file.
+
+Binary vocab files are memory-mapped when they are loaded, so they load much
+faster than text ones. SubwordTextEncoder and TokenTextEncoder accept either
+kind of file.
+
+Example usage:
+
+python data_generators/text_encoder_convert_vocab.py \
+    --vocab_filename=$DATA_DIR/vocab.ende.32768 \
+    --output_filename=$DATA_DIR/vocab.ende.32768.bin \
+    --encoder=subword \
+    --logtostderr
+
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+# Dependency imports
+
+from tensor2tensor.data_generators import text_encoder
+
+import tensorflow as tf
+
+tf.flags.DEFINE_string('vocab_filename', None, 'Text vocab file to convert.')
+tf.flags.DEFINE_string('output_filename', None,
+                       'Where to store the binary vocab file.')
+tf.flags.DEFINE_string('encoder', 'subword',
+                       'The encoder that reads the vocab file: "subword" or '
+                       '"token".')
+FLAGS = tf.flags.FLAGS
+
+
+def main(unused_argv):
+  if not FLAGS.vocab_filename or not FLAGS.output_filename:
+    raise ValueError('Must provide --vocab_filename and --output_filename')
+
+  if FLAGS.encoder == 'subword':
+    encoder = text_encoder.SubwordTextEncoder(FLAGS.vocab_filename)
+  elif FLAGS.encoder == 'token':
+    encoder = text_encoder.TokenTextEncoder(FLAGS.vocab_filename)
+  else:
+    raise ValueError('Unknown --encoder: %s' % FLAGS.encoder)
+  encoder.store_to_binary_file(FLAGS.output_filename)
+  tf.logging.info('Wrote %d entries to %s', encoder.vocab_size,
+                  FLAGS.output_filename)
+
+
+if __name__ == '__main__':
+  tf.app.run()
@@ -22,10 +22,12 @@ from __future__ import unicode_literals
 
 import collections
 import io
+import multiprocessing
 import os
 import random
 import shutil
 import string
+import time
 
 # Dependency imports
 import mock
@@ -33,6 +35,7 @@ import six
 from six.moves import xrange  # pylint: disable=redefined-builtin
 
 from tensor2tensor.data_generators import text_encoder
+from tensor2tensor.data_generators import tokenizer
 import tensorflow as tf
 
 
@@ -107,6 +110,58 @@ class TokenTextEncoderTest(tf.test.TestCase):
     # be unique.
     self.assertEqual(len(all_tokens), len(set(all_tokens)))
 
+  def test_encode_decode_batch(self):
+    corpus = "A B C D E F G H I J K L M N O P Q R S T U V W X Y Z"
+    encoder = text_encoder.TokenTextEncoder(None, vocab_list=corpus.split())
+    sentences = ["A B C", "Z", "", "M N O P"] * 5
+    expected_ids = [encoder.encode(s) for s in sentences]
+
+    self.assertEqual(expected_ids, encoder.encode_batch(sentences))
+    self.assertEqual(expected_ids,
+                     encoder.encode_batch(sentences, num_processes=2))
+    self.assertEqual(sentences,
+                     encoder.decode_batch(expected_ids, num_processes=2))
+
+    batches = [sentences[:7], sentences[7:], []]
+    for num_processes in [None, 2]:
+      self.assertEqual(
+          [expected_ids[:7], expected_ids[7:], []],
+          list(encoder.encode_batches(iter(batches), num_processes)))
+
+  def test_encode_batch_in_pool_worker(self):
+    corpus = "A B C D E F G H I J K L M N O P Q R S T U V W X Y Z"
+    encoder = text_encoder.TokenTextEncoder(None, vocab_list=corpus.split())
+    sentences = ["A B C", "Z", "M N O P"]
+    pool = multiprocessing.Pool(processes=1)
+    try:
+      # Daemonic workers cannot start pools, so this encodes in the worker.
+      self.assertEqual(
+          [encoder.encode(s) for s in sentences],
+          pool.apply(_encode_batch_with_pool, (encoder, sentences)))
+    finally:
+      pool.terminate()
+      pool.join()
+
+
+def _encode_batch_with_pool(encoder, sentences):
+  return encoder.encode_batch(sentences, num_processes=2)
+
+
+def _slice_segmentation(encoder, escaped_token):
+  """The previous segmentation, trying every length at every position."""
+  ret = []
+  start = 0
+  token_len = len(escaped_token)
+  while start < token_len:
+    for end in xrange(
+        min(token_len, start + encoder._max_subtoken_len), start, -1):
+      subtoken = escaped_token[start:end]
+      if subtoken in encoder._subtoken_string_to_id:
+        ret.append(encoder._subtoken_string_to_id[subtoken])
+        start = end
+        break
+  return ret
+
 
 class SubwordTextEncoderTest(tf.test.TestCase):
 
@@ -151,6 +206,116 @@ class SubwordTextEncoderTest(tf.test.TestCase):
     for a in alphabet:
       self.assertIn(a, encoder.all_subtoken_strings)
 
+  def test_encode_decode_batch(self):
+    corpus = "the quick brown fox jumps over the lazy dog"
+    token_counts = collections.Counter(corpus.split(" "))
+    encoder = text_encoder.SubwordTextEncoder.build_to_target_size(
+        100, token_counts, 2, 10)
+    sentences = [corpus, "The Dog", "", "foxes jumped"] * 5
+    expected_ids = [encoder.encode(s) for s in sentences]
+
+    self.assertEqual(expected_ids,
+                     encoder.encode_batch(sentences, num_processes=2))
+    self.assertEqual(sentences,
+                     encoder.decode_batch(expected_ids, num_processes=2))
+
+  def test_token_cache(self):
+    corpus = "the quick brown fox jumps over the lazy dog"
+    token_counts = collections.Counter(corpus.split(" "))
+    encoder = text_encoder.SubwordTextEncoder.build_to_target_size(
+        100, token_counts, 2, 10)
+    encoder._cache = text_encoder.LRUCache(2)
+
+    expected = encoder.encode(corpus)
+    # "the" is seen twice but evicted before it is seen again.
+    self.assertEqual({"capacity": 2, "size": 2, "hits": 0, "misses": 9,
+                      "evictions": 7, "hit_rate": 0.0}, encoder.cache_stats)
+    self.assertEqual(expected, encoder.encode(corpus))
+    self.assertEqual(expected, encoder.encode(corpus))
+
+    # "lazy" and "dog" are the two most recently used tokens.
+    encoder.encode("dog dog lazy")
+    stats = encoder.cache_stats
+    self.assertEqual(2, stats["size"])
+    self.assertEqual(3, stats["hits"])
+
+  def test_lru_cache_evicts_least_recently_used(self):
+    cache = text_encoder.LRUCache(2)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    self.assertEqual([1], cache.get("a"))
+    cache.put("c", [3])
+    self.assertIsNone(cache.get("b"))
+    self.assertEqual([1], cache.get("a"))
+    self.assertEqual([3], cache.get("c"))
+    self.assertEqual(3, cache.hits)
+    self.assertEqual(1, cache.misses)
+    self.assertEqual(1, cache.evictions)
+
+  def test_vocab_builder_is_reusable(self):
+    corpus = (
+        "This is a corpus of text that provides a bunch of tokens from which "
+        "to build a vocabulary. It will be used when strings are encoded "
+        "with a TextEncoder subclass. The encoder was coded by a coder.")
+    token_counts = collections.Counter(corpus.split(" "))
+    builder = text_encoder._SubwordVocabBuilder(token_counts,
+                                                max_subtoken_length=6)
+
+    # Builds that share the builder match independent builds from scratch.
+    for min_count in [1, 2, 3, 2]:
+      expected = text_encoder.SubwordTextEncoder()
+      expected.build_from_token_counts(token_counts, min_count,
+                                       max_subtoken_length=6)
+      encoder = text_encoder.SubwordTextEncoder()
+      builder.build(encoder, min_count)
+      self.assertEqual(expected.all_subtoken_strings,
+                       encoder.all_subtoken_strings)
+      self.assertEqual(corpus, encoder.decode(encoder.encode(corpus)))
+
+  def test_build_with_multiple_processes(self):
+    corpus = (
+        "This is a corpus of text that provides a bunch of tokens from which "
+        "to build a vocabulary. It will be used when strings are encoded "
+        "with a TextEncoder subclass. The encoder was coded by a coder.")
+    token_counts = collections.Counter(corpus.split(" "))
+
+    expected = text_encoder.SubwordTextEncoder.build_to_target_size(
+        50, token_counts, 1, 10)
+    encoder = text_encoder.SubwordTextEncoder.build_to_target_size(
+        50, token_counts, 1, 10, num_processes=3)
+    self.assertEqual(expected.all_subtoken_strings,
+                     encoder.all_subtoken_strings)
+
+  def test_fast_decode_matches_unescaping(self):
+    vocab_filename = os.path.join(
+        os.path.dirname(__file__), "..", "test_data", "vocab.ende.32768")
+    encoder = text_encoder.SubwordTextEncoder(vocab_filename)
+    texts = ["Hello world, this is a test.", "under_score and back\\slash",
+             "\U0001F638 cats  and   spaces ", "12 34 56", ""]
+    rng = random.Random(0)
+    id_lists = [encoder.encode(t) for t in texts]
+    id_lists += [[rng.randrange(-2, encoder.vocab_size + 2)
+                  for _ in xrange(rng.randint(0, 20))] for _ in xrange(200)]
+
+    for ids in id_lists:
+      expected = text_encoder.unicode_to_native(
+          tokenizer.decode(encoder._subtoken_ids_to_tokens(ids)))
+      self.assertEqual(expected, encoder.decode(ids))
+    self.assertEqual(texts, encoder.decode_batch(id_lists[:len(texts)]))
+
+  def test_encode_stream(self):
+    corpus = "the quick brown fox jumps over the lazy dog"
+    token_counts = collections.Counter(corpus.split(" "))
+    encoder = text_encoder.SubwordTextEncoder.build_to_target_size(
+        100, token_counts, 2, 10)
+    text = "the quick, brown foxes jumped  over the lazy dogs"
+    chunks = [text[i:i + 3] for i in xrange(0, len(text), 3)]
+    self.assertEqual(encoder.encode(text), list(encoder.encode_stream(chunks)))
+
+    byte_encoder = text_encoder.ByteTextEncoder()
+    self.assertEqual(byte_encoder.encode("\U0001F638 cat"),
+                     list(byte_encoder.encode_stream(["\U0001F638", " cat"])))
+
   def test_unicode(self):
     corpus = "Cat emoticons. \U0001F638 \U0001F639 \U0001F63A \U0001F63B"
     token_counts = collections.Counter(corpus.split(" "))
@@ -265,6 +430,23 @@ class SubwordTextEncoderTest(tf.test.TestCase):
     with self.assertRaises(AssertionError):
       encoder.encode(original)
 
+  def test_segmentation_matches_slicing(self):
+    encoder = text_encoder.SubwordTextEncoder()
+    # Tries along "abcd" and "abx" pass nodes that are not subtokens, so the
+    # longest match has to fall back to a shorter one.
+    subtokens = ["abcd", "abx", "bcd_", "a", "b", "c", "d", "x", "ab", "cd_",
+                 "_"] + list("\\;0123456789")
+    encoder._load_from_file_object(
+        io.StringIO("".join("'%s'\n" % s for s in subtokens)))
+    tokens = ["abcd", "abc", "abcx", "abxd", "bcd", "abcdabc", "dcba", "",
+              "c\u2603d", "\u2603", "ab\U0001F638x", "a\\b"]
+    for token in tokens:
+      escaped_token = text_encoder._escape_token(token, encoder._alphabet)
+      ids = encoder._escaped_token_to_subtoken_ids(escaped_token)
+      self.assertEqual(_slice_segmentation(encoder, escaped_token), ids)
+      self.assertEqual(escaped_token,
+                       "".join(encoder.all_subtoken_strings[i] for i in ids))
+
   def test_load_from_file(self):
     # Test a vocab file with words not wrapped with single quotes
     encoder = text_encoder.SubwordTextEncoder()
@@ -341,5 +523,81 @@ class SubwordTextEncoderTest(tf.test.TestCase):
     self.assertEqual(encoder._max_subtoken_len, new_encoder._max_subtoken_len)
 
 
+class SubwordTextEncoderBenchmark(tf.test.Benchmark):
+  """Benchmarks subword segmentation on the bundled en-de vocabulary.
+
+  Run with:
+    python text_encoder_test.py --benchmarks=SubwordTextEncoderBenchmark
+  """
+
+  _VOCAB_FILENAME = os.path.join(
+      os.path.dirname(__file__), "..", "test_data", "vocab.ende.32768")
+
+  def _random_tokens(self, encoder, num_tokens, seed=0):
+    # Glue random subtokens together so that the tokens look like the ones
+    # seen when encoding real text with this vocabulary.
+    rng = random.Random(seed)
+    subtoken_strings = encoder.all_subtoken_strings[
+        len(text_encoder.RESERVED_TOKENS):]
+    tokens = []
+    for _ in xrange(num_tokens):
+      pieces = [rng.choice(subtoken_strings) for _ in xrange(rng.randint(1, 3))]
+      tokens.append(text_encoder._unescape_token("".join(pieces)))
+    return [t for t in tokens if t]
+
+  def benchmark_segmentation(self):
+    encoder = text_encoder.SubwordTextEncoder(self._VOCAB_FILENAME)
+    escaped_tokens = [
+        text_encoder._escape_token(t, encoder._alphabet)
+        for t in self._random_tokens(encoder, 200000)]
+
+    start_time = time.time()
+    slice_ids = [_slice_segmentation(encoder, t) for t in escaped_tokens]
+    slice_time = time.time() - start_time
+
+    encoder._escaped_token_to_subtoken_ids(escaped_tokens[0])  # Build trie.
+    start_time = time.time()
+    trie_ids = [encoder._escaped_token_to_subtoken_ids(t)
+                for t in escaped_tokens]
+    trie_time = time.time() - start_time
+
+    assert slice_ids == trie_ids
+    self.report_benchmark(
+        iters=len(escaped_tokens),
+        wall_time=trie_time,
+        extras={"slice_tokens_per_sec": len(escaped_tokens) / slice_time,
+                "trie_tokens_per_sec": len(escaped_tokens) / trie_time})
+
+  def benchmark_decode(self):
+    encoder = text_encoder.SubwordTextEncoder(self._VOCAB_FILENAME)
+    # Sentences of whole words, like the outputs of a translation model.
+    words = [s[:-1] for s in encoder.all_subtoken_strings
+             if s.endswith("_") and "\\" not in s and len(s) > 1]
+    rng = random.Random(0)
+    id_lists = [
+        encoder.encode(" ".join(rng.choice(words) for _ in xrange(25)))
+        for _ in xrange(10000)]
+    # Both paths share the tokenizer tables; build them, and the decode table,
+    # before timing.
+    encoder.decode(id_lists[0])
+
+    start_time = time.time()
+    regex_texts = [
+        tokenizer.decode(encoder._subtoken_ids_to_tokens(ids))
+        for ids in id_lists]
+    regex_time = time.time() - start_time
+
+    start_time = time.time()
+    fast_texts = encoder.decode_batch(id_lists)
+    fast_time = time.time() - start_time
+
+    assert regex_texts == fast_texts
+    self.report_benchmark(
+        iters=len(id_lists),
+        wall_time=fast_time,
+        extras={"regex_sequences_per_sec": len(id_lists) / regex_time,
+                "fast_sequences_per_sec": len(id_lists) / fast_time})
+
+
 if __name__ == "__main__":
   tf.test.main()
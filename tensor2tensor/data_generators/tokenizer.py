@@ -45,24 +45,81 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
-import sys
-import unicodedata
+import multiprocessing
+import re
 
 # Dependency imports
 
 import six
 from six.moves import xrange  # pylint: disable=redefined-builtin
+from tensor2tensor.utils import unicode_tables
 import tensorflow as tf
 
 # Conversion between Unicode and UTF-8, if required (on Python2)
 _native_to_unicode = (lambda s: s.decode("utf-8")) if six.PY2 else (lambda s: s)
 
 
-# This set contains all letter and number characters.
-_ALPHANUMERIC_CHAR_SET = set(
-    six.unichr(i) for i in xrange(sys.maxunicode)
-    if (unicodedata.category(six.unichr(i)).startswith("L") or
-        unicodedata.category(six.unichr(i)).startswith("N")))
+def _char_set_to_regex_class(char_set):
+  """Returns the body of a regex character class matching char_set."""
+  code_points = sorted(ord(c) for c in char_set)
+  ranges = []
+  start = prev = code_points[0]
+  for code_point in code_points[1:]:
+    if code_point != prev + 1:
+      ranges.append((start, prev))
+      start = code_point
+    prev = code_point
+  ranges.append((start, prev))
+  return u"".join(
+      re.escape(six.unichr(lo)) + (u"-" + re.escape(six.unichr(hi))
+                                   if hi != lo else u"")
+      for lo, hi in ranges)
+
+
+def _token_regex(char_set):
+  """Regex whose findall() implements encode() for the given alphanumerics.
+
+  Each match captures a maximal run of alphanumeric or of non-alphanumeric
+  characters.  A single space between two alphanumeric runs is consumed by
+  the optional prefix of the next match but not captured, so it is dropped.
+
+  Args:
+    char_set: the set of alphanumeric characters.
+  Returns:
+    a compiled regex.
+  """
+  char_class = _char_set_to_regex_class(char_set)
+  return re.compile(u"(?:(?<=[%s]) (?=[%s]))?([%s]+|[^%s]+)" %
+                    (char_class, char_class, char_class, char_class))
+
+
+# The regex engine can only use its fast lookup table for character classes
+# that lie within the Basic Multilingual Plane, so text without astral
+# characters is split with a BMP-only pattern.
+_MAX_BMP_CHAR = six.unichr(0xFFFF)
+
+# The set of all letter and number characters, and the regexes built from it.
+# Building them scans all of Unicode, so it is done on first use; see
+# _init_alphanumeric_tables().
+_ALPHANUMERIC_CHAR_SET = None
+_TOKEN_RE = None
+_BMP_TOKEN_RE = None
+
+
+def _init_alphanumeric_tables():
+  global _ALPHANUMERIC_CHAR_SET, _TOKEN_RE, _BMP_TOKEN_RE
+  alphanumeric_chars = unicode_tables.chars_in_categories(("L", "N"))
+  _TOKEN_RE = _token_regex(alphanumeric_chars)
+  _BMP_TOKEN_RE = _token_regex(
+      set(c for c in alphanumeric_chars if c <= _MAX_BMP_CHAR))
+  _ALPHANUMERIC_CHAR_SET = set(alphanumeric_chars)
+
+
+def _alphanumeric_char_set():
+  """Returns the set of all letter and number characters."""
+  if _ALPHANUMERIC_CHAR_SET is None:
+    _init_alphanumeric_tables()
+  return _ALPHANUMERIC_CHAR_SET
 
 
 def encode(text):
@@ -75,19 +132,49 @@ def encode(text):
   """
   if not text:
     return []
-  ret = []
-  token_start = 0
-  # Classify each character in the input string
-  is_alnum = [c in _ALPHANUMERIC_CHAR_SET for c in text]
-  for pos in xrange(1, len(text)):
-    if is_alnum[pos] != is_alnum[pos - 1]:
-      token = text[token_start:pos]
-      if token != u" " or token_start == 0:
-        ret.append(token)
-      token_start = pos
-  final_token = text[token_start:]
-  ret.append(final_token)
-  return ret
+  if _ALPHANUMERIC_CHAR_SET is None:
+    _init_alphanumeric_tables()
+  # Classify and split the whole string in a single regex pass.
+  if max(text) <= _MAX_BMP_CHAR:
+    return _BMP_TOKEN_RE.findall(text)
+  return _TOKEN_RE.findall(text)
+
+
+def encode_stream(chunks):
+  """Encode unicode text that arrives in pieces as a stream of tokens.
+
+  Yields the same tokens as encode(u"".join(chunks)), without holding more
+  than a chunk and the last token of the previous chunk in memory.
+
+  Args:
+    chunks: an iterable of unicode strings
+  Yields:
+    tokens as Unicode strings
+  """
+  if _ALPHANUMERIC_CHAR_SET is None:
+    _init_alphanumeric_tables()
+  # The last token of a chunk may continue in the next one, so its text is
+  # carried over. It is preceded by one character of context, starting at
+  # `pos`, for the lookbehind that drops single spaces between words.
+  pending = u""
+  pos = 0
+  for chunk in chunks:
+    if not chunk:
+      continue
+    text = pending + chunk
+    token_re = _BMP_TOKEN_RE if max(text) <= _MAX_BMP_CHAR else _TOKEN_RE
+    last_match = None
+    for match in token_re.finditer(text, pos):
+      if last_match is not None:
+        yield last_match.group(1)
+      last_match = match
+    start = last_match.start()
+    pos = 1 if start > 0 else 0
+    pending = text[start - pos:]
+  if len(pending) > pos:
+    token_re = _BMP_TOKEN_RE if max(pending) <= _MAX_BMP_CHAR else _TOKEN_RE
+    for match in token_re.finditer(pending, pos):
+      yield match.group(1)
 
 
 def decode(tokens):
@@ -98,7 +185,8 @@ def decode(tokens):
   Returns:
     a unicode string
   """
-  token_is_alnum = [t[0] in _ALPHANUMERIC_CHAR_SET for t in tokens]
+  alphanumeric_char_set = _alphanumeric_char_set()
+  token_is_alnum = [t[0] in alphanumeric_char_set for t in tokens]
   ret = []
   for i, token in enumerate(tokens):
     if i > 0 and token_is_alnum[i - 1] and token_is_alnum[i]:
@@ -147,8 +235,159 @@ def _read_filepattern(filepattern, max_lines=None, split_on_newlines=True):
           yield f.read()
 
 
+# Files larger than this are split into byte ranges of about this size when
+# counting tokens in parallel with split_on_newlines=True.
+_MAX_BYTES_PER_TASK = 2**26
+
+
+def _file_tasks(filename, split_on_newlines):
+  """Splits a file into (filename, start, end) byte ranges for workers."""
+  size = tf.gfile.Stat(filename).length
+  if not split_on_newlines or size <= _MAX_BYTES_PER_TASK:
+    return [(filename, 0, size)]
+  return [(filename, start, min(start + _MAX_BYTES_PER_TASK, size))
+          for start in xrange(0, size, _MAX_BYTES_PER_TASK)]
+
+
+def _range_lines(f, start, end):
+  """Returns the lines of binary file f which start in [start, end).
+
+  Args:
+    f: a file opened in binary mode.
+    start: an integer byte offset.
+    end: an integer byte offset.
+  Returns:
+    a list of byte strings, without their trailing newlines.
+  """
+  # Also read the byte before the range, to know whether a line starts at
+  # start, and read on to the end of the last line starting in the range.
+  offset = max(start - 1, 0)
+  f.seek(offset)
+  data = f.read(end - offset)
+  if data and not data.endswith(b"\n"):
+    tail = []
+    while True:
+      block = f.read(2**16)
+      newline = block.find(b"\n")
+      if newline >= 0:
+        tail.append(block[:newline + 1])
+      else:
+        tail.append(block)
+      if not block or newline >= 0:
+        break
+    data += b"".join(tail)
+  if start > 0:
+    # Skip the line that started before this range.
+    first = data.find(b"\n") + 1
+    if not first:
+      return []
+    data = data[first:]
+  lines = data.split(b"\n")
+  if not lines[-1]:
+    lines.pop()
+  return lines
+
+
+def _count_lines_in_task(args):
+  """Returns the number of lines which start in the byte range of a task.
+
+  Counting stops once max_lines lines are found, so the result is only exact
+  when it is less than max_lines.
+  """
+  (filename, start, end), max_lines = args
+  if start >= end:
+    return 0
+  with tf.gfile.Open(filename, "rb") as f:
+    # A line starts at every position following a newline, except at the end
+    # of the file, so count the newlines in [start - 1, end - 1).
+    num_lines = 1 if start == 0 else 0
+    f.seek(max(start - 1, 0))
+    remaining = end - 1 - max(start - 1, 0)
+    while remaining > 0 and num_lines < max_lines:
+      block = f.read(min(remaining, 2**20))
+      if not block:
+        break
+      num_lines += block.count(b"\n")
+      remaining -= len(block)
+  return num_lines
+
+
+def _count_tokens_in_task(args):
+  """Counts the tokens of one task; the map step of corpus_token_counts."""
+  (filename, start, end), max_lines, split_on_newlines = args
+  counts = collections.Counter()
+  with tf.gfile.Open(filename, "rb") as f:
+    if split_on_newlines:
+      for i, line in enumerate(_range_lines(f, start, end)):
+        if max_lines is not None and i >= max_lines:
+          break
+        counts.update(encode(line.decode("utf-8").strip()))
+    else:
+      doc = f.read()
+      if max_lines is not None:
+        pos = 0
+        for _ in xrange(max_lines):
+          pos = doc.find(b"\n", pos) + 1
+          if not pos:
+            pos = len(doc)
+            break
+        doc = doc[:pos]
+      counts.update(encode(doc.decode("utf-8")))
+  return counts
+
+
+def _task_line_budgets(pool, tasks, corpus_max_lines, max_pending):
+  """Returns how many lines of each task a serial pass would read.
+
+  The lines of the tasks are counted in order, with at most max_pending
+  tasks in the pool at a time, and counting stops once corpus_max_lines is
+  used up. The list ends at the last task with lines left to read.
+  """
+  budgets = []
+  pending = collections.deque()
+  lines_left = corpus_max_lines
+  next_task = 0
+  while lines_left and (pending or next_task < len(tasks)):
+    while next_task < len(tasks) and len(pending) < max_pending:
+      pending.append(pool.apply_async(_count_lines_in_task,
+                                      ((tasks[next_task], lines_left),)))
+      next_task += 1
+    budgets.append(min(pending.popleft().get(), lines_left))
+    lines_left -= budgets[-1]
+  return budgets
+
+
+def _parallel_corpus_token_counts(
+    text_filepattern, corpus_max_lines, split_on_newlines, num_processes):
+  """Map-reduce implementation of corpus_token_counts."""
+  tasks = []
+  for filename in sorted(tf.gfile.Glob(text_filepattern)):
+    tasks.extend(_file_tasks(filename, split_on_newlines))
+  pool = multiprocessing.Pool(processes=num_processes)
+  try:
+    if corpus_max_lines:
+      # Give each task the share of the line budget that a serial pass over
+      # the files would have spent on it.
+      max_lines = _task_line_budgets(pool, tasks, corpus_max_lines,
+                                     num_processes)
+    else:
+      max_lines = [None] * len(tasks)
+    counts = collections.Counter()
+    for task_counts in pool.imap_unordered(
+        _count_tokens_in_task,
+        [(task, task_max_lines, split_on_newlines)
+         for task, task_max_lines in zip(tasks, max_lines)
+         if task_max_lines != 0]):
+      counts.update(task_counts)
+  finally:
+    pool.terminate()
+    pool.join()
+  return counts
+
+
 def corpus_token_counts(
-    text_filepattern, corpus_max_lines, split_on_newlines=True):
+    text_filepattern, corpus_max_lines, split_on_newlines=True,
+    num_processes=None):
   """Read the corpus and compute a dictionary of token counts.
 
   Args:
@@ -157,10 +396,18 @@ def corpus_token_counts(
     split_on_newlines: A boolean. If true, then split files by lines and strip
         leading and trailing whitespace from each line. Otherwise, treat each
         file as a single string.
+    num_processes: An optional integer. If greater than 1, the files (or byte
+        ranges of large files, if split_on_newlines) are counted in a pool of
+        this many processes and the partial counts are merged. The result is
+        the same as for a serial read, including the corpus_max_lines cutoff.
 
   Returns:
     a dictionary mapping token to count.
   """
+  if num_processes and num_processes > 1:
+    return _parallel_corpus_token_counts(
+        text_filepattern, corpus_max_lines, split_on_newlines, num_processes)
+
   counts = collections.Counter()
   for doc in _read_filepattern(
       text_filepattern,
@@ -22,9 +22,12 @@ from __future__ import print_function
 
 import os
 import random
+import sys
+import time
 
 # Dependency imports
 
+import mock
 import six
 from six.moves import xrange  # pylint: disable=redefined-builtin
 from tensor2tensor.data_generators import tokenizer
@@ -61,6 +64,41 @@ class TokenizerTest(tf.test.TestCase):
       s = u"".join(six.unichr(random.randint(0, 65535)) for _ in xrange(10))
       self.assertEqual(s, tokenizer.decode(tokenizer.encode(s)))
 
+  def test_encode_matches_character_classification(self):
+    for _ in xrange(1000):
+      max_code_point = random.choice([127, 65535, sys.maxunicode])
+      s = u"".join(random.choice([u" ", u"a", u"1", u".", u"\n"]) +
+                   six.unichr(random.randint(0, max_code_point))
+                   for _ in xrange(10))
+      self.assertListEqual(_classify_and_split(s), tokenizer.encode(s))
+
+  def test_encode_stream_matches_encode(self):
+    for _ in xrange(1000):
+      s = u"".join(random.choice([u" ", u"a", u"1", u".", u"\u00e9", u"\n"])
+                   for _ in xrange(20))
+      cuts = sorted(random.randint(0, len(s)) for _ in xrange(3))
+      chunks = [s[i:j] for i, j in zip([0] + cuts, cuts + [len(s)])]
+      self.assertListEqual(tokenizer.encode(s),
+                           list(tokenizer.encode_stream(chunks)))
+
+
+def _classify_and_split(text):
+  """Reference tokenizer classifying one character at a time."""
+  if not text:
+    return []
+  ret = []
+  token_start = 0
+  alphanumeric_char_set = tokenizer._alphanumeric_char_set()
+  is_alnum = [c in alphanumeric_char_set for c in text]
+  for pos in xrange(1, len(text)):
+    if is_alnum[pos] != is_alnum[pos - 1]:
+      token = text[token_start:pos]
+      if token != u" " or token_start == 0:
+        ret.append(token)
+      token_start = pos
+  ret.append(text[token_start:])
+  return ret
+
 
 class TestTokenCounts(tf.test.TestCase):
 
@@ -116,6 +154,48 @@ class TestTokenCounts(tf.test.TestCase):
         u".\n": 1
     }, token_counts)
 
+  def test_parallel_corpus_token_counts(self):
+    # Use tiny byte ranges so that lines are split across many tasks.
+    with mock.patch.object(tokenizer, "_MAX_BYTES_PER_TASK", new=7):
+      for split_on_newlines in [True, False]:
+        for corpus_max_lines in [0, 1, 3, 5, 6, 100]:
+          self.assertDictEqual(
+              tokenizer.corpus_token_counts(
+                  self.corpus_path, corpus_max_lines,
+                  split_on_newlines=split_on_newlines),
+              tokenizer.corpus_token_counts(
+                  self.corpus_path, corpus_max_lines,
+                  split_on_newlines=split_on_newlines, num_processes=3))
+
+  def test_task_line_budgets_stop_at_max_lines(self):
+
+    class SerialPool(object):
+      """Runs apply_async calls right away and records their tasks."""
+
+      def __init__(self):
+        self.tasks = []
+
+      def apply_async(self, func, args):
+        self.tasks.append(args[0][0])
+        result = func(*args)
+        return mock.Mock(get=lambda: result)
+
+    # Tasks of up to 7 bytes, so that the corpus has many more of them than
+    # it takes to read two lines.
+    with mock.patch.object(tokenizer, "_MAX_BYTES_PER_TASK", new=7):
+      tasks = []
+      for filename in sorted(tf.gfile.Glob(self.corpus_path)):
+        tasks.extend(tokenizer._file_tasks(filename, True))
+    pool = SerialPool()
+    budgets = tokenizer._task_line_budgets(pool, tasks, 2, 3)
+    self.assertEqual(2, sum(budgets))
+    self.assertTrue(budgets[-1])
+    # Only the tasks up to the second line were counted, plus those already
+    # handed to the pool.
+    self.assertEqual(tasks[:len(pool.tasks)], pool.tasks)
+    self.assertLess(len(pool.tasks), len(budgets) + 3)
+    self.assertLess(len(pool.tasks), len(tasks))
+
   def test_vocab_token_counts(self):
     token_counts = tokenizer.vocab_token_counts(self.vocab_path, 0)
 
@@ -141,5 +221,45 @@ class TestTokenCounts(tf.test.TestCase):
     self.assertDictEqual(expected, token_counts)
 
 
+class TokenizerBenchmark(tf.test.Benchmark):
+  """Benchmarks tokenizer.encode against per-character classification.
+
+  Run with:
+    python tokenizer_test.py --benchmarks=TokenizerBenchmark
+  """
+
+  def _corpus_lines(self, num_bytes=4 * 10**6, seed=0):
+    rng = random.Random(seed)
+    words = [u"Dude", u"that's", u"so", u"cool.", u"802.11b", u"\u0141ukasz",
+             u"est", u"n\u00e9", u"en", u"1981", u"--", u"(", u")", u"\u4e2d"]
+    lines, size = [], 0
+    while size < num_bytes:
+      line = u" ".join(rng.choice(words) for _ in xrange(rng.randint(5, 40)))
+      lines.append(line)
+      size += len(line.encode("utf-8"))
+    return lines
+
+  def _time_encode(self, encode_fn, lines):
+    start_time = time.time()
+    for line in lines:
+      encode_fn(line)
+    return time.time() - start_time
+
+  def benchmark_encode(self):
+    lines = self._corpus_lines()
+    for line in lines[:1000]:
+      assert _classify_and_split(line) == tokenizer.encode(line)
+
+    reference_time = self._time_encode(_classify_and_split, lines)
+    regex_time = self._time_encode(tokenizer.encode, lines)
+
+    num_chars = sum(len(line) for line in lines)
+    self.report_benchmark(
+        iters=len(lines),
+        wall_time=regex_time,
+        extras={"per_char_chars_per_sec": num_chars / reference_time,
+                "regex_chars_per_sec": num_chars / regex_time})
+
+
 if __name__ == "__main__":
   tf.test.main()
@@ -26,6 +26,7 @@ import tarfile
 
 from tensor2tensor.data_generators import generator_utils
 from tensor2tensor.data_generators import problem
+from tensor2tensor.data_generators import text_encoder
 
 import tensorflow as tf
 
@@ -108,7 +109,8 @@ def tabbed_generator(source_path, source_vocab, target_vocab, eos=None):
         yield {"inputs": source_ints, "targets": target_ints}
 
 
-def token_generator(source_path, target_path, token_vocab, eos=None):
+def token_generator(source_path, target_path, token_vocab, eos=None,
+                    num_processes=None, batch_size=10000):
   """Generator for sequence-to-sequence tasks that uses tokens.
 
   This generator assumes the files at source_path and target_path have
@@ -121,6 +123,9 @@ def token_generator(source_path, target_path, token_vocab, eos=None):
     target_path: path to the file with target sentences.
     token_vocab: text_encoder.TextEncoder object.
     eos: integer to append at the end of each sequence (default: None).
+    num_processes: if greater than 1, encode each batch of lines in a pool of
+      this many processes (see TextEncoder.encode_batch).
+    batch_size: number of line pairs read and encoded at a time.
   Yields:
     A dictionary {"inputs": source-line, "targets": target-line} where
     the lines are integer lists converted from tokens in the file lines.
@@ -128,12 +133,31 @@ def token_generator(source_path, target_path, token_vocab, eos=None):
   eos_list = [] if eos is None else [eos]
   with tf.gfile.GFile(source_path, mode="r") as source_file:
     with tf.gfile.GFile(target_path, mode="r") as target_file:
-      source, target = source_file.readline(), target_file.readline()
-      while source and target:
-        source_ints = token_vocab.encode(source.strip()) + eos_list
-        target_ints = token_vocab.encode(target.strip()) + eos_list
-        yield {"inputs": source_ints, "targets": target_ints}
+
+      def line_batches():
+        """Yields a batch of source lines, then the matching target lines."""
         source, target = source_file.readline(), target_file.readline()
+        while source and target:
+          sources, targets = [], []
+          while source and target and len(sources) < batch_size:
+            sources.append(source.strip())
+            targets.append(target.strip())
+            source, target = source_file.readline(), target_file.readline()
+          yield sources
+          yield targets
+
+      # One pool encodes both sides of every batch.
+      encoded = token_vocab.encode_batches(line_batches(), num_processes)
+      for source_batch in encoded:
+        target_batch = next(encoded)
+        for source_ints, target_ints in zip(source_batch, target_batch):
+          yield {"inputs": source_ints + eos_list,
+                 "targets": target_ints + eos_list}
+  # With num_processes > 1 the caches that saw the tokens live in the workers.
+  if (isinstance(token_vocab, text_encoder.SubwordTextEncoder) and
+      not (num_processes and num_processes > 1)):
+    tf.logging.info("Token cache stats for %s: %s",
+                    source_path, token_vocab.cache_stats)
 
 
 def bi_vocabs_token_generator(source_path,
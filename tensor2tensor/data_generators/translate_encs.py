@@ -19,6 +19,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import multiprocessing
+
 # Dependency imports
 
 from tensor2tensor.data_generators import generator_utils
@@ -93,7 +95,8 @@ class TranslateEncsWmt32k(translate.TranslateProblem):
         data_dir, tmp_dir, self.vocab_file, self.targeted_vocab_size,
         vocab_datasets)
     return translate.token_generator(data_path + ".lang1", data_path + ".lang2",
-                                     symbolizer_vocab, EOS)
+                                     symbolizer_vocab, EOS,
+                                     num_processes=multiprocessing.cpu_count())
 
   @property
   def input_space_id(self):
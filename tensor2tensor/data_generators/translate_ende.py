@@ -19,6 +19,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import multiprocessing
 import os
 import tarfile
 
@@ -137,7 +138,8 @@ class TranslateEndeWmt8k(translate.TranslateProblem):
     data_path = translate.compile_data(tmp_dir, datasets,
                                        "wmt_ende_tok_%s" % tag)
     return translate.token_generator(data_path + ".lang1", data_path + ".lang2",
-                                     symbolizer_vocab, EOS)
+                                     symbolizer_vocab, EOS,
+                                     num_processes=multiprocessing.cpu_count())
 
   @property
   def input_space_id(self):
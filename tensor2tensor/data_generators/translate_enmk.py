@@ -19,6 +19,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import multiprocessing
+
 # Dependency imports
 
 from tensor2tensor.data_generators import generator_utils
@@ -76,7 +78,8 @@ class TranslateEnmkSetimes32k(translate.TranslateProblem):
     # just add the "_rev" suffix to the problem name, e.g., like this.
     #   --problems=translate_enmk_setimes32k_rev
     return translate.token_generator(data_path + ".lang2", data_path + ".lang1",
-                                     symbolizer_vocab, EOS)
+                                     symbolizer_vocab, EOS,
+                                     num_processes=multiprocessing.cpu_count())
 
   @property
   def input_space_id(self):
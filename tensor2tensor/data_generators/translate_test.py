@@ -78,6 +78,25 @@ class TranslateTest(tf.test.TestCase):
     os.remove(tmp_file_path + ".tgt")
     os.remove(tmp_file_path)
 
+  def testTokenGeneratorInPool(self):
+    tmp_dir = self.get_temp_dir()
+    sources = ["source %d" % i for i in range(7)]
+    targets = ["target %d" % i for i in range(7)]
+    with io.open(os.path.join(tmp_dir, "pool.src"), "w") as f:
+      f.write(u"".join(s + u"\n" for s in sources))
+    with io.open(os.path.join(tmp_dir, "pool.tgt"), "w") as f:
+      f.write(u"".join(t + u"\n" for t in targets))
+    vocab = text_encoder.TokenTextEncoder(
+        None, vocab_list=["source", "target"] + [str(i) for i in range(7)])
+    expected = [{"inputs": vocab.encode(s) + [1],
+                 "targets": vocab.encode(t) + [1]}
+                for s, t in zip(sources, targets)]
+    for num_processes in [None, 2]:
+      self.assertEqual(expected, list(translate.token_generator(
+          os.path.join(tmp_dir, "pool.src"),
+          os.path.join(tmp_dir, "pool.tgt"), vocab, eos=1,
+          num_processes=num_processes, batch_size=3)))
+
 
 if __name__ == "__main__":
   tf.test.main()
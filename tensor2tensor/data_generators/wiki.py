@@ -19,12 +19,19 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import bz2
+import codecs
+import collections
+import contextlib
+import itertools
+import multiprocessing
 import os
 import subprocess
 
 # Dependency imports
 
 import numpy as np
+import six
 
 from tensor2tensor.data_generators import generator_utils
 from tensor2tensor.data_generators import problem
@@ -221,28 +228,84 @@ class LanguagemodelWikiNorefV8kL1k(LanguagemodelWikiXmlV8kL1k):
   without regard to article boundaries.
   """
 
+  def __init__(self, was_reversed=False, was_copy=False):
+    super(LanguagemodelWikiNorefV8kL1k, self).__init__(was_reversed, was_copy)
+    # The pool of the task being generated; see _cleanup_pool().
+    self._pool = None
+
   @property
   def vocab_name(self):
     return "vocab.wiki_noref"
 
+  def filepath_to_unicode_strings(self, filepath):
+    """Overrides the base class to clean up the xml dump before tokenizing.
+
+    Yields one string per article, as the pages of the dump are read.
+
+    Args:
+      filepath: a string; a part of the xml dump, optionally bz2-compressed.
+    Yields:
+      unicode strings.
+    """
+    pages = _dump_chunks_to_pages(
+        _read_dump_chunks(filepath, self.read_chunk_size))
+    with self._cleanup_pool() as pool:
+      if pool is None:
+        texts = six.moves.map(_clean_page, pages)
+      else:
+        texts = _clean_pages_in_pool(pool, pages,
+                                     4 * self.num_cleanup_processes)
+      for text in texts:
+        if text is not None:
+          yield text
+
   def filepath_to_unicode_text(self, filepath):
-    """Overriddes the base class to clean up the xml dump before tokenizing."""
-    dump = problem.to_unicode_ignore_erros(tf.gfile.Open(filepath).read())
-    pages = _dump_to_pages(dump)
-    ret = u""
-    for p in pages:
-      title = _page_to_title(p)
-      text = _page_to_text(p)
-      text = _remove_triple_quotes(
-          _remove_double_brackets(_remove_references(text)))
-      if u":" in title:
-        # not a regular article
-        continue
-      if len(text) <= 140:
-        # Probably a redirect or something like that.  Skip it.
-        continue
-      ret += u"title: \"%s\" length: %d\n%s\n" % (title, len(text), text)
-    return ret
+    """The cleaned up text of a part of the xml dump, as one string."""
+    return u"".join(self.filepath_to_unicode_strings(filepath))
+
+  def get_or_generate_vocab(self, data_dir, tmp_dir):
+    # One pool cleans up the pages of all the part files read for the vocab.
+    with self._cleanup_pool():
+      return super(LanguagemodelWikiNorefV8kL1k, self).get_or_generate_vocab(
+          data_dir, tmp_dir)
+
+  def generate_data(self, data_dir, tmp_dir, task_id=-1):
+    # One pool cleans up the pages of all the part files of the task.
+    with self._cleanup_pool():
+      super(LanguagemodelWikiNorefV8kL1k, self).generate_data(
+          data_dir, tmp_dir, task_id)
+
+  @contextlib.contextmanager
+  def _cleanup_pool(self):
+    """Provides the pool that cleans up pages.
+
+    The pool is created when none is in use already, and terminated when the
+    outermost user is done with it.
+
+    Yields:
+      a multiprocessing.Pool, or None to clean up pages in this process.
+    """
+    if self._pool is not None:
+      yield self._pool
+      return
+    if (self.num_cleanup_processes <= 1 or
+        multiprocessing.current_process().daemon):
+      # Daemonic processes, e.g. workers of t2t-datagen's pool, cannot start
+      # pools of their own.
+      yield None
+      return
+    self._pool = multiprocessing.Pool(processes=self.num_cleanup_processes)
+    try:
+      yield self._pool
+    finally:
+      self._pool.terminate()
+      self._pool.join()
+      self._pool = None
+
+  @property
+  def num_cleanup_processes(self):
+    """Number of worker processes cleaning up pages."""
+    return multiprocessing.cpu_count()
 
   @property
   def max_chars_for_vocab(self):
@@ -251,6 +314,108 @@ class LanguagemodelWikiNorefV8kL1k(LanguagemodelWikiXmlV8kL1k):
     return 21240483
 
 
+_CLEANUP_BATCH_SIZE = 16
+
+
+def _clean_pages(pages):
+  return [_clean_page(page) for page in pages]
+
+
+def _clean_pages_in_pool(pool, pages, max_pending):
+  """Cleans up pages in a pool.
+
+  Only max_pending batches of pages are read ahead of the results; Pool.imap
+  would read all the pages of the file into its task queue.
+
+  Args:
+    pool: a multiprocessing.Pool.
+    pages: an iterable of unicode strings.
+    max_pending: an integer; the most batches in flight at a time.
+  Yields:
+    _clean_page() of each page, in order.
+  """
+  pages = iter(pages)
+  pending = collections.deque()
+  while True:
+    batch = list(itertools.islice(pages, _CLEANUP_BATCH_SIZE))
+    if not batch:
+      break
+    pending.append(pool.apply_async(_clean_pages, (batch,)))
+    if len(pending) >= max_pending:
+      for text in pending.popleft().get():
+        yield text
+  while pending:
+    for text in pending.popleft().get():
+      yield text
+
+
+def _read_dump_chunks(filepath, chunk_size):
+  """Reads an xml dump in pieces.
+
+  Args:
+    filepath: a string; the dump is decompressed if the name ends in ".bz2".
+    chunk_size: number of bytes to read at a time.
+  Yields:
+    unicode strings
+  """
+  compressed = filepath.endswith(".bz2")
+  bz2_decompressor = bz2.BZ2Decompressor()
+  decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+  with tf.gfile.Open(filepath, "rb") as f:
+    while True:
+      b = f.read(chunk_size)
+      data = b
+      if compressed and b:
+        data = b""
+        rest = b
+        while rest:
+          # Multistream dumps are several bz2 streams concatenated. When a
+          # stream ends inside a chunk, the rest of the chunk is left in
+          # unused_data; when it ends with a chunk, decompressing more fails.
+          try:
+            data += bz2_decompressor.decompress(rest)
+          except EOFError:
+            bz2_decompressor = bz2.BZ2Decompressor()
+            continue
+          rest = bz2_decompressor.unused_data
+          if rest:
+            bz2_decompressor = bz2.BZ2Decompressor()
+      text = decoder.decode(data, final=not b)
+      if text:
+        yield text
+      if not b:
+        break
+
+
+def _dump_chunks_to_pages(chunks):
+  """Extract pages from an xml dump that is read in pieces.
+
+  Args:
+    chunks: an iterable of unicode strings; the pieces of the dump.
+  Yields:
+    unicode strings; the pages, as soon as their end tag has been read.
+  """
+  start_tag = u"<page>\n"
+  end_tag = u"</page>\n"
+  buf = u""
+  for chunk in chunks:
+    buf += chunk
+    pos = 0
+    while True:
+      start_pos = buf.find(start_tag, pos)
+      if start_pos == -1:
+        # Keep what could be the beginning of a start tag.
+        pos = max(pos, len(buf) - len(start_tag) + 1)
+        break
+      end_pos = buf.find(end_tag, start_pos + len(start_tag))
+      if end_pos == -1:
+        pos = start_pos
+        break
+      yield buf[start_pos + len(start_tag):end_pos]
+      pos = end_pos + len(end_tag)
+    buf = buf[pos:]
+
+
 def _dump_to_pages(dump):
   """Extract pages from an xml dump.
 
@@ -259,21 +424,29 @@ def _dump_to_pages(dump):
   Returns:
     a list of unicode strings
   """
-  pos = 0
-  ret = []
-  start_tag = u"<page>\n"
-  end_tag = u"</page>\n"
-  while True:
-    start_pos = dump.find(start_tag, pos)
-    if start_pos == -1:
-      break
-    start_pos += len(start_tag)
-    end_pos = dump.find(end_tag, start_pos)
-    if end_pos == -1:
-      break
-    ret.append(dump[start_pos:end_pos])
-    pos = end_pos + len(end_tag)
-  return ret
+  return list(_dump_chunks_to_pages([dump]))
+
+
+def _clean_page(page):
+  """Clean up a page of the xml dump.
+
+  Args:
+    page: a unicode string
+  Returns:
+    a unicode string with a header line and the text of the article, or None
+    if the page should be skipped.
+  """
+  title = _page_to_title(page)
+  if u":" in title:
+    # not a regular article
+    return None
+  text = _page_to_text(page)
+  text = _remove_triple_quotes(
+      _remove_double_brackets(_remove_references(text)))
+  if len(text) <= 140:
+    # Probably a redirect or something like that.  Skip it.
+    return None
+  return u"title: \"%s\" length: %d\n%s\n" % (title, len(text), text)
 
 
 def _page_to_title(page):
@@ -332,20 +505,21 @@ def _find_and_replace(text, start_string, end_string, replace_fn):
   Returns:
     a string
   """
-  ret = u""
+  # Collect the pieces and join them once; appending to a string copies it.
+  pieces = []
   current_pos = 0
   while True:
     start_pos = text.find(start_string, current_pos)
     if start_pos == -1:
-      ret += text[current_pos:]
+      pieces.append(text[current_pos:])
       break
-    ret += text[current_pos:start_pos]
+    pieces.append(text[current_pos:start_pos])
     end_pos = text.find(end_string, start_pos + len(start_string))
     if end_pos == -1:
       break
-    ret += replace_fn(text[start_pos + len(start_string):end_pos])
+    pieces.append(replace_fn(text[start_pos + len(start_string):end_pos]))
     current_pos = end_pos + len(end_string)
-  return ret
+  return u"".join(pieces)
 
 
 def _remove_references(text):
@@ -0,0 +1,143 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tensor2tensor.data_generators.wiki."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import bz2
+import multiprocessing
+import os
+
+# Dependency imports
+
+import mock
+
+from tensor2tensor.data_generators import wiki
+import tensorflow as tf
+
+
+def _page(title, text):
+  return ("<page>\n<title>%s</title>\n<revision>\n"
+          "<text xml:space=\"preserve\">%s</text>\n</revision>\n</page>\n" %
+          (title, text))
+
+
+_ARTICLE = ("'''Cats''' are [[mammal]]s&lt;ref&gt;A book&lt;/ref&gt; that "
+            "[[Meow|say meow]]. [[Category:Animals]] " + "Purr. " * 30)
+_DUMP = ("<mediawiki>\n" + _page("Cat", _ARTICLE) +
+         _page("Talk:Cat", _ARTICLE) + _page("Dog", "#REDIRECT [[Cat]]") +
+         _page("Gato \U0001F638", _ARTICLE) + "</mediawiki>\n")
+
+
+class WikiTest(tf.test.TestCase):
+
+  def test_dump_chunks_to_pages(self):
+    pages = wiki._dump_to_pages(_DUMP)
+    self.assertEqual(4, len(pages))
+    for chunk_size in [1, 7, 100]:
+      chunks = [_DUMP[i:i + chunk_size]
+                for i in range(0, len(_DUMP), chunk_size)]
+      self.assertEqual(pages, list(wiki._dump_chunks_to_pages(chunks)))
+
+  def test_clean_page(self):
+    pages = wiki._dump_to_pages(_DUMP)
+    text = "Cats are mammals that say meow.  " + "Purr. " * 30
+    self.assertEqual("title: \"Cat\" length: %d\n%s\n" % (len(text), text),
+                     wiki._clean_page(pages[0]))
+    self.assertIsNone(wiki._clean_page(pages[1]))
+    self.assertIsNone(wiki._clean_page(pages[2]))
+
+  def test_filepath_to_unicode_strings(self):
+    problem = wiki.LanguagemodelWikiNorefV8kL1k()
+    pages = wiki._dump_to_pages(_DUMP)
+    expected = [wiki._clean_page(pages[0]), wiki._clean_page(pages[3])]
+    filepath = os.path.join(self.get_temp_dir(), "dump.xml.bz2")
+    with open(filepath, "wb") as f:
+      # Two streams, as in multistream dumps.
+      middle = len(_DUMP) // 2
+      f.write(bz2.compress(_DUMP[:middle].encode("utf-8")))
+      f.write(bz2.compress(_DUMP[middle:].encode("utf-8")))
+
+    for num_processes in [1, 2]:
+      with mock.patch.object(
+          wiki.LanguagemodelWikiNorefV8kL1k, "num_cleanup_processes",
+          num_processes), mock.patch.object(
+              wiki.LanguagemodelWikiNorefV8kL1k, "read_chunk_size", 10):
+        self.assertEqual(expected,
+                         list(problem.filepath_to_unicode_strings(filepath)))
+        self.assertEqual("".join(expected),
+                         problem.filepath_to_unicode_text(filepath))
+
+  def test_read_dump_chunks_multistream(self):
+    streams = [bz2.compress(_DUMP[:100].encode("utf-8")),
+               bz2.compress(_DUMP[100:].encode("utf-8"))]
+    filepath = os.path.join(self.get_temp_dir(), "multistream.xml.bz2")
+    with open(filepath, "wb") as f:
+      f.write(b"".join(streams))
+    # The first stream ends exactly at the end of a chunk, or inside one.
+    for chunk_size in [len(streams[0]), 10, 2**20]:
+      self.assertEqual(
+          _DUMP, "".join(wiki._read_dump_chunks(filepath, chunk_size)))
+
+  def test_clean_pages_in_pool_reads_ahead_boundedly(self):
+    pages = wiki._dump_to_pages(_DUMP) * 100
+    num_read = [0]
+
+    def read_pages():
+      for page in pages:
+        num_read[0] += 1
+        yield page
+
+    pool = multiprocessing.Pool(processes=2)
+    try:
+      texts = wiki._clean_pages_in_pool(pool, read_pages(), 2)
+      self.assertEqual(wiki._clean_page(pages[0]), next(texts))
+      self.assertLessEqual(num_read[0], 2 * wiki._CLEANUP_BATCH_SIZE)
+      self.assertEqual([wiki._clean_page(page) for page in pages[1:]],
+                       list(texts))
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def test_vocab_files_share_one_pool(self):
+    problem = wiki.LanguagemodelWikiNorefV8kL1k()
+    filepaths = []
+    for i in range(3):
+      filepath = os.path.join(self.get_temp_dir(), "part%d.xml" % i)
+      with open(filepath, "wb") as f:
+        f.write(_DUMP.encode("utf-8"))
+      filepaths.append(filepath)
+    data_dir = os.path.join(self.get_temp_dir(), "vocab_data")
+    tf.gfile.MakeDirs(data_dir)
+    with mock.patch.object(
+        wiki.LanguagemodelWikiNorefV8kL1k, "num_cleanup_processes",
+        2), mock.patch.object(
+            wiki.LanguagemodelWikiNorefV8kL1k, "train_text_filepaths",
+            lambda self, tmp_dir: filepaths), mock.patch.object(
+                wiki.LanguagemodelWikiNorefV8kL1k, "targeted_vocab_size",
+                100), mock.patch.object(
+                    multiprocessing, "Pool",
+                    wraps=multiprocessing.Pool) as pool:
+      problem.get_or_generate_vocab(data_dir, self.get_temp_dir())
+    self.assertEqual(1, pool.call_count)
+    self.assertIsNone(problem._pool)
+
+
+if __name__ == "__main__":
+  tf.test.main()
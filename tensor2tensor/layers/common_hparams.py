@@ -176,6 +176,10 @@ def basic_params1():
       # examples.  e.g.  The examples may be written with length 65536, but we
       # want to split each example into 64 examples of length 1024.
       split_to_length=0,
+      # If nonzero, we pack the text examples into examples of this length
+      # on example read, as Text2TextProblem.packed_length does at datagen
+      # time. See generator_utils.pack_dataset().
+      pack_to_length=0,
       # This flag allows us to optionally treat a seq-to-seq problem
       # as a language model.  Legal values are:
       #
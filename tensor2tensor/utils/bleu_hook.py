@@ -22,19 +22,18 @@ import collections
 import math
 import os
 import re
-import sys
 import time
-import unicodedata
 
 # Dependency imports
 
 import numpy as np
-import six
 # pylint: disable=redefined-builtin
 from six.moves import xrange
 from six.moves import zip
 # pylint: enable=redefined-builtin
 
+from tensor2tensor.utils import unicode_tables
+
 import tensorflow as tf
 
 
@@ -146,17 +145,42 @@ def bleu_score(predictions, labels, **unused_kwargs):
 
 
 class UnicodeRegex(object):
-  """Ad-hoc hack to recognize all punctuation and symbols."""
+  """Ad-hoc hack to recognize all punctuation and symbols.
+
+  The regexes are compiled on first use, so that importing this module does
+  not scan all of Unicode.
+  """
 
   def __init__(self):
+    self._regexes = None
+
+  def _compile(self):
     punctuation = self.property_chars("P")
-    self.nondigit_punct_re = re.compile(r"([^\d])([" + punctuation + r"])")
-    self.punct_nondigit_re = re.compile(r"([" + punctuation + r"])([^\d])")
-    self.symbol_re = re.compile("([" + self.property_chars("S") + "])")
+    self._regexes = (
+        re.compile(r"([^\d])([" + punctuation + r"])"),
+        re.compile(r"([" + punctuation + r"])([^\d])"),
+        re.compile("([" + self.property_chars("S") + "])"))
+
+  @property
+  def nondigit_punct_re(self):
+    if self._regexes is None:
+      self._compile()
+    return self._regexes[0]
+
+  @property
+  def punct_nondigit_re(self):
+    if self._regexes is None:
+      self._compile()
+    return self._regexes[1]
+
+  @property
+  def symbol_re(self):
+    if self._regexes is None:
+      self._compile()
+    return self._regexes[2]
 
   def property_chars(self, prefix):
-    return "".join(six.unichr(x) for x in range(sys.maxunicode)
-                   if unicodedata.category(six.unichr(x)).startswith(prefix))
+    return unicode_tables.chars_in_categories(prefix)
 
 
 uregex = UnicodeRegex()
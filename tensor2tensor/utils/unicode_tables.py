@@ -0,0 +1,141 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tables of Unicode characters by general category, cached on disk.
+
+Scanning all of sys.maxunicode with unicodedata.category takes about a second
+per table. The tables are therefore built on first use and stored in a
+per-user cache directory, keyed by the unicodedata version and sys.maxunicode,
+so that later processes just read them back. A cached table is checked
+against its header and the categories of its characters before it is used,
+and rebuilt if it does not match.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import os
+import sys
+import tempfile
+import unicodedata
+
+# Dependency imports
+
+import six
+from six.moves import xrange  # pylint: disable=redefined-builtin
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "tensor2tensor", "unicode_tables")
+
+# Tables already built or loaded by this process.
+_tables = {}
+
+
+def _cache_filename(cache_dir, prefixes):
+  return os.path.join(
+      cache_dir, "%s-%d-%s.txt" % (unicodedata.unidata_version,
+                                   sys.maxunicode, "".join(prefixes)))
+
+
+def _build_table(prefixes):
+  return u"".join(
+      six.unichr(i) for i in xrange(sys.maxunicode)
+      if unicodedata.category(six.unichr(i)).startswith(prefixes))
+
+
+def _header(prefixes, table):
+  return u"t2t unicode table %s %d %s %d\n" % (
+      unicodedata.unidata_version, sys.maxunicode, u",".join(prefixes),
+      len(table))
+
+
+def _read_table(filename, prefixes):
+  """Returns the table cached in filename, or None if it is missing or wrong.
+
+  Args:
+    filename: a string
+    prefixes: the tuple of category prefixes of the table.
+  """
+  try:
+    with io.open(filename, encoding="utf-8") as f:
+      contents = f.read()
+  except (IOError, OSError, UnicodeDecodeError):
+    return None
+  header, _, table = contents.partition(u"\n")
+  if header + u"\n" != _header(prefixes, table):
+    return None
+  # The characters must be the right ones, in code point order.
+  if not (all(a < b for a, b in zip(table, table[1:])) and
+          all(unicodedata.category(c).startswith(prefixes) for c in table)):
+    return None
+  return table
+
+
+def _write_table(filename, prefixes, table):
+  """Writes a table atomically, so concurrent readers never see a partial one.
+
+  Args:
+    filename: a string
+    prefixes: the tuple of category prefixes of the table.
+    table: a unicode string
+  """
+  directory = os.path.dirname(filename)
+  if not os.path.isdir(directory):
+    # Other users must not be able to plant tables.
+    os.makedirs(directory, 0o700)
+  fd, tmp_filename = tempfile.mkstemp(dir=directory)
+  try:
+    with io.open(fd, "w", encoding="utf-8") as f:
+      f.write(_header(prefixes, table))
+      f.write(table)
+    os.rename(tmp_filename, filename)
+  except:  # pylint: disable=bare-except
+    os.remove(tmp_filename)
+    raise
+
+
+def chars_in_categories(prefixes, cache_dir=DEFAULT_CACHE_DIR):
+  """Returns all characters whose Unicode category starts with a prefix.
+
+  Args:
+    prefixes: a string or tuple of strings, e.g. "P" or ("L", "N").
+    cache_dir: directory to cache the table in, or None to not use the disk.
+
+  Returns:
+    a unicode string of the matching characters, in code point order.
+  """
+  if isinstance(prefixes, six.string_types):
+    prefixes = (prefixes,)
+  prefixes = tuple(prefixes)
+  if prefixes in _tables:
+    return _tables[prefixes]
+
+  filename = _cache_filename(cache_dir, prefixes) if cache_dir else None
+  table = _read_table(filename, prefixes) if filename else None
+  if table is None:
+    table = _build_table(prefixes)
+    if filename:
+      try:
+        _write_table(filename, prefixes, table)
+      except (IOError, OSError):
+        # The cache is only an optimization; e.g. the directory may be
+        # read-only.
+        pass
+
+  _tables[prefixes] = table
+  return table
@@ -0,0 +1,128 @@
+# coding=utf-8
+# Copyright 2018 The Tensor2Tensor Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for tensor2tensor.utils.unicode_tables."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Dependency imports
+
+import mock
+
+from tensor2tensor.utils import unicode_tables
+
+import tensorflow as tf
+
+
+class UnicodeTablesTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(UnicodeTablesTest, self).setUp()
+    self.cache_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    unicode_tables._tables.clear()
+
+  def tearDown(self):
+    shutil.rmtree(self.cache_dir, ignore_errors=True)
+    super(UnicodeTablesTest, self).tearDown()
+
+  def testTableIsCachedOnDisk(self):
+    table = unicode_tables.chars_in_categories("Sc", cache_dir=self.cache_dir)
+    self.assertIn(u"$", table)
+    self.assertIn(u"€", table)
+    self.assertNotIn(u"a", table)
+    self.assertEqual(1, len(os.listdir(self.cache_dir)))
+
+    # A new process would read the table back from the cache directory.
+    unicode_tables._tables.clear()
+    self.assertEqual(
+        table,
+        unicode_tables.chars_in_categories("Sc", cache_dir=self.cache_dir))
+    self.assertEqual(table, unicode_tables._build_table(("Sc",)))
+
+  def testCacheDirectoryIsPrivate(self):
+    cache_dir = os.path.join(self.cache_dir, "new")
+    unicode_tables.chars_in_categories("Sc", cache_dir=cache_dir)
+    self.assertEqual(0o700, os.stat(cache_dir).st_mode & 0o777)
+
+  def testWrongCachedTablesAreRebuilt(self):
+    table = unicode_tables.chars_in_categories("Sc", cache_dir=self.cache_dir)
+    filename = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+    header = unicode_tables._header(("Sc",), table)
+    for contents in [
+        # No header, as written by older versions.
+        table.encode("utf-8"),
+        # A character of another category.
+        (unicode_tables._header(("Sc",), table[:-1] + u"a") + table[:-1] +
+         u"a").encode("utf-8"),
+        # Truncated.
+        (header + table[:-1]).encode("utf-8"),
+        # Not UTF-8.
+        header.encode("utf-8") + b"\xff"]:
+      with open(filename, "wb") as f:
+        f.write(contents)
+      unicode_tables._tables.clear()
+      self.assertEqual(
+          table,
+          unicode_tables.chars_in_categories("Sc", cache_dir=self.cache_dir))
+      # The cache file is rewritten.
+      self.assertEqual(table,
+                       unicode_tables._read_table(filename, ("Sc",)))
+
+  def testFailedWriteLeavesNoTemporaryFile(self):
+    with mock.patch.object(unicode_tables.os, "rename",
+                           side_effect=OSError("no")):
+      unicode_tables.chars_in_categories("Sc", cache_dir=self.cache_dir)
+    self.assertEqual([], os.listdir(self.cache_dir))
+
+  def testMultiplePrefixes(self):
+    table = unicode_tables.chars_in_categories(("Lu", "Nd"), cache_dir=None)
+    self.assertIn(u"A", table)
+    self.assertIn(u"7", table)
+    self.assertNotIn(u"a", table)
+    self.assertEqual(sorted(table), list(table))
+
+
+class ImportTimeBenchmark(tf.test.Benchmark):
+  """Measures the start-up cost of the t2t binaries.
+
+  Run with:
+    python unicode_tables_test.py --benchmarks=ImportTimeBenchmark
+  """
+
+  def _time_import(self, module):
+    start_time = time.time()
+    subprocess.check_call([sys.executable, "-c", "import %s" % module])
+    return time.time() - start_time
+
+  def benchmark_import_t2t_decoder(self):
+    module = "tensor2tensor.bin.t2t_decoder"
+    # The first import may need to populate the on-disk Unicode tables.
+    self._time_import(module)
+    num_iters = 3
+    wall_time = sum(self._time_import(module) for _ in range(num_iters))
+    self.report_benchmark(iters=num_iters, wall_time=wall_time / num_iters)
+
+
+if __name__ == "__main__":
+  tf.test.main()